@@ -0,0 +1,258 @@
+#!/usr/bin/env python
+#
+# This file is part of the cpthook library.
+#
+# cpthook is free software released under the BSD License.
+# Please see the LICENSE file included in this distribution for
+# terms of use. This LICENSE is also available at
+# https://github.com/aelse/cpthook/blob/master/LICENSE
+
+"""Benchmark cpthook against synthetic configs and repository farms
+
+Generates a config with a number of repo groups, hook groups and
+inherited memberships, lays out a matching farm of bare repositories
+in a temporary directory and times the main cpthook operations.
+Results are written as JSON so that runs against different versions
+of cpthook can be compared with --compare."""
+
+import json
+import logging
+import optparse
+import os
+import os.path
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import cpthook
+
+
+def parse_options():
+    parser = optparse.OptionParser()
+    parser.add_option("--repo-groups", dest="repo_groups", type="int",
+                      default=200, help="number of repo groups")
+    parser.add_option("--repos-per-group", dest="repos_per_group",
+                      type="int", default=10,
+                      help="number of repos listed in each repo group")
+    parser.add_option("--hook-groups", dest="hook_groups", type="int",
+                      default=20, help="number of hook groups")
+    parser.add_option("--depth", dest="depth", type="int", default=4,
+                      help="depth of @ inheritance between repo groups")
+    parser.add_option("--fan-out", dest="fan_out", type="int", default=3,
+                      help="number of groups inheriting from each group")
+    parser.add_option("--scripts", dest="scripts", type="int", default=3,
+                      help="number of scripts per hook type in hook groups")
+    parser.add_option("--hook-runs", dest="hook_runs", type="int",
+                      default=20, help="number of end to end hook runs")
+    parser.add_option("--repeat", dest="repeat", type="int", default=3,
+                      help="number of times to repeat each benchmark")
+    parser.add_option("-o", "--output", dest="output", metavar="FILE",
+                      default=None, help="write results to FILE")
+    parser.add_option("--compare", dest="compare", metavar="FILE",
+                      default=None,
+                      help="compare results with an earlier results FILE")
+    parser.add_option("--keep", dest="keep", default=False,
+                      action="store_true",
+                      help="keep the generated config and repositories")
+    options, args = parser.parse_args()
+    return options
+
+
+def group_parent(index, fan_out):
+    """Returns the index of the group inheriting from group index"""
+    return (index - 1) // fan_out
+
+
+def group_depth(index, fan_out):
+    depth = 0
+    while index > 0:
+        index = group_parent(index, fan_out)
+        depth += 1
+    return depth
+
+
+def write_config(root, opts):
+    """Write a synthetic config and return it with the repo names
+
+    Repo groups form trees: a group inherits the members of up to
+    fan_out child groups, down to the given depth of inheritance."""
+
+    script_path = os.path.join(root, 'hooks.d')
+    repo_path = os.path.join(root, 'repos')
+    repos = []
+    lines = ['[cpthook]',
+             'script-path = {0}'.format(script_path),
+             'repo-path = {0}'.format(repo_path),
+             '']
+
+    inherits = dict((i, []) for i in range(opts.repo_groups))
+    for i in range(1, opts.repo_groups):
+        if group_depth(i, opts.fan_out) <= opts.depth:
+            inherits[group_parent(i, opts.fan_out)].append(i)
+
+    for i in range(opts.repo_groups):
+        members = ['repo{0}-{1}'.format(i, j)
+                   for j in range(opts.repos_per_group)]
+        repos += members
+        members += ['@group{0}'.format(x) for x in inherits[i]]
+        lines += ['[repos group{0}]'.format(i),
+                  'members = {0}'.format(' '.join(members)),
+                  'hooks = hooks{0}'.format(i % opts.hook_groups),
+                  '']
+
+    lines += ['[repos *]', 'hooks = global', '']
+    for i in range(opts.hook_groups):
+        scripts = ['noop{0}.sh'.format((i + j) % (opts.scripts * 2))
+                   for j in range(opts.scripts)]
+        lines += ['[hooks hooks{0}]'.format(i),
+                  'pre-receive = {0}'.format(' '.join(scripts)),
+                  'post-receive = {0}'.format(' '.join(scripts)),
+                  '']
+    lines += ['[hooks global]', 'post-receive = noop0.sh', '']
+
+    config_file = os.path.join(root, 'hook.cfg')
+    with open(config_file, 'w') as f:
+        f.write('\n'.join(lines))
+
+    for hook_type in ('pre-receive', 'post-receive'):
+        os.makedirs(os.path.join(script_path, hook_type))
+        for i in range(opts.scripts * 2):
+            script = os.path.join(script_path, hook_type,
+                                  'noop{0}.sh'.format(i))
+            with open(script, 'w') as f:
+                f.write('#!/bin/sh\ncat >/dev/null\nexit 0\n')
+            os.chmod(script, 0755)
+    return config_file, repos
+
+
+def make_repo_farm(root, repos):
+    """Lay out a bare repository for each repo name
+
+    Only the files git and cpthook look for are created, which is
+    much quicker than running git init for every repository."""
+
+    repo_path = os.path.join(root, 'repos')
+    for repo in repos:
+        path = os.path.join(repo_path, repo + '.git')
+        for dir_ in ('hooks', 'objects', 'refs/heads'):
+            os.makedirs(os.path.join(path, dir_))
+        with open(os.path.join(path, 'HEAD'), 'w') as f:
+            f.write('ref: refs/heads/master\n')
+
+
+def timed(repeat, func):
+    """Returns the durations of repeat calls of func"""
+    durations = []
+    for _ in range(repeat):
+        start = time.time()
+        func()
+        durations.append(time.time() - start)
+    return durations
+
+
+def run_benchmarks(config_file, repos, opts):
+    results = {}
+
+    def record(name, durations):
+        # The first run is also reported on its own, as later runs may
+        # find the files it read in the page cache
+        results[name] = {'best': min(durations),
+                         'first': durations[0],
+                         'mean': sum(durations) / len(durations),
+                         'runs': durations}
+        sys.stderr.write('{0:30} {1:10.4f}s (first {2:.4f}s)\n'.format(
+            name, min(durations), durations[0]))
+
+    record('config', timed(opts.repeat,
+                           lambda: cpthook.CptHookConfig(config_file)))
+
+    record('lazy_config', timed(
+        opts.repeat, lambda: cpthook.CptHookConfig(
+            config_file, lazy=True).hooks_for_repo(repos[0])))
+
+    config = cpthook.CptHookConfig(config_file)
+    record('hooks_for_repo', timed(
+        opts.repeat, lambda: [config.hooks_for_repo(r) for r in repos]))
+
+    # Every run rewrites all wrappers. The scan for unmanaged wrappers
+    # then examines every repository but finds nothing to remove. Each
+    # run has a fresh CptHook, so none reuses state cached by the last.
+    record('install_hooks', timed(
+        opts.repeat, lambda: cpthook.CptHook(config_file).install_hooks()))
+    record('remove_unmanaged_hooks', timed(
+        opts.repeat,
+        lambda: cpthook.CptHook(config_file).remove_unmanaged_hooks()))
+
+    repo = os.path.join(os.path.dirname(config_file), 'repos',
+                        repos[0] + '.git')
+    stdin_file = os.path.join(os.path.dirname(config_file), 'stdin')
+    with open(stdin_file, 'w') as f:
+        f.write('{0} {1} refs/heads/master\n'.format('0' * 40, '1' * 40))
+
+    def run_hook():
+        orig_dir = os.getcwd()
+        os.chdir(repo)
+        try:
+            for _ in range(opts.hook_runs):
+                cpt = cpthook.CptHook(config_file, lazy=True)
+                with open(stdin_file) as stdin:
+                    cpt.run_hook('post-receive', [], stdin=stdin)
+        finally:
+            os.chdir(orig_dir)
+
+    record('run_hook', [x / opts.hook_runs
+                        for x in timed(opts.repeat, run_hook)])
+    return results
+
+
+def compare(results, compare_file):
+    with open(compare_file) as f:
+        previous = json.load(f)['results']
+    print '{0:30} {1:>10} {2:>10} {3:>8}'.format(
+        'benchmark', 'before', 'after', 'ratio')
+    for name in sorted(results):
+        if name not in previous:
+            continue
+        before = previous[name]['best']
+        after = results[name]['best']
+        print '{0:30} {1:10.4f} {2:10.4f} {3:8.2f}'.format(
+            name, before, after, after / before if before else 0)
+
+
+def main():
+    opts = parse_options()
+    # Silence cpthook logging below errors, such as missing repos
+    logging.getLogger().setLevel(logging.ERROR)
+
+    root = tempfile.mkdtemp(prefix='cpthook-benchmark-')
+    try:
+        config_file, repos = write_config(root, opts)
+        make_repo_farm(root, repos)
+        results = run_benchmarks(config_file, repos, opts)
+    finally:
+        if opts.keep:
+            sys.stderr.write('Kept benchmark files in {0}\n'.format(root))
+        else:
+            shutil.rmtree(root)
+
+    report = {
+        'params': dict((k, v) for k, v in vars(opts).items()
+                       if k not in ('output', 'compare', 'keep')),
+        'python': platform.python_version(),
+        'repos': len(repos),
+        'results': results,
+    }
+    if opts.output is not None:
+        with open(opts.output, 'w') as f:
+            json.dump(report, f, indent=1, sort_keys=True)
+    if opts.compare is not None:
+        compare(results, opts.compare)
+    elif opts.output is None:
+        print json.dumps(report, indent=1, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -8,12 +8,31 @@
 # https://github.com/aelse/cpthook/blob/master/LICENSE
 
 
+import contextlib
+import errno
+import fcntl
+import fnmatch
+import functools
+import hashlib
+import json
 import logging
+import logging.handlers
+import marshal
+import math
 import os
 import os.path
+import pipes
 import re
+import select
+import signal
+import socket
+import stat
+import struct
 import subprocess
 import sys
+import tempfile
+import threading
+import time
 
 
 # Supported hooks - see
@@ -38,6 +57,190 @@ supported_hooks = [
 ]
 
 
+# Options that may be given in a hooks section alongside hook types,
+# with their default values. The type of the default determines how
+# the option is parsed.
+hook_group_defaults = {
+    # Run the scripts of the group concurrently. A | in a list of
+    # scripts separates stages which are run one after another.
+    'parallel': False,
+    # Maximum number of concurrently running scripts, 0 for no limit.
+    'max-parallel': 0,
+    # Terminate the other running scripts of a stage on failure.
+    'cancel-on-failure': False,
+    # Reuse the recorded result of a script run with the same script,
+    # arguments and input (see the result-cache global option).
+    'cache': False,
+    # Seconds a cached result may be reused for, 0 for no limit.
+    'cache-ttl': 0,
+    # Queue post-* hook scripts to be run in the background (see the
+    # async-queue global option) rather than making git wait.
+    'async': False,
+    # Seconds a script may run before its process group is killed, 0
+    # for no limit.
+    'timeout': 0,
+    # Seconds all scripts of the hook may run for together, 0 for no
+    # limit. The shortest of the hook groups of a repository applies.
+    'hook-timeout': 0,
+    # Whether a script that timed out fails the hook or is ignored.
+    'timeout-policy': 'fail',
+}
+
+# Allowed values of hook group options taking a string
+hook_group_choices = {
+    'timeout-policy': ('fail', 'pass'),
+}
+
+# Exit code of a script that timed out under the fail policy, as used
+# by timeout(1)
+timeout_exit_code = 124
+
+# Hooks run after git has completed an operation, whose scripts cannot
+# affect its outcome and may be run in the background
+async_hooks = [h for h in supported_hooks if h.startswith('post-')]
+
+# Hook types given input on stdin by git
+input_hooks = ['pre-receive', 'post-receive', 'post-rewrite']
+
+# Defaults for running queued hook jobs: the number of jobs run at once,
+# the number of times a failing job is tried and the seconds before its
+# first retry, doubled for each retry after that
+async_jobs = 1
+async_retries = 3
+async_backoff = 5
+
+# Default maximum number of results kept in the result cache
+result_cache_size = 1000
+
+# Default seconds a script waits for a free process slot when it has no
+# timeout (see ProcessSlots)
+process_slot_wait = 60
+
+# Separates the stages of a list of scripts in a parallel hook group
+stage_separator = '|'
+
+# Version of the installed state manifest format (see update_hooks)
+manifest_version = 2
+
+# Wrapper installed as a repository hook to run cpthook. Wrappers
+# record the options they were installed with in a "# cpthook-install:"
+# comment, so update-cpthook.sh can install them again alike.
+wrapper_template = (
+    "#!/bin/sh\n"
+    "#\n"
+    "# MAGIC STRING: cpthook-wrapper (do not remove)\n"
+    "# cpthook-install: {install}\n"
+    "{cpthook} {options} --hook={hook} $*\n"
+)
+
+# Wrapper installed as a repository hook to run the scripts of a hook
+# directly (see CptHook._compiled_wrapper). The body is one of the
+# compiled_* snippets below followed by a line running each script.
+compiled_wrapper_template = (
+    "#!/bin/sh\n"
+    "#\n"
+    "# MAGIC STRING: cpthook-wrapper (do not remove)\n"
+    "# cpthook: {cpthook} {options} --hook={hook}\n"
+    "# cpthook-install: {install}\n"
+    "# Compiled from {config} for {repo}\n"
+    "{body}"
+)
+
+# Replaces the wrapper with a hook's only script
+compiled_exec = (
+    "script={script}\n"
+    "[ -f \"$script\" ] && [ -x \"$script\" ] || exit 0\n"
+    "exec \"$script\" \"$@\"\n"
+)
+
+# Runs a script, skipping those missing or not executable
+compiled_run = (
+    "run() {\n"
+    "    [ -f \"$1\" ] && [ -x \"$1\" ] || return 0\n"
+    "    \"$@\"\n"
+    "}\n"
+)
+
+# Runs a script with hook input replayed from a temporary file
+compiled_run_input = (
+    "input=$(mktemp) || exit 1\n"
+    "trap 'rm -f \"$input\"' EXIT\n"
+    "trap 'exit 1' HUP INT TERM\n"
+    "cat > \"$input\" || exit 1\n"
+    "run() {\n"
+    "    [ -f \"$1\" ] && [ -x \"$1\" ] || return 0\n"
+    "    \"$@\" < \"$input\"\n"
+    "}\n"
+)
+
+# Wrapper installed as a repository hook to run hooks through a cpthook
+# daemon (see CptHookDaemon), falling back to running cpthook directly
+# if the daemon cannot be reached.
+daemon_wrapper_template = (
+    "#!/usr/bin/env python\n"
+    "# MAGIC STRING: cpthook-wrapper (do not remove)\n"
+    "# cpthook: {cpthook} {options} --hook={hook}\n"
+    "# cpthook-install: {install}\n"
+    "import json\n"
+    "import os\n"
+    "import socket\n"
+    "import struct\n"
+    "import sys\n"
+    "import threading\n"
+    "\n"
+    "COMMAND = {command!r}\n"
+    "SOCKET = {socket!r}\n"
+    "\n"
+    "\n"
+    "def write_all(fd, data):\n"
+    "    while data:\n"
+    "        data = data[os.write(fd, data):]\n"
+    "\n"
+    "\n"
+    "def send_input(sock):\n"
+    "    fd = sys.stdin.fileno()\n"
+    "    try:\n"
+    "        while True:\n"
+    "            data = os.read(fd, 65536)\n"
+    "            if not data:\n"
+    "                break\n"
+    "            sock.sendall(data)\n"
+    "        sock.shutdown(socket.SHUT_WR)\n"
+    "    except (OSError, socket.error):\n"
+    "        pass\n"
+    "\n"
+    "\n"
+    "def main():\n"
+    "    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)\n"
+    "    try:\n"
+    "        sock.connect(SOCKET)\n"
+    "    except socket.error:\n"
+    "        os.execv(COMMAND[0], COMMAND + sys.argv[1:])\n"
+    "    request = dict(hook={hook!r}, args=sys.argv[1:], cwd=os.getcwd(),\n"
+    "                   env=dict(os.environ))\n"
+    "    sock.sendall(json.dumps(request).encode('utf-8') + b'\\n')\n"
+    "    sender = threading.Thread(target=send_input, args=(sock,))\n"
+    "    sender.daemon = True\n"
+    "    sender.start()\n"
+    "    reply = sock.makefile('rb')\n"
+    "    while True:\n"
+    "        header = reply.read(5)\n"
+    "        if len(header) < 5:\n"
+    "            break\n"
+    "        channel, size = struct.unpack('!cI', header)\n"
+    "        data = reply.read(size)\n"
+    "        if channel == b'x':\n"
+    "            return int(data)\n"
+    "        write_all(1 if channel == b'o' else 2, data)\n"
+    "    sys.stderr.write('cpthook daemon closed connection\\n')\n"
+    "    return -1\n"
+    "\n"
+    "\n"
+    "if __name__ == '__main__':\n"
+    "    sys.exit(main())\n"
+)
+
+
 class CyclicalDependencyException(Exception):
     """Unresolvable group dependency encountered"""
     pass
@@ -63,23 +266,394 @@ class NoSuchHookGroupException(Exception):
     pass
 
 
+class InvalidConfigValueException(Exception):
+    """Configuration option has an invalid value"""
+    pass
+
+
+# Errors of an invalid config. A lazily loaded config raises them when
+# the groups of a repository are first resolved, such as by run_hook.
+config_errors = (CyclicalDependencyException, UnknownDependencyException,
+                 UnknownConfigElementException, NoSuchRepoGroupException,
+                 NoSuchHookGroupException, InvalidConfigValueException)
+
+
+def _resolve_references(groups, names, resolved, inline=False):
+    """Expand @group references in the named groups
+
+    groups maps a group name to its list of entries, where an entry
+    beginning with @ refers to another group. Each group is expanded
+    exactly once, in dependency order, and memoized in resolved. An
+    expansion lists the group's own entries followed by inherited
+    entries in reference order, without duplicates. If inline is True
+    inherited entries take the place of the reference instead.
+
+    Raises UnknownDependencyException for a reference to an undefined
+    group and CyclicalDependencyException naming the cycle path."""
+
+    def refs(name):
+        return [x[1:] for x in groups[name] if x.startswith('@')]
+
+    def expand(name):
+        seen = set()
+        values = []
+        if inline:
+            entries = groups[name]
+        else:
+            entries = [x for x in groups[name] if not x.startswith('@')]
+            entries += ['@' + ref for ref in refs(name)]
+        for entry in entries:
+            if entry.startswith('@'):
+                inherited = resolved[entry[1:]]
+            else:
+                inherited = [entry]
+            for entry in inherited:
+                if entry not in seen:
+                    seen.add(entry)
+                    values.append(entry)
+        return values
+
+    for name in names:
+        if name in resolved:
+            continue
+        # Depth first walk of the reference graph, tracking the
+        # current path to report cycles exactly.
+        path = [name]
+        on_path = {name: 0}
+        stack = [(name, iter(refs(name)))]
+        while stack:
+            node, pending = stack[-1]
+            for ref in pending:
+                if ref in resolved:
+                    continue
+                if ref not in groups:
+                    raise UnknownDependencyException('@' + ref)
+                if ref in on_path:
+                    cycle = path[on_path[ref]:] + [ref]
+                    raise CyclicalDependencyException(' -> '.join(cycle))
+                on_path[ref] = len(path)
+                path.append(ref)
+                stack.append((ref, iter(refs(ref))))
+                break
+            else:
+                stack.pop()
+                path.pop()
+                del on_path[node]
+                resolved[node] = expand(node)
+    return resolved
+
+
+def is_repo_pattern(member):
+    """Returns True if a repo group member is a pattern
+
+    Patterns are either globs, eg. team-a/*, or regular expressions
+    prefixed with re:, eg. re:^svc-.*$"""
+
+    return member.startswith('re:') or \
+        any(c in member for c in '*?[')
+
+
+def _pattern_regex(pattern):
+    """Returns a regular expression for a pattern and the literal
+    prefix every name matched by it starts with"""
+
+    if pattern.startswith('re:'):
+        return pattern[3:], ''
+    regex = fnmatch.translate(pattern)
+    if regex.endswith('\\Z(?ms)'):
+        # Older Pythons append global flags, which may not appear
+        # within the combined expression
+        regex = regex[:-len('(?ms)')]
+    prefix = re.split('[*?[]', pattern, 1)[0]
+    return regex, prefix
+
+
+def _check_patterns(section, members):
+    """Raise InvalidConfigValueException for a pattern member that is
+    not a valid regular expression"""
+
+    for member in members:
+        if not is_repo_pattern(member):
+            continue
+        try:
+            re.compile(_pattern_regex(member)[0])
+        except re.error as e:
+            raise InvalidConfigValueException(
+                'Invalid pattern {0} in {1}: {2}'.format(member, section, e))
+
+
+class RepoMatcher(object):
+    """Matches repository names against pattern members of groups
+
+    All patterns are compiled into a single expression rejecting names
+    that match no pattern at all. Patterns are also indexed by their
+    literal prefix, so a name is only tested against the patterns
+    whose prefix it starts with. Results are cached by name."""
+
+    def __init__(self, patterns=None):
+        """patterns maps each pattern to the groups it is a member of"""
+        self._patterns = {}
+        self._compiled = False
+        self._cache = {}
+        for pattern, groups in (patterns or {}).items():
+            for group in groups:
+                self.add(pattern, group)
+
+    def add(self, pattern, group):
+        """Add a pattern member of a group"""
+        self._patterns.setdefault(pattern, set()).add(group)
+        self._compiled = False
+        self._cache = {}
+
+    def patterns(self):
+        """Returns a dict of each pattern to the sorted list of groups
+        it is a member of"""
+        return dict((p, sorted(g)) for p, g in self._patterns.items())
+
+    def prefixes(self):
+        """Returns the set of literal prefixes of all patterns"""
+        return set(_pattern_regex(p)[1] for p in self._patterns)
+
+    def _compile(self):
+        sources = []
+        buckets = {}
+        for pattern, groups in sorted(self._patterns.items()):
+            regex, prefix = _pattern_regex(pattern)
+            sources.append('(?:{0})'.format(regex))
+            buckets.setdefault(prefix, []).append(
+                (re.compile(regex), groups))
+        self._any = re.compile('|'.join(sources)) if sources else None
+        self._buckets = buckets
+        self._prefix_lengths = sorted(set(len(p) for p in buckets))
+        self._compiled = True
+
+    def match(self, name):
+        """Returns the set of groups with a pattern matching name"""
+
+        try:
+            return self._cache[name]
+        except KeyError:
+            pass
+        if not self._compiled:
+            self._compile()
+        groups = set()
+        if self._any is not None and self._any.match(name):
+            for length in self._prefix_lengths:
+                if length > len(name):
+                    break
+                for regex, pattern_groups in self._buckets.get(
+                        name[:length], ()):
+                    if regex.match(name):
+                        groups.update(pattern_groups)
+        groups = frozenset(groups)
+        self._cache[name] = groups
+        return groups
+
+
+# Version of the compiled config cache format. Bump this whenever the
+# cached state changes shape so that stale caches are rebuilt.
+cache_version = 9
+
+
 class CptHookConfig(object):
     """An object representing a cpthook configuration"""
 
-    def __init__(self, config_file):
+    def __init__(self, config_file, cache_file=None, lazy=False):
+        """Load a cpthook configuration
+
+        If cache_file is given the fully resolved configuration is
+        loaded from it when it is still current for config_file, and
+        the config file is not parsed at all. Otherwise the config is
+        parsed and resolved, and the cache is (re)written.
+
+        If lazy is True and no cache_file is given, only the groups
+        needed for a repository are resolved, when that repository is
+        first looked up. Errors in groups not involving the repository
+        are then not reported, and repo_groups holds the groups as
+        written in the config until repos() is called."""
+
         if not os.path.isfile(config_file):
             raise IOError('No such file {0}'.format(config_file))
 
-        g_conf, repo_groups, hook_groups = self._parse_config(config_file)
-
         self.config_file = config_file
+        self.cache_file = cache_file
+        self.lazy = lazy and cache_file is None
+
+        if cache_file is not None and self._load_cache():
+            return
+
+        g_conf, repo_groups, hook_groups, hook_group_options = \
+            self._parse_config(config_file)
+
         self.global_config = g_conf
         self.repo_groups = repo_groups
         self.hook_groups = hook_groups
+        self.hook_group_options = hook_group_options
+        self._set_missing_globals()
+        self.scripts = ScriptTable(self.global_config['script-path'])
+        self._merged_hooks = {}
+        self._plans = {}
+        self._expanded_hook_groups = set()
+        self._resolved_hook_types = {}
+
+        if self.lazy:
+            self._repo_membership = {}
+            self._repo_hook_groups = {}
+            self._repo_hooks = {}
+            self._inherited_by = None
+            self._resolved_inheritors = {}
+            self._resolved_hooks = {}
+            return
 
         self._normalise_repo_groups('members')
         self._normalise_repo_groups('hooks')
-        self._set_missing_globals()
+        self._normalise_hook_groups()
+        self._build_index()
+
+        if cache_file is not None:
+            self.write_cache()
+
+    def _config_stamp(self):
+        """Returns (mtime, size) of the config file"""
+        st = os.stat(self.config_file)
+        return st.st_mtime, st.st_size
+
+    def _config_digest(self):
+        """Returns the sha1 hex digest of the config file contents"""
+        with open(self.config_file, 'rb') as f:
+            return hashlib.sha1(f.read()).hexdigest()
+
+    def _load_cache(self):
+        """Load resolved configuration from the compiled cache
+
+        Returns True if the cache was current and has been loaded,
+        False if the config must be parsed."""
+
+        try:
+            with open(self.cache_file, 'rb') as f:
+                data = marshal.loads(f.read())
+        except (IOError, OSError, EOFError, ValueError, TypeError):
+            logging.debug('No usable cache {0}'.format(self.cache_file))
+            return False
+
+        if not isinstance(data, dict) or \
+                data.get('version') != cache_version:
+            logging.debug('Cache {0} has wrong version'.format(
+                self.cache_file))
+            return False
+
+        stamp = self._config_stamp()
+        stale_stamp = tuple(data['stamp']) != stamp
+        if stale_stamp:
+            # The file was touched. Only rebuild if content changed.
+            if data['digest'] != self._config_digest():
+                logging.debug('Cache {0} is stale'.format(self.cache_file))
+                return False
+
+        self.global_config = data['global_config']
+        self.repo_groups = data['repo_groups']
+        self.hook_groups = data['hook_groups']
+        self.hook_group_options = data['hook_group_options']
+        self._repos = data['repos']
+        self._matcher = RepoMatcher(data['repo_patterns'])
+        self._repo_membership = data['repo_membership']
+        self._repo_hook_groups = data['repo_hook_groups']
+        # Repositories with the same hook groups share their hooks
+        self._merged_hooks = dict((tuple(hook_groups), hooks)
+                                  for hook_groups, hooks
+                                  in data['merged_hooks'])
+        self._repo_hooks = dict(
+            (repo, self._merged_hooks[tuple(data['repo_hook_groups'][repo])])
+            for repo in data['repo_hooks'])
+        self._plans = {}
+        self.scripts = ScriptTable(self.global_config['script-path'],
+                                   data['scripts'])
+        logging.debug('Loaded config from cache {0}'.format(
+            self.cache_file))
+
+        if stale_stamp:
+            self.write_cache()
+        return True
+
+    def write_cache(self):
+        """Write resolved configuration to the compiled cache file
+
+        The cache is written to a temporary file and renamed into
+        place so readers never see a partially written cache. The
+        scripts of all hook types in use are indexed into it."""
+
+        self.scripts.scan(self._hook_types())
+        for scripts in self.scripts.state().values():
+            for entry in scripts.values():
+                try:
+                    self.scripts.digest(entry)
+                except IOError:
+                    pass
+        data = {
+            'version': cache_version,
+            'stamp': self._config_stamp(),
+            'digest': self._config_digest(),
+            'global_config': self.global_config,
+            'repo_groups': self.repo_groups,
+            'hook_groups': self.hook_groups,
+            'hook_group_options': self.hook_group_options,
+            'repos': self._repos,
+            'repo_patterns': self._matcher.patterns(),
+            'repo_membership': self._repo_membership,
+            'repo_hook_groups': self._repo_hook_groups,
+            'merged_hooks': [[list(hook_groups), hooks] for hook_groups, hooks
+                             in self._merged_hooks.items()],
+            'repo_hooks': sorted(self._repo_hooks),
+            'scripts': self.scripts.state(),
+        }
+        cache_dir = os.path.dirname(os.path.abspath(self.cache_file))
+        try:
+            fd, tmp = tempfile.mkstemp(dir=cache_dir, prefix='.cpthook-')
+        except (IOError, OSError):
+            logging.warn('Could not write cache {0}'.format(self.cache_file))
+            return
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                # Readable by the users running hooks, not only the
+                # one installing them (mkstemp creates files 0600)
+                os.fchmod(f.fileno(), 0644)
+                f.write(marshal.dumps(data))
+            os.rename(tmp, self.cache_file)
+            logging.debug('Wrote cache {0}'.format(self.cache_file))
+        except (IOError, OSError):
+            logging.warn('Could not write cache {0}'.format(self.cache_file))
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+
+    def _hook_types(self):
+        """Returns the sorted hook types used by any hook group"""
+        hook_types = set()
+        for hooks in self.hook_groups.values():
+            hook_types.update(hooks)
+        return sorted(hook_types)
+
+    def script_problems(self):
+        """Returns messages describing the scripts of hook groups that
+        do not exist or are not executable"""
+
+        self.scripts.scan(self._hook_types())
+        problems = []
+        for hook_group in sorted(self.hook_groups):
+            hooks = self.hook_groups[hook_group]
+            for hook_type in sorted(hooks):
+                for script in hooks[hook_type]:
+                    entry = self.scripts.lookup(hook_type, script)
+                    if entry is None:
+                        problem = 'does not exist'
+                    elif not entry['executable']:
+                        problem = 'is not executable'
+                    else:
+                        continue
+                    problems.append('hooks {0}: {1} hook {2} {3}'.format(
+                        hook_group, hook_type, script, problem))
+        return problems
 
     def _set_missing_globals(self):
         """Set global configuration for all repositories
@@ -101,56 +675,72 @@ class CptHookConfig(object):
         """Resolve inherited memberships"""
 
         data = self.repo_groups
-        tainted = data.keys()
-        round_ = 0
-        while tainted:
-            round_ += 1
-            logging.debug('Normalise {0}: round {1}'.format(option, round_))
-
-            did_work = False
-
-            for item in tainted:
-                try:
-                    members = data[item][option]
-                except KeyError:
-                    logging.debug('Removed empty item {0}'.format(item))
-                    tainted.remove(item)
-                    did_work = True
-                    continue
+        groups = dict((name, group[option])
+                      for name, group in data.items() if option in group)
+        logging.debug('Normalise {0}: {1} groups'.format(
+            option, len(groups)))
+        resolved = {}
+        _resolve_references(groups, sorted(groups), resolved)
+        for name, values in resolved.items():
+            data[name][option] = values
+        self.repo_groups = data
 
-                unresolved = [x for x in members if x.startswith('@')]
-                if len(unresolved) == 0:
-                    logging.debug('Nothing to resolve in {0}'.format(item))
-                    tainted.remove(item)
-                    did_work = True
-                    continue
+    def _normalise_hook_groups(self, names=None):
+        """Resolve inherited scripts of hook groups
+
+        An @ reference in the scripts of a hook type is replaced by the
+        scripts of that hook type in the referenced hook group. Only
+        the named groups, by default all, are updated. Expansions are
+        memoized, so each group is expanded once."""
+
+        if names is None:
+            names = sorted(self.hook_groups)
+        hook_types = set()
+        for name in names:
+            hook_types.update(self.hook_groups[name])
+        for hook_type in sorted(hook_types):
+            groups = dict((name, hooks.get(hook_type, []))
+                          for name, hooks in self.hook_groups.items())
+            resolved = self._resolved_hook_types.setdefault(hook_type, {})
+            _resolve_references(groups, names, resolved, inline=True)
+        for name in names:
+            if name in self._expanded_hook_groups:
+                continue
+            hooks = self.hook_groups[name]
+            stages = self.hook_group_options[name]['stages']
+            for hook_type in hooks:
+                resolved = self._resolved_hook_types[hook_type]
+                hooks[hook_type] = resolved[name]
+                # Inherited scripts join the stage of their reference.
+                # A script is only run once, at its first appearance.
+                expanded = []
+                seen = set()
+                for stage in stages[hook_type]:
+                    scripts = []
+                    for script in stage:
+                        if script.startswith('@'):
+                            inherited = resolved[script[1:]]
+                        else:
+                            inherited = [script]
+                        for x in inherited:
+                            if x not in seen:
+                                seen.add(x)
+                                scripts.append(x)
+                    if scripts:
+                        expanded.append(scripts)
+                stages[hook_type] = expanded
+            self._expanded_hook_groups.add(name)
+
+    def _hook_group(self, name):
+        """Returns the scripts of a hook group by hook type"""
 
-                resolved = []
-                dirty = False
-                for member in unresolved:
-                    mem = member.lstrip('@')
-                    try:
-                        new_members = data[mem][option]
-                    except KeyError:
-                        raise UnknownDependencyException(member)
-                    for new_mem in new_members:
-                        if new_mem.startswith('@'):
-                            # Unresolved membership in upstream group
-                            dirty = True
-                            break
-                    resolved += new_members
-
-                if not dirty:
-                    # No dependencies remain - replace resolved groups
-                    for member in unresolved:
-                        members.remove(member)
-                    members += resolved
-                    data[item][option] = members
-                    did_work = True
-
-            if did_work is False:
-                raise CyclicalDependencyException(','.join(tainted))
-        self.repo_groups = data
+        try:
+            hooks = self.hook_groups[name]
+        except KeyError:
+            raise NoSuchHookGroupException(name)
+        if self.lazy and name not in self._expanded_hook_groups:
+            self._normalise_hook_groups([name])
+        return hooks
 
     def _parse_config(self, filename):
         """Parse config file and return global, repo and hook config"""
@@ -162,6 +752,7 @@ class CptHookConfig(object):
         # Record the groups as defined in the config
         conf_repos = {}
         conf_hooks = {}
+        conf_hook_options = {}
         conf = {}
 
         for section in parser.sections():
@@ -175,8 +766,10 @@ class CptHookConfig(object):
                         values = parser.get(section, option).split()
                         # Record repo names without a .git suffix
                         if option == 'members':
-                            values = [re.sub('\.git$', '', x)
+                            values = [x if x.startswith('re:') else
+                                      re.sub('\.git$', '', x)
                                       for x in values]
+                            _check_patterns(section, values)
                         logging.debug('{0} -> {1} -> {2}'.format(
                             section, option, values))
                         conf_repos[repo_group][option] = values
@@ -188,13 +781,33 @@ class CptHookConfig(object):
                 hook_group = re.sub('^hooks\s+', '', section)
                 logging.debug('Found hook {0}'.format(hook_group))
                 conf_hooks[hook_group] = {}
+                options = {}
+                for option, default in hook_group_defaults.items():
+                    if not parser.has_option(section, option):
+                        options[option] = default
+                    elif isinstance(default, bool):
+                        options[option] = parser.getboolean(section, option)
+                    elif isinstance(default, str):
+                        value = parser.get(section, option).strip()
+                        if value not in hook_group_choices[option]:
+                            raise InvalidConfigValueException(
+                                '{0} in {1} must be one of {2}'.format(
+                                    option, section,
+                                    ', '.join(hook_group_choices[option])))
+                        options[option] = value
+                    else:
+                        options[option] = parser.getint(section, option)
+                options['stages'] = {}
                 for type_ in supported_hooks:
                     try:
                         vals = parser.get(section, type_).split()
-                        conf_hooks[hook_group][type_] = vals
                     except ConfigParser.NoOptionError:
                         # No hooks of that type
-                        pass
+                        continue
+                    options['stages'][type_] = self._split_stages(vals)
+                    conf_hooks[hook_group][type_] = [
+                        x for x in vals if x != stage_separator]
+                conf_hook_options[hook_group] = options
             elif section == 'cpthook':
                 try:
                     sp = parser.get(section, 'script-path').split()
@@ -208,75 +821,217 @@ class CptHookConfig(object):
                 except ConfigParser.NoOptionError:
                     # No defined repository search path
                     pass
+                try:
+                    rc = parser.get(section, 'result-cache').split()
+                    conf['result-cache'] = rc[0]
+                except ConfigParser.NoOptionError:
+                    # Script results are not cached
+                    pass
+                try:
+                    conf['result-cache-size'] = parser.getint(
+                        section, 'result-cache-size')
+                except ConfigParser.NoOptionError:
+                    pass
+                try:
+                    aq = parser.get(section, 'async-queue').split()
+                    conf['async-queue'] = aq[0]
+                except ConfigParser.NoOptionError:
+                    # Async hook groups are run synchronously
+                    pass
+                try:
+                    ps = parser.get(section, 'process-slot-path').split()
+                    conf['process-slot-path'] = ps[0]
+                except ConfigParser.NoOptionError:
+                    pass
+                for option in ('async-jobs', 'async-retries',
+                               'async-backoff', 'max-processes',
+                               'process-slot-wait'):
+                    try:
+                        conf[option] = parser.getint(section, option)
+                    except ConfigParser.NoOptionError:
+                        pass
             else:
                 raise UnknownConfigElementException(
                     'Unknown config element {0}'.format(section))
 
-        return conf, conf_repos, conf_hooks
+        return conf, conf_repos, conf_hooks, conf_hook_options
+
+    def _split_stages(self, scripts):
+        """Split a list of scripts into stages at each stage separator"""
+
+        stages = [[]]
+        for script in scripts:
+            if script == stage_separator:
+                stages.append([])
+            else:
+                stages[-1].append(script)
+        return [stage for stage in stages if stage]
 
     def _aggregate_hooks(self, hook_groups):
+        """Returns the merged scripts of a list of hook groups by hook
+        type
+
+        Scripts keep the order of the groups without duplicates. The
+        result is computed once for each list of hook groups and shared
+        by every repository using the same list."""
+
         if not hasattr(hook_groups, '__iter__'):
             # Check for __iter__ attribute rather than iter(),
             # which also captures strings.
             raise ValueError('hook_groups must be iterable')
 
+        key = tuple(hook_groups)
+        try:
+            return self._merged_hooks[key]
+        except KeyError:
+            pass
         hooks = {}
+        seen = {}
         logging.debug('Aggregating hooks for hook groups {0}'.format(
             hook_groups))
         for hook_group in hook_groups:
             logging.debug('Evaluating hook group {0}'.format(hook_group))
-            try:
-                hg = self.hook_groups[hook_group]
-                logging.debug('hg {0} -> {1}'.format(hook_group, hg))
-            except KeyError:
-                raise NoSuchHookGroupException(hook_group)
+            hg = self._hook_group(hook_group)
+            logging.debug('hg {0} -> {1}'.format(hook_group, hg))
             for hook_type, hook_list in hg.items():
-                if hook_type not in hooks:
-                    hooks[hook_type] = hook_list
-                else:
-                    for hook in hook_list:
-                        if hook not in hooks[hook_type]:
-                            hooks[hook_type].append(hook)
+                scripts = hooks.setdefault(hook_type, [])
+                seen_scripts = seen.setdefault(hook_type, set())
+                for hook in hook_list:
+                    if hook not in seen_scripts:
+                        seen_scripts.add(hook)
+                        scripts.append(hook)
+        self._merged_hooks[key] = hooks
         return hooks
 
-    def repo_group_membership(self, repo):
-        """Returns list of repo group membership for repo"""
+    def _build_index(self):
+        """Index group membership and hooks by repository
+
+        Built once after normalisation so that per repository lookups
+        do not need to scan every repo group."""
 
-        membership = []
+        membership = {}
+        matcher = RepoMatcher()
         for repo_group, data in self.repo_groups.items():
-            try:
-                group_members = data['members']
-            except KeyError:
-                continue
-            if repo in group_members:
-                if repo not in membership:
-                    membership.append(repo_group)
+            for member in data.get('members', []):
+                if is_repo_pattern(member):
+                    matcher.add(member, repo_group)
+                else:
+                    membership.setdefault(member, set()).add(repo_group)
+
+        self._repos = sorted(membership)
+        self._matcher = matcher
+        self._repo_membership = {}
+        self._repo_hook_groups = {}
+        self._repo_hooks = {}
+        for repo, repo_groups in membership.items():
+            repo_groups.update(matcher.match(repo))
+            self._index_repo(repo, self._order_groups(repo_groups),
+                             lambda g: self.repo_groups[g].get('hooks', []))
+
+    def _order_groups(self, repo_groups):
+        """Returns a list of a repository's groups in a stable order
+
+        The global repo group is added last if the repository is in any
+        other group and the global membership group exists."""
+
+        ordered = sorted(g for g in repo_groups if g != '*')
+        if repo_groups and '*' in self.repo_groups:
+            ordered.append('*')
+        return ordered
+
+    def _index_repo(self, repo, repo_groups, group_hooks):
+        """Add a repository and its groups to the index
+
+        group_hooks returns the resolved hook groups of a repo group."""
+
+        hook_groups = []
+        for repo_group in repo_groups:
+            for hook_group in group_hooks(repo_group):
+                if hook_group not in hook_groups:
+                    hook_groups.append(hook_group)
+        self._repo_membership[repo] = repo_groups
+        self._repo_hook_groups[repo] = hook_groups
+        self._repo_hooks[repo] = self._aggregate_hooks(hook_groups)
+
+    def _index_repo_on_demand(self, repo):
+        """Add a repository not listed by name to the index
+
+        Repositories matching pattern members are indexed when first
+        looked up. In lazy mode every repository is."""
 
-        # Add global repo group if repo is in any other group
-        # and the global membership group exists
-        if membership and '*' in self.repo_groups:
-            membership.append('*')
+        if repo in self._repo_membership:
+            return
+        if self.lazy:
+            self._index_repo_lazily(repo)
+            return
+        repo_groups = self._matcher.match(repo)
+        if repo_groups:
+            self._index_repo(repo, self._order_groups(repo_groups),
+                             lambda g: self.repo_groups[g].get('hooks', []))
+
+    def _index_repo_lazily(self, repo):
+        """Resolve only the groups involving a repository
+
+        The groups containing the repository are found by walking
+        @ references backwards from the groups listing it or with a
+        pattern matching it, and only the hooks of those groups are
+        resolved. Resolutions are memoized for later lookups."""
+
+        if self._inherited_by is None:
+            # Reverse @ references: each group is listed together with
+            # the groups inheriting its members
+            inherited_by = dict((g, [g]) for g in self.repo_groups)
+            direct = {}
+            matcher = RepoMatcher()
+            unknown = {}
+            for name in sorted(self.repo_groups):
+                for member in self.repo_groups[name].get('members', []):
+                    if is_repo_pattern(member):
+                        matcher.add(member, name)
+                    elif not member.startswith('@'):
+                        direct.setdefault(member, []).append(name)
+                    elif member[1:] in inherited_by:
+                        inherited_by[member[1:]].append('@' + name)
+                    else:
+                        unknown.setdefault(name, member)
+            self._inherited_by = inherited_by
+            self._direct_groups = direct
+            self._matcher = matcher
+            self._unknown_members = unknown
+            self._group_hooks = dict((g, data['hooks'])
+                                     for g, data in self.repo_groups.items())
+
+        direct = set(self._direct_groups.get(repo, []))
+        direct.update(self._matcher.match(repo))
+        direct = sorted(direct)
+        _resolve_references(self._inherited_by, direct,
+                            self._resolved_inheritors)
+        groups = set()
+        for group in direct:
+            groups.update(self._resolved_inheritors[group])
+        for group in sorted(groups):
+            if group in self._unknown_members:
+                raise UnknownDependencyException(self._unknown_members[group])
+
+        repo_groups = self._order_groups(groups)
+        _resolve_references(self._group_hooks, repo_groups,
+                            self._resolved_hooks)
+        self._index_repo(repo, repo_groups,
+                         lambda g: self._resolved_hooks[g])
 
+    def repo_group_membership(self, repo):
+        """Returns list of repo group membership for repo"""
+
+        self._index_repo_on_demand(repo)
+        membership = list(self._repo_membership.get(repo, []))
         logging.debug('{0} is a member of {1}'.format(repo, membership))
         return membership
 
     def repo_group_hook_groups(self, repo):
-        """Returns list of repo group membership for repo"""
+        """Returns list of hook groups applied to repo"""
 
-        # 1. Get repo group membership for repo
-        repo_groups = self.repo_group_membership(repo)
-
-        # 2. Combine lists of hook groups from repo groups
-        membership = []
-        for repo_group in repo_groups:
-            try:
-                hook_groups = self.repo_groups[repo_group]['hooks']
-            except KeyError:
-                logging.debug('No hook groups in {0}'.format(repo_group))
-                continue
-            for hook_group in hook_groups:
-                if hook_group not in membership:
-                    membership.append(hook_group)
+        self._index_repo_on_demand(repo)
+        membership = list(self._repo_hook_groups.get(repo, []))
         if not len(membership):
             logging.debug('No hook groups for {0}'.format(repo))
         return membership
@@ -284,29 +1039,1083 @@ class CptHookConfig(object):
     def hooks_for_repo(self, repo):
         """Returns dict of hooks to be applied to a repository"""
 
-        # 1. Get hook group membership for repo
-        hook_groups = self.repo_group_hook_groups(repo)
-
-        # 2. Build dict of hooks from those hook groups
-        hooks = self._aggregate_hooks(hook_groups)
-
-        return hooks
+        self._index_repo_on_demand(repo)
+        try:
+            return self._repo_hooks[repo]
+        except KeyError:
+            # Repositories not in any group have no hooks
+            return {}
+
+    def hook_plan(self, repo, hook_type):
+        """Returns the execution stages of a hook type for a repository
+
+        Each stage is a dict listing the scripts to be run together and
+        the options of the hook group they came from (max-parallel,
+        cancel-on-failure, cache, cache-ttl, async, which is only set
+        for post-* hooks, timeout, hook-timeout and timeout-policy).
+        Stages are run in order and the scripts of a stage may run
+        concurrently. Scripts appear in the same order as in
+        hooks_for_repo. Plans are computed once for each list of hook
+        groups and their stages must not be modified."""
+
+        hook_groups = tuple(self.repo_group_hook_groups(repo))
+        try:
+            return list(self._plans[hook_groups, hook_type])
+        except KeyError:
+            pass
+        plan = []
+        seen = set()
+        for hook_group in hook_groups:
+            scripts = self._hook_group(hook_group)
+            if hook_type not in scripts:
+                continue
+            options = self.hook_group_options[hook_group]
+            if options['parallel']:
+                stages = options['stages'][hook_type]
+                max_parallel = options['max-parallel']
+            else:
+                stages = [[x] for x in scripts[hook_type]]
+                max_parallel = 1
+            for stage in stages:
+                stage = [x for x in stage if x not in seen]
+                if not stage:
+                    continue
+                seen.update(stage)
+                plan.append({
+                    'scripts': stage,
+                    'max-parallel': max_parallel,
+                    'cancel-on-failure': options['cancel-on-failure'],
+                    'cache': options['cache'],
+                    'cache-ttl': options['cache-ttl'],
+                    'async': options['async'] and hook_type in async_hooks,
+                    'timeout': options['timeout'],
+                    'hook-timeout': options['hook-timeout'],
+                    'timeout-policy': options['timeout-policy'],
+                })
+        self._plans[hook_groups, hook_type] = plan
+        return list(plan)
 
     def repos(self):
         """Returns list of known repos"""
 
-        rg = self.repo_groups
-        members_ = map(lambda x: x['members'], rg.values())
+        if self.lazy:
+            # Every repository is needed, so resolve everything
+            self._normalise_repo_groups('members')
+            self._normalise_repo_groups('hooks')
+            self._normalise_hook_groups()
+            self._build_index()
+            self.lazy = False
+        return list(self._repos)
+
+    def pattern_prefixes(self):
+        """Returns the literal prefixes of all pattern members
+
+        Every repository matching a pattern member has a name starting
+        with one of these prefixes."""
+
+        self.repos()
+        return self._matcher.prefixes()
+
+
+def process_start_time():
+    """Returns the time the current process started, or None if it
+    cannot be determined (only Linux is supported)"""
+
+    try:
+        with open('/proc/self/stat') as f:
+            # The command name may contain spaces, so skip past it
+            fields = f.read().rsplit(')', 1)[1].split()
+        # The start time is in clock ticks since boot. Compare it with
+        # the uptime, which unlike the boot time is finer than seconds.
+        with open('/proc/uptime') as f:
+            uptime = float(f.read().split()[0])
+        now = time.time()
+        ticks = os.sysconf(os.sysconf_names['SC_CLK_TCK'])
+        return now - (uptime - float(fields[19]) / ticks)
+    except (IOError, OSError, IndexError, KeyError, ValueError):
+        return None
+
+
+class HookTracer(object):
+    """Records timed spans of hook execution
+
+    Each span is written as a line of JSON holding the phase, start
+    time, duration and process id together with fields such as the
+    repo, hook and script. If trace_file is None nothing is recorded.
+    The trace file is rotated once it reaches max_bytes, keeping
+    backup_count old files, if max_bytes is not 0."""
+
+    def __init__(self, trace_file=None, max_bytes=0, backup_count=1):
+        self.trace_file = trace_file
+        self._handler = None
+        if trace_file is not None:
+            self._handler = logging.handlers.RotatingFileHandler(
+                trace_file, maxBytes=max_bytes, backupCount=backup_count)
+
+    def record(self, phase, start, duration, **fields):
+        """Record a span of a phase"""
+
+        if self._handler is None:
+            return
+        fields.update(phase=phase, time=start, duration=duration,
+                      pid=os.getpid())
+        line = json.dumps(fields, sort_keys=True)
+        self._handler.handle(logging.makeLogRecord({'msg': line}))
+
+    def close(self):
+        """Close the trace file"""
+        if self._handler is not None:
+            self._handler.close()
+            self._handler = None
+
+    @contextlib.contextmanager
+    def span(self, phase, **fields):
+        """Record a span covering the body of a with statement
+
+        The dict of fields is yielded so that results, such as an
+        exit code, can be added within the body."""
+
+        start = time.time()
+        try:
+            yield fields
+        finally:
+            self.record(phase, start, time.time() - start, **fields)
+
+
+def _percentile(values, percent):
+    """Returns the nearest rank percentile of sorted values"""
+    rank = max(1, int(math.ceil(percent / 100.0 * len(values))))
+    return values[min(rank, len(values)) - 1]
+
+
+def trace_stats(trace_file):
+    """Summarise hook execution times recorded by HookTracer
+
+    Reads trace_file and its rotated backups. Returns a dict with
+    'script' and 'repo' entries, mapping each script (as hook/script)
+    and each repo to the count and the 50th, 95th and 99th percentile
+    of its durations in seconds."""
+
+    files = [trace_file]
+    index = 1
+    while os.path.exists('{0}.{1}'.format(trace_file, index)):
+        files.append('{0}.{1}'.format(trace_file, index))
+        index += 1
+
+    durations = {'script': {}, 'repo': {}}
+    for file_ in files:
+        with open(file_) as f:
+            for line in f:
+                try:
+                    span = json.loads(line)
+                except ValueError:
+                    continue
+                if span.get('phase') == 'script':
+                    key = '{0}/{1}'.format(span['hook'], span['script'])
+                    durations['script'].setdefault(key, []).append(
+                        span['duration'])
+                elif span.get('phase') == 'hook' and 'repo' in span:
+                    durations['repo'].setdefault(span['repo'], []).append(
+                        span['duration'])
+
+    stats = {}
+    for kind, by_key in durations.items():
+        stats[kind] = {}
+        for key, values in by_key.items():
+            values.sort()
+            stats[kind][key] = {
+                'count': len(values),
+                'p50': _percentile(values, 50),
+                'p95': _percentile(values, 95),
+                'p99': _percentile(values, 99),
+            }
+    return stats
+
+
+class StdinSpool(object):
+    """Hook input spooled for replay to each hook script
+
+    Input is read from source in chunks only as scripts consume it,
+    and kept in memory up to max_size bytes before spilling to a
+    temporary file, so memory use is bounded however large the input.
+    Each script is fed by its own writer thread following the spool
+    from the start. Scripts start consuming input immediately and
+    concurrently running scripts stream it together."""
+
+    chunk_size = 65536
+    max_size = 1024 * 1024
+
+    def __init__(self, source):
+        self._source = source
+        try:
+            self._fd = source.fileno()
+        except (AttributeError, IOError, ValueError):
+            self._fd = None
+        self._spool = tempfile.SpooledTemporaryFile(max_size=self.max_size)
+        self._size = 0
+        self._eof = False
+        self._reading = False
+        self._cond = threading.Condition()
+        self._digest = None
+
+    def _read_source(self):
+        """Read the next chunk of input, '' at end of input"""
+        if self._fd is not None:
+            # Return whatever is available rather than waiting for a
+            # full chunk, as a buffered file read would.
+            return os.read(self._fd, self.chunk_size)
+        return self._source.read(self.chunk_size)
+
+    def read_at(self, offset, size):
+        """Returns up to size bytes of input at offset
+
+        Blocks until input is available. Returns '' at end of input."""
+
+        with self._cond:
+            while offset >= self._size and not self._eof:
+                if self._reading:
+                    # Another consumer is reading the source
+                    self._cond.wait()
+                    continue
+                self._reading = True
+                self._cond.release()
+                try:
+                    data = self._read_source()
+                finally:
+                    self._cond.acquire()
+                    self._reading = False
+                    self._cond.notify_all()
+                if data:
+                    self._spool.seek(0, os.SEEK_END)
+                    self._spool.write(data)
+                    self._size += len(data)
+                else:
+                    self._eof = True
+            if offset >= self._size:
+                return ''
+            self._spool.seek(offset)
+            return self._spool.read(min(size, self._size - offset))
+
+    def digest(self):
+        """Returns the sha1 hex digest of the whole input
+
+        All remaining input is read from the source."""
+
+        if self._digest is None:
+            sha = hashlib.sha1()
+            offset = 0
+            while True:
+                data = self.read_at(offset, self.chunk_size)
+                if not data:
+                    break
+                sha.update(data)
+                offset += len(data)
+            self._digest = sha.hexdigest()
+        return self._digest
+
+    def feed(self, pipe, stats=None):
+        """Write the whole input to pipe from a new thread
+
+        The pipe is closed once all input has been written or the
+        reader has gone away. If a stats dict is given the number of
+        bytes written and the time taken are stored in it as
+        'stdin_bytes' and 'stdin_duration' when done. Returns the
+        writer thread."""
+
+        def write():
+            start = time.time()
+            offset = 0
+            try:
+                while True:
+                    data = self.read_at(offset, self.chunk_size)
+                    if not data:
+                        break
+                    pipe.write(data)
+                    offset += len(data)
+            except IOError as e:
+                # The script exited without reading all of its input
+                if e.errno != errno.EPIPE:
+                    logging.warn('Could not write hook input: {0}'.format(
+                        e))
+            finally:
+                try:
+                    pipe.close()
+                except IOError:
+                    pass
+                if stats is not None:
+                    stats['stdin_bytes'] = offset
+                    stats['stdin_duration'] = time.time() - start
+
+        writer = threading.Thread(target=write)
+        writer.daemon = True
+        writer.start()
+        return writer
+
+
+class ResultCache(object):
+    """Recorded hook script results, one marshal file per result
+
+    Each result holds the exit code and output of a script run and
+    is stored under a key identifying the script and its input. Using
+    a result marks it as recently used. At most max_entries results
+    are kept, evicting the least recently used first."""
+
+    def __init__(self, directory, max_entries=result_cache_size):
+        self.directory = directory
+        self.max_entries = max_entries
+
+    @staticmethod
+    def key(*parts):
+        """Returns a cache key for a sequence of strings"""
+        return hashlib.sha1('\0'.join(parts)).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key)
+
+    def get(self, key, ttl=0):
+        """Returns the result stored under key, or None
+
+        Results older than ttl seconds are not returned, unless ttl
+        is 0."""
+
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                result = marshal.load(f)
+        except (IOError, EOFError, ValueError, TypeError):
+            return None
+        if ttl and result['time'] + ttl < time.time():
+            self._remove(path)
+            return None
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        return result
+
+    def put(self, key, exit_code, stdout, stderr):
+        """Store the result of a script run under key"""
+
+        result = {'exit': exit_code, 'stdout': stdout, 'stderr': stderr,
+                  'time': time.time()}
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            fd, tmp = tempfile.mkstemp(dir=self.directory, prefix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                marshal.dump(result, f)
+            os.rename(tmp, self._path(key))
+        except (IOError, OSError) as e:
+            logging.warn('Could not cache script result: {0}'.format(e))
+            return
+        self._evict()
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def _evict(self):
+        """Remove the least recently used results over max_entries"""
+
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.startswith('.tmp'):
+                continue
+            path = self._path(name)
+            try:
+                entries.append((os.stat(path).st_mtime, path))
+            except OSError:
+                pass
+        if len(entries) <= self.max_entries:
+            return
+        entries.sort()
+        for _, path in entries[:len(entries) - self.max_entries]:
+            self._remove(path)
+
+
+class ProcessSlots(object):
+    """A host wide limit on the number of running hook scripts
+
+    Each of count slot files in directory is locked with flock by a
+    running script, so a slot is released even if its holder dies.
+    Scripts wait at most wait seconds for a slot, or for ever if 0, so
+    hooks run from within hooks cannot deadlock the host.
+
+    The directory and slot files are shared by every user running
+    hooks, so they are created writable and readable by all whatever
+    the umask, and slot files are only ever opened for reading."""
+
+    # Seconds between attempts to take a slot when all are in use
+    poll_interval = 0.05
+
+    def __init__(self, directory, count, wait=process_slot_wait):
+        self.directory = directory
+        self.count = count
+        self.wait = wait
+
+    def acquire(self, deadline=None):
+        """Take a free slot, waiting until one is free
+
+        Returns the slot, to be passed to release, or None if no slot
+        became free before the deadline (a time.time() value) or the
+        slot files could not be opened."""
+
+        try:
+            return self._acquire(deadline)
+        except OSError as e:
+            logging.warn('Could not take a process slot in {0}: {1}'.format(
+                self.directory, e))
+            return None
+
+    def _open(self, index):
+        """Open a slot file for reading, creating it if missing"""
+
+        path = os.path.join(self.directory, 'slot-{0}'.format(index))
+        try:
+            fd = os.open(path, os.O_RDONLY | os.O_CREAT | os.O_EXCL, 0644)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+            return os.open(path, os.O_RDONLY)
+        os.fchmod(fd, 0644)
+        return fd
+
+    def _acquire(self, deadline):
+        if not os.path.isdir(self.directory):
+            try:
+                os.makedirs(self.directory)
+                # Sticky, so users cannot remove each other's slots
+                os.chmod(self.directory, 01777)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+        while True:
+            for index in range(self.count):
+                fd = self._open(index)
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    return fd
+                except IOError as e:
+                    os.close(fd)
+                    if e.errno not in (errno.EAGAIN, errno.EACCES):
+                        raise
+            if deadline is not None and time.time() >= deadline:
+                return None
+            time.sleep(self.poll_interval)
+
+    def release(self, slot):
+        os.close(slot)
+
+
+class HookQueue(object):
+    """An on-disk queue of hook jobs to be run in the background
+
+    Jobs are written to tmp and renamed into new, so they are never
+    seen partially written. The hook input of a job is kept in input,
+    written before the job is queued. A worker holding the queue lock
+    moves a job to work while running it. A failed job is returned to
+    new to be tried again, or moved to failed once out of retries.
+
+    A job name starts with the time it may be run from, so names sort
+    in the order jobs are due."""
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def _path(self, *names):
+        return os.path.join(self.directory, *names)
+
+    @staticmethod
+    def _name(due):
+        return '{0:017.6f}-{1}-{2}'.format(due, os.getpid(),
+                                           hashlib.sha1(os.urandom(8))
+                                           .hexdigest()[:8])
+
+    @staticmethod
+    def due(name):
+        """Returns the time the job name may be run from"""
+        return float(name.split('-', 1)[0])
+
+    def put(self, job, stdin=None):
+        """Add a job, a marshallable dict, to the queue
+
+        The hook input is copied from stdin, a StdinSpool, a chunk at a
+        time to the input directory, to be opened with input."""
+
+        for name in ('tmp', 'new', 'work', 'failed', 'input'):
+            if not os.path.isdir(self._path(name)):
+                os.makedirs(self._path(name))
+        name = self._name(time.time())
+        if stdin is not None:
+            with open(self._path('tmp', name + '.input'), 'wb') as f:
+                offset = 0
+                while True:
+                    chunk = stdin.read_at(offset, stdin.chunk_size)
+                    if not chunk:
+                        break
+                    f.write(chunk)
+                    offset += len(chunk)
+            os.rename(self._path('tmp', name + '.input'),
+                      self._path('input', name))
+            job = dict(job, input=name)
+        with open(self._path('tmp', name), 'wb') as f:
+            marshal.dump(job, f)
+        os.rename(self._path('tmp', name), self._path('new', name))
+        return name
+
+    def input(self, job):
+        """Returns the hook input of a job, opened for reading"""
+        if 'input' not in job:
+            return open(os.devnull, 'rb')
+        return open(self._path('input', job['input']), 'rb')
+
+    def lock(self):
+        """Take the queue lock without waiting
+
+        Returns the lock, to be passed to unlock, or None if another
+        worker holds it."""
+
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        fd = os.open(self._path('lock'), os.O_RDWR | os.O_CREAT, 0600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError as e:
+            os.close(fd)
+            if e.errno in (errno.EAGAIN, errno.EACCES):
+                return None
+            raise
+        return fd
+
+    def unlock(self, lock):
+        os.close(lock)
+
+    def pending(self):
+        """Returns the names of queued jobs in the order they are due"""
+        try:
+            return sorted(os.listdir(self._path('new')))
+        except OSError:
+            return []
+
+    def ready(self):
+        """Returns the names of queued jobs which are due to be run"""
+        now = time.time()
+        return [name for name in self.pending() if self.due(name) <= now]
+
+    def recover(self):
+        """Return jobs left in work by a worker that died to the queue
+
+        Only to be called while holding the lock."""
+        try:
+            names = os.listdir(self._path('work'))
+        except OSError:
+            return
+        for name in names:
+            os.rename(self._path('work', name), self._path('new', name))
+
+    def claim(self, name):
+        """Move a queued job to work, returning the job"""
+        os.rename(self._path('new', name), self._path('work', name))
+        with open(self._path('work', name), 'rb') as f:
+            return marshal.load(f)
+
+    def done(self, name, job):
+        os.remove(self._path('work', name))
+        if 'input' in job:
+            os.remove(self._path('input', job['input']))
+
+    def retry(self, name, job, delay=0):
+        """Return a job in work to the queue with its updated state
+
+        The job is not due to be run until delay seconds from now.
+        Returns its new name."""
+
+        new_name = self._name(time.time() + delay)
+        with open(self._path('work', name), 'wb') as f:
+            marshal.dump(job, f)
+        os.rename(self._path('work', name), self._path('new', new_name))
+        return new_name
+
+    def fail(self, name, job):
+        """Move a job in work to failed, where it is kept with its input"""
+        os.rename(self._path('work', name), self._path('failed', name))
+        if 'input' in job:
+            os.rename(self._path('input', job['input']),
+                      self._path('failed', name + '.input'))
+
+
+try:
+    from os import scandir as _scandir
+except ImportError:
+    try:
+        # Backport of os.scandir for older Pythons
+        from scandir import scandir as _scandir
+    except ImportError:
+        _scandir = None
+
+
+def _list_dirs(path):
+    """Returns the sorted names of entries of path that may be
+    directories
+
+    With os.scandir only directories (and links to directories) are
+    returned, without a stat call per entry. Otherwise all entries are
+    returned."""
+
+    if _scandir is None:
+        return sorted(os.listdir(path))
+    return sorted(e.name for e in _scandir(path) if e.is_dir())
+
+
+class _DirListings(object):
+    """Listings of directories shared by several RepoLocators
+
+    Each directory is listed at most once, however many locators
+    search it, as when the configs of a CptHookSet have overlapping
+    repo-path lists."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._listings = {}
+
+    def list(self, path):
+        """Returns _list_dirs(path), raising OSError as it does"""
+
+        path = os.path.realpath(path)
+        with self._lock:
+            if path not in self._listings:
+                try:
+                    self._listings[path] = _list_dirs(path)
+                except OSError as e:
+                    self._listings[path] = e
+            listing = self._listings[path]
+        if isinstance(listing, OSError):
+            raise listing
+        return list(listing)
+
+
+class ScriptTable(object):
+    """An index of the hook scripts below script-path
+
+    Each script is recorded by hook type and name with its absolute
+    path, whether it is executable, its mtime and the sha1 digest of
+    its content. The directory of a hook type is listed once when
+    scanned. Recorded scripts are revalidated with a single stat when
+    looked up, and only re-examined if they have changed."""
+
+    def __init__(self, script_path, scripts=None):
+        """scripts is the state of a previous table (see state)"""
+        self.script_path = script_path
+        self._scripts = scripts or {}
+        self._lock = threading.Lock()
+
+    def state(self):
+        """Returns the table as a dict of hook type to a dict of
+        script name to its entry"""
+        return self._scripts
+
+    def _entry(self, path, st):
+        """Returns a new table entry for a script, or None if it is
+        not a file"""
+        if not stat.S_ISREG(st.st_mode):
+            return None
+        return {
+            'path': path,
+            'executable': os.access(path, os.X_OK),
+            'mtime': st.st_mtime,
+            'size': st.st_size,
+            'mode': st.st_mode,
+            'sha1': None,
+        }
+
+    def scan(self, hook_types):
+        """Index all scripts of the given hook types"""
+
+        for hook_type in hook_types:
+            directory = os.path.join(self.script_path, hook_type)
+            try:
+                if _scandir is None:
+                    names = os.listdir(directory)
+                else:
+                    names = [e.name for e in _scandir(directory)
+                             if e.is_file()]
+            except OSError:
+                names = []
+            scripts = {}
+            for name in names:
+                path = os.path.join(directory, name)
+                try:
+                    entry = self._entry(path, os.stat(path))
+                except OSError:
+                    continue
+                if entry is not None:
+                    scripts[name] = entry
+            with self._lock:
+                self._scripts[hook_type] = scripts
+
+    def lookup(self, hook_type, script):
+        """Returns the entry of a script, or None if it does not exist
+
+        The entry is a dict with the 'path', 'executable' flag,
+        'mtime' and 'sha1' (see digest) of the script."""
+
+        path = os.path.join(self.script_path, hook_type, script)
+        logging.debug('Script path {0}'.format(path))
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        with self._lock:
+            entry = self._scripts.get(hook_type, {}).get(script)
+        if entry is not None and entry['path'] == path and \
+                (entry['mtime'], entry['size'], entry['mode']) == \
+                (st.st_mtime, st.st_size, st.st_mode):
+            return entry
+        entry = self._entry(path, st)
+        if entry is not None:
+            with self._lock:
+                self._scripts.setdefault(hook_type, {})[script] = entry
+        return entry
+
+    def digest(self, entry):
+        """Returns the sha1 hex digest of the content of a script"""
+        if entry['sha1'] is None:
+            with open(entry['path'], 'rb') as f:
+                entry['sha1'] = hashlib.sha1(f.read()).hexdigest()
+        return entry['sha1']
+
+
+def _load_libc(*functions):
+    """Returns the C library if it provides all of functions,
+    otherwise None"""
+
+    try:
+        import ctypes
+        import ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                           use_errno=True)
+        for function in functions:
+            getattr(libc, function)
+    except (ImportError, OSError, AttributeError):
+        return None
+    return libc
+
+
+def _fsync_path(path):
+    """fsync a file or directory by name"""
+
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class ConfigWatcher(object):
+    """Waits for changes to a config file or the scripts below
+    script-path
+
+    inotify is used where available, otherwise the files are polled.
+    The directory holding the config file is watched rather than the
+    file, so that a config replaced by renaming a new file over it is
+    noticed."""
+
+    # Seconds between checks when polling
+    poll_interval = 1.0
+    # Seconds without further changes before a change is reported
+    settle_time = 0.2
+
+    # inotify events of interest: modify, attrib, close_write,
+    # moved_from, moved_to, create, delete, delete_self, move_self
+    _inotify_mask = 0x2 | 0x4 | 0x8 | 0x40 | 0x80 | 0x100 | 0x200 | \
+        0x400 | 0x800
+    _inotify_event = struct.Struct('iIII')
+
+    def __init__(self, config_file, script_path, use_inotify=True):
+        self.config_file = os.path.abspath(config_file)
+        self.script_path = os.path.abspath(script_path)
+        self._libc = _load_libc('inotify_init', 'inotify_add_watch') \
+            if use_inotify else None
+        self._fd = None
+        self._watches = {}
+        self._snapshot = None
+        self.reset()
+
+    def _dirs(self):
+        """Returns the directories to watch"""
+        dirs = [os.path.dirname(self.config_file)]
+        for root, subdirs, _ in os.walk(self.script_path):
+            dirs.append(root)
+        return dirs
+
+    def reset(self, script_path=None):
+        """Start watching afresh, eg. once script_path has changed"""
+
+        if script_path is not None:
+            self.script_path = os.path.abspath(script_path)
+        self.close()
+        if self._libc is None:
+            self._snapshot = self._take_snapshot()
+            return
+        self._fd = self._libc.inotify_init()
+        if self._fd < 0:
+            # Out of inotify instances, so poll instead
+            self._libc = None
+            self._fd = None
+            self._snapshot = self._take_snapshot()
+            return
+        for path in self._dirs():
+            wd = self._libc.inotify_add_watch(self._fd, path,
+                                              self._inotify_mask)
+            if wd >= 0:
+                self._watches[wd] = path
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+        self._watches = {}
+
+    def _take_snapshot(self):
+        snapshot = {}
+        paths = [self.config_file]
+        for root, _, files in os.walk(self.script_path):
+            paths.append(root)
+            paths.extend(os.path.join(root, f) for f in files)
+        for path in paths:
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            snapshot[path] = (st.st_ino, st.st_mtime, st.st_size,
+                              st.st_mode)
+        return snapshot
+
+    def _read_events(self, timeout):
+        """Returns True if a relevant event arrived within timeout"""
+
+        ready, _, _ = select.select([self._fd], [], [], timeout)
+        if not ready:
+            return False
+        data = os.read(self._fd, 65536)
+        config_dir = os.path.dirname(self.config_file)
+        config_name = os.path.basename(self.config_file)
+        changed = False
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = self._inotify_event.unpack_from(
+                data, offset)
+            offset += self._inotify_event.size
+            name = data[offset:offset + length].rstrip('\0')
+            offset += length
+            path = self._watches.get(wd)
+            # Only the config file matters in its directory, unless
+            # that is also below script-path
+            if path == config_dir and name != config_name and \
+                    not path.startswith(self.script_path):
+                continue
+            changed = True
+        return changed
+
+    def wait(self, timeout=None):
+        """Wait for a change
+
+        Returns True once a change has been seen and no further change
+        followed within settle_time, or False if there was no change
+        within timeout seconds."""
+
+        end = None if timeout is None else time.time() + timeout
+        while True:
+            remaining = None if end is None else max(end - time.time(), 0)
+            if self._libc is not None:
+                changed = self._read_events(remaining)
+            else:
+                time.sleep(self.poll_interval if remaining is None
+                           else min(self.poll_interval, remaining))
+                snapshot = self._take_snapshot()
+                changed = snapshot != self._snapshot
+                self._snapshot = snapshot
+            if changed:
+                break
+            if end is not None and time.time() >= end:
+                return False
+
+        # Let a burst of changes, eg. a checkout, complete
+        if self._libc is not None:
+            while self._read_events(self.settle_time):
+                pass
+        else:
+            time.sleep(self.settle_time)
+            self._snapshot = self._take_snapshot()
+        return True
+
+
+class RepoLocator(object):
+    """An index of the repositories below a list of search paths
+
+    Each search path is listed once, the first time the index is
+    used. The index serves both to locate managed repositories by
+    name and to enumerate the directories that may be repositories.
+    A repository named repo may be found at path/repo, path/repo/.git,
+    path/repo.git or path/repo.git/.git, in that order of preference,
+    with earlier search paths preferred over later ones.
+
+    listings, a _DirListings, may be shared with other locators so
+    directories they have in common are listed once."""
+
+    def __init__(self, search_paths, listings=None):
+        self.search_paths = search_paths
+        self._listings = listings or _DirListings()
+        self._lock = threading.Lock()
+        self._paths = None
+        self._candidates = None
+        self._located = {}
+        self._names = {}
+
+    def _scan(self):
+        with self._lock:
+            if self._paths is not None:
+                return
+            paths = []
+            candidates = {}
+            for index, search_path in enumerate(self.search_paths):
+                try:
+                    names = self._listings.list(search_path)
+                except OSError:
+                    logging.warn('Could not list repo path {0}'.format(
+                        search_path))
+                    continue
+                for name in names:
+                    path = os.path.join(search_path, name)
+                    paths.append(path)
+                    repo = re.sub('\.git$', '', name)
+                    rank = 0 if repo == name else 2
+                    candidates.setdefault(repo, []).extend([
+                        (index, rank, path),
+                        (index, rank + 1, os.path.join(path, '.git'))])
+            for repo_candidates in candidates.values():
+                repo_candidates.sort()
+            self._candidates = candidates
+            self._paths = paths
+
+    def _probe(self, repo):
+        """Locate a repository by checking each naming case in turn"""
+        for path in self.search_paths:
+            for path_ in (os.path.join(path, repo),
+                          os.path.join(path, repo, '.git'),
+                          os.path.join(path, repo + '.git'),
+                          os.path.join(path, repo + '.git', '.git')):
+                if os.path.exists(os.path.join(path_, 'hooks')):
+                    return path_
+        return None
+
+    def locate(self, repo):
+        """Returns the path of a repository, or None if not found"""
+
         try:
-            members = reduce(lambda x, y: list(set(x + y)), members_)
-        except TypeError:
-            members = []
-        return list(members)
+            return self._located[repo]
+        except KeyError:
+            pass
+        if os.sep in repo:
+            # Nested repositories are not in the index of search paths
+            path = self._probe(repo)
+        else:
+            self._scan()
+            path = None
+            for _, _, path_ in self._candidates.get(repo, []):
+                if os.path.exists(os.path.join(path_, 'hooks')):
+                    path = path_
+                    break
+        self._located[repo] = path
+        return path
+
+    def paths(self):
+        """Returns the paths of all directories below the search paths"""
+        self._scan()
+        return list(self._paths)
+
+    def names(self, subdir=''):
+        """Returns the sorted names of the directories found in subdir
+        of the search paths, as repository names
+
+        subdir is part of the returned names, eg. team-a/repo for a
+        directory team-a/repo.git."""
+
+        if not subdir:
+            self._scan()
+            return sorted(self._candidates)
+        with self._lock:
+            if subdir not in self._names:
+                names = set()
+                for search_path in self.search_paths:
+                    try:
+                        dirs = self._listings.list(
+                            os.path.join(search_path, subdir))
+                    except OSError:
+                        continue
+                    names.update(os.path.join(subdir,
+                                              re.sub('\.git$', '', name))
+                                 for name in dirs)
+                self._names[subdir] = sorted(names)
+            return list(self._names[subdir])
+
+    def name(self, path):
+        """Returns the repository name of a path
+
+        The name of a repository below a search path is its path
+        relative to the search path, so nested repositories keep their
+        directory, eg. team-a/repo. Otherwise it is the last component
+        of the path. Where search paths are nested the deepest one
+        containing the path is used, as it is the one the repository
+        was found in by name when its wrapper was installed."""
+
+        path = os.path.realpath(path)
+        name = os.path.basename(path)
+        prefix = ''
+        for search_path in self.search_paths:
+            search_path = os.path.join(os.path.realpath(search_path), '')
+            if path.startswith(search_path) and len(search_path) > len(prefix):
+                prefix = search_path
+        if prefix:
+            name = path[len(prefix):]
+        name = re.sub('{0}\.git$'.format(re.escape(os.sep)), '', name)
+        return re.sub('\.git$', '', name)
+
+
+class _DeferredLogFilter(logging.Filter):
+    """Holds back log records of threads collecting them
+
+    Records logged by a thread between start() and stop() are
+    returned by stop() instead of being emitted."""
+
+    def __init__(self):
+        logging.Filter.__init__(self)
+        self._local = threading.local()
+
+    def start(self):
+        self._local.records = []
+
+    def stop(self):
+        records = self._local.records
+        self._local.records = None
+        return records
+
+    def filter(self, record):
+        records = getattr(self._local, 'records', None)
+        if records is None:
+            return True
+        records.append(record)
+        return False
 
 
 class CptHook(object):
 
-    def __init__(self, config_file):
+    # Seconds to wait for hook input to be written once a script exits
+    stdin_join_timeout = 1.0
+
+    def __init__(self, config_file, cache_file=None, lazy=False):
         """A git hook execution layer
 
         CptHook provides a mechanism for running multiple hook scripts
@@ -318,10 +2127,65 @@ class CptHook(object):
         configured to be run for a hook type in a repository.
 
         Configuration is managed through an ini-style file
-        (see CptHookConfig)"""
+        (see CptHookConfig), optionally loaded from a compiled
+        cache_file or lazily resolved."""
         self.config_file = config_file
-        self.config = CptHookConfig(config_file)
+        self.cache_file = cache_file
+        self.config = CptHookConfig(config_file, cache_file=cache_file,
+                                    lazy=lazy)
         self.dry_run = False
+        # Install wrappers running hooks through a cpthook daemon
+        # listening on this socket (see CptHookDaemon)
+        self.socket_path = None
+        # Ask git about repositories with an ambiguous layout
+        self.strict_repo_detection = False
+        # Record installed wrappers here so later updates only apply
+        # changes (see update_hooks)
+        self.manifest_file = None
+        # Number of threads scanning and updating repositories
+        self.jobs = 1
+        # Records timings of hook execution (see HookTracer)
+        self.tracer = HookTracer()
+        # Further cpthook options passed by installed wrappers
+        self.wrapper_options = []
+        # Replace this process with the script when a hook has a single
+        # script to run (see run_hook). Only for a process run by git
+        # for the hook, reading hook input from standard input.
+        self.exec_single_script = False
+        # Repositories managed by another config, mapped to its CptHook
+        # (see CptHookSet). Their wrappers are left alone.
+        self.other_repos = {}
+        # Install wrappers listing the scripts to run where possible
+        # (see _compiled_wrapper)
+        self.compile_wrappers = False
+        # Flush written wrappers and manifest to disk at the end of
+        # install_hooks and update_hooks (see _sync_writes)
+        self.sync = False
+        self._written_paths = set()
+        self._locator = None
+        # Cache repository detection by inode and mtime
+        self.repo_detection_cache = True
+        self._git_repo_cache = {}
+        # Results of scripts in hook groups with the cache option
+        self.result_cache = None
+        if 'result-cache' in self.config.global_config:
+            self.result_cache = ResultCache(
+                self.config.global_config['result-cache'],
+                self.config.global_config.get('result-cache-size',
+                                              result_cache_size))
+        # Limit on the scripts running at once on this host
+        self.process_slots = None
+        g_conf = self.config.global_config
+        if g_conf.get('max-processes', 0) > 0:
+            self.process_slots = ProcessSlots(
+                g_conf.get('process-slot-path', os.path.join(
+                    tempfile.gettempdir(), 'cpthook-slots')),
+                g_conf['max-processes'],
+                g_conf.get('process-slot-wait', process_slot_wait))
+        # Queue of async hook scripts to be run in the background
+        self.queue = None
+        if 'async-queue' in self.config.global_config:
+            self.queue = HookQueue(self.config.global_config['async-queue'])
 
     def _script_name(self):
         """Returns path and filename of executing python program"""
@@ -342,25 +2206,119 @@ class CptHook(object):
         else:
             return True
 
-    def add_hooks_to_repo(self, repo_path, hooks):
+    def _wrapper(self, hook_type, repo=None):
+        """Returns the wrapper script to install for a hook type
+
+        If compile_wrappers is set and the repository is given, a
+        compiled wrapper is returned where the hook plan allows."""
+
+        if self.compile_wrappers and repo is not None:
+            wrapper = self._compiled_wrapper(repo, hook_type)
+            if wrapper is not None:
+                return wrapper
+
+        cpthook = self._script_name()
+        options = self._wrapper_command_options()
+
+        if self.socket_path is None:
+            template = wrapper_template
+        else:
+            template = daemon_wrapper_template
+        return template.format(
+            cpthook=cpthook, options=' '.join(options), hook=hook_type,
+            install=' '.join(self._install_options()),
+            command=[cpthook] + options + ['--hook={0}'.format(hook_type)],
+            socket=os.path.realpath(self.socket_path or ''))
+
+    def _compiled_wrapper(self, repo, hook_type):
+        """Returns a shell wrapper running the scripts of a hook type
+        for a repository directly, or None
+
+        The scripts resolved from the config are listed in the
+        wrapper, so running the hook needs neither python nor the
+        config. A single script replaces the wrapper. Otherwise the
+        scripts run in order, each given the hook input replayed from
+        a temporary file, until one exits non-zero. Missing and
+        non-executable scripts are skipped when the hook runs.
+
+        None is returned if the hook plan needs cpthook itself: for
+        parallel stages, timeouts, cached results, async scripts, the
+        process limit or tracing."""
+
+        if self.process_slots is not None or self.wrapper_options:
+            return None
+        plan = self.config.hook_plan(repo, hook_type)
+        for stage in plan:
+            if (len(stage['scripts']) > 1 and stage['max-parallel'] != 1) \
+                    or stage['timeout'] or stage['hook-timeout'] \
+                    or (stage['cache'] and self.result_cache is not None) \
+                    or (stage['async'] and self.queue is not None):
+                logging.debug('Cannot compile {0} hook {1}'.format(
+                    repo, hook_type))
+                return None
+
+        script_path = os.path.abspath(self.config.scripts.script_path)
+        scripts = [pipes.quote(os.path.join(script_path, hook_type, x))
+                   for stage in plan for x in stage['scripts']]
+        if not scripts:
+            body = 'exit 0\n'
+        elif len(scripts) == 1:
+            body = compiled_exec.format(script=scripts[0])
+        else:
+            if hook_type in input_hooks:
+                body = compiled_run_input
+            else:
+                body = compiled_run
+            body += ''.join('run {0} "$@" || exit $?\n'.format(x)
+                            for x in scripts)
+        return compiled_wrapper_template.format(
+            cpthook=self._script_name(),
+            options=' '.join(self._wrapper_command_options()),
+            hook=hook_type, install=' '.join(self._install_options()),
+            config=os.path.realpath(self.config_file), repo=repo, body=body)
+
+    def _wrapper_command_options(self):
+        """Returns the options of the cpthook command run by wrappers"""
+
+        options = ['--config={0}'.format(os.path.realpath(self.config_file))]
+        if self.cache_file is not None:
+            options.append('--cache={0}'.format(
+                os.path.realpath(self.cache_file)))
+        return options + self.wrapper_options
+
+    def _install_options(self):
+        """Returns the cpthook options wrappers are installed with"""
+
+        options = []
+        if self.cache_file is not None:
+            options.append('--cache={0}'.format(
+                os.path.realpath(self.cache_file)))
+        if self.socket_path is not None:
+            options.append('--socket={0}'.format(
+                os.path.realpath(self.socket_path)))
+        if self.manifest_file is not None:
+            options.append('--manifest={0}'.format(
+                os.path.realpath(self.manifest_file)))
+        if self.compile_wrappers:
+            options.append('--compile')
+        return options + self.wrapper_options
+
+    def add_hooks_to_repo(self, repo_path, hooks, repo=None):
         """Called with a path to a repository and a list of hooks
 
-        Creates a bash wrapper to run cpthook when git runs each hook"""
+        Creates a wrapper to run cpthook when git runs each hook. If
+        socket_path is set the wrapper runs hooks through a cpthook
+        daemon listening on that socket. If compile_wrappers is set
+        and the repository name is given, wrappers run the hook
+        scripts directly where possible (see _compiled_wrapper).
 
-        template = (
-            "#!/bin/sh\n"
-            "#\n"
-            "# MAGIC STRING: cpthook-wrapper (do not remove)\n"
-            "{0} --config={1} --hook={2} $*\n"
-        )
+        Returns the list of hooks for which a wrapper was written."""
 
-        config_file = os.path.realpath(self.config_file)
+        written = []
         hook_path = os.path.join(repo_path, 'hooks')
         if not os.path.isdir(hook_path):
             logging.warn('Hook path {0} is not a directory'.format(hook_path))
-            return
-
-        cpthook = self._script_name()
+            return written
 
         for hook_type in hooks:
             target = os.path.join(repo_path, 'hooks', hook_type)
@@ -385,178 +2343,714 @@ class CptHook(object):
                 logging.info('Dry run. Skipping write to {0}'.format(target))
                 continue
 
+            # Write a temporary file beside the target and rename it
+            # into place, so git never runs a partially written wrapper
             try:
-                f = open(target, 'w')
+                fd, tmp = tempfile.mkstemp(dir=hook_path, prefix='.cpthook-')
             except:
                 logging.warn('Could not write wrapper {0}'.format(target))
                 continue
 
             try:
-                wrapper = template.format(cpthook, config_file, hook_type)
-                f.write(wrapper)
-                f.close()
-                os.chmod(target, 0755)
+                with os.fdopen(fd, 'w') as f:
+                    os.fchmod(f.fileno(), 0755)
+                    f.write(self._wrapper(hook_type, repo))
+                os.rename(tmp, target)
+                self._written_paths.add(target)
+                written.append(hook_type)
                 logging.info('Wrote {0} hook {1}'.format(
                     os.path.basename(repo_path), hook_type))
                 logging.debug('Created wrapper {0}'.format(target))
             except:
                 logging.warn('Failed to create wrapper {0}'.format(target))
+                try:
+                    os.unlink(tmp)
+                except OSError:
+                    pass
+        return written
+
+    def _sync_writes(self):
+        """Flush the wrappers and manifest written since the last call
+        to disk if sync is set
+
+        A single syncfs is made for each filesystem written to. Where
+        syncfs is not available each written file and then each
+        directory holding them is fsynced once."""
+
+        paths = sorted(self._written_paths)
+        self._written_paths = set()
+        if not self.sync or not paths:
+            return
+        dirs = sorted(set(os.path.dirname(p) for p in paths))
+
+        libc = _load_libc('syncfs')
+        if libc is not None:
+            devices = {}
+            for d in dirs:
+                try:
+                    devices.setdefault(os.stat(d).st_dev, d)
+                except OSError:
+                    pass
+            for d in devices.values():
+                fd = os.open(d, os.O_RDONLY)
+                try:
+                    if libc.syncfs(fd) == 0:
+                        logging.debug('Synced filesystem of {0}'.format(d))
+                        continue
+                finally:
+                    os.close(fd)
+                logging.warn('syncfs failed for {0}'.format(d))
+            return
+
+        def sync(path):
+            try:
+                _fsync_path(path)
+            except OSError:
+                logging.warn('Could not sync {0}'.format(path))
+
+        self._map(sync, paths)
+        self._map(sync, dirs)
+
+    def _remove_wrapper(self, file_):
+        """Remove file_ if it is a cpthook wrapper"""
+
+        try:
+            is_wrapper = self._is_cpthook_wrapper(file_)
+        except:
+            logging.warn(('Could not determine if {0} '
+                          'is a wrapper'.format(file_)))
+            return
+        if not is_wrapper:
+            logging.debug('Not cpthook wrapper: {0}'.format(file_))
+            return
+        if self.dry_run:
+            logging.info(('Dry run. Skipping removal '
+                          'of unmanaged wrapper '
+                          '{0}'.format(file_)))
+            return
+        try:
+            os.remove(file_)
+        except:
+            logging.warn('Could not remove {0}'.format(file_))
+            return
+        logging.info('Removed unmanaged wrapper '
+                     '{0}'.format(file_))
+
+    @property
+    def locator(self):
+        """The RepoLocator for the configured repo-path"""
+        if self._locator is None:
+            self._locator = RepoLocator(
+                self.config.global_config['repo-path'])
+        return self._locator
 
     def _locate_repo(self, repo):
         """Find repository location for a given repository name"""
+        return self.locator.locate(repo)
 
-        # Locate by matching 4 common naming cases
-        # 1. path/repo
-        # 2. path/repo/.git
-        # 3. path/repo.git
-        # 4. path/repo.git/.git
-
-        search_paths = self.config.global_config['repo-path']
-        for path in search_paths:
-            path_ = os.path.join(path, repo)
-            if os.path.exists(os.path.join(path_, 'hooks')):
-                return path_
-            path_ = os.path.join(path, repo, '.git')
-            if os.path.exists(os.path.join(path_, 'hooks')):
-                return path_
-            path_ = os.path.join(path, repo + '.git')
-            if os.path.exists(os.path.join(path_, 'hooks')):
-                return path_
-            path_ = os.path.join(path, repo + '.git', '.git')
-            if os.path.exists(os.path.join(path_, 'hooks')):
-                return path_
-        return None
+    def _wrapper_digest(self, hook_type, repo=None):
+        """Returns the sha1 hex digest of the wrapper for a hook type"""
+        return hashlib.sha1(self._wrapper(hook_type, repo)).hexdigest()
 
     def install_hooks(self):
-        """Installs configured hooks into managed repositories"""
-
-        for repo in self.config.repos():
-            logging.debug('Examining repo {0}'.format(repo))
-            repo_path = self._locate_repo(repo)
-            if repo_path is None:
-                logging.warn('Could not locate repo {0}'.format(repo))
+        """Installs configured hooks into managed repositories
+
+        Returns the installed state, a dict of repository name to the
+        repository path and a dict of installed hook type to the
+        wrapper's digest and stamp (see _installed_wrapper)."""
+
+        state = self._install_hooks()
+        self._sync_writes()
+        return state
+
+    def _install_hooks(self):
+        """Installs configured hooks without syncing (see install_hooks)"""
+
+        repos = self._managed_repos()
+        results = self._map(self._install_repo, repos)
+        return dict((repo, result) for repo, result in zip(repos, results)
+                    if result is not None)
+
+    def _install_repo(self, repo):
+        """Installs the configured hooks of a repository
+
+        Returns the installed state of the repository, or None if it
+        could not be located."""
+
+        logging.debug('Examining repo {0}'.format(repo))
+        repo_path = self._locate_repo(repo)
+        if repo_path is None:
+            logging.warn('Could not locate repo {0}'.format(repo))
+            return None
+        hooks = self.config.hooks_for_repo(repo).keys()
+        written = self.add_hooks_to_repo(repo_path, hooks, repo)
+        return {
+            'path': repo_path,
+            'hooks': dict((h, self._installed_wrapper(
+                               repo_path, h, self._wrapper_digest(h, repo)))
+                          for h in written),
+        }
+
+    def _installed_wrapper(self, repo_path, hook_type, digest):
+        """Returns the manifest entry of an installed wrapper
+
+        The entry holds the digest of the wrapper content and the
+        stamp of the file (see _wrapper_stamp), so a wrapper since
+        replaced or removed is noticed."""
+        return {'digest': digest,
+                'stamp': self._wrapper_stamp(repo_path, hook_type)}
+
+    def _wrapper_stamp(self, repo_path, hook_type):
+        """Returns the inode, size and mtime of a wrapper, or None"""
+        try:
+            st = os.stat(os.path.join(repo_path, 'hooks', hook_type))
+        except OSError:
+            return None
+        return [st.st_ino, st.st_size, st.st_mtime]
+
+    def _managed_repos(self):
+        """Returns the sorted names of the repositories to manage
+
+        These are the repositories listed in the config and those
+        found below the repo paths that match pattern members. Each
+        pattern is matched against the directories of its literal
+        prefix, eg. team-a/* against the contents of team-a."""
+
+        repos = set(self.config.repos())
+        subdirs = set(os.path.dirname(prefix)
+                      for prefix in self.config.pattern_prefixes())
+        for subdir in sorted(subdirs):
+            for repo in self.locator.names(subdir):
+                if repo not in repos and \
+                        self.config.repo_group_membership(repo):
+                    repos.add(repo)
+        return sorted(r for r in repos if r not in self.other_repos)
+
+    def _sync_hooks(self, manifest):
+        """Apply the difference between a manifest and the config
+
+        Only wrappers whose desired state differs from the state
+        recorded in the manifest are written or removed. Returns the
+        installed state (see install_hooks)."""
+
+        calls, finish = self._sync_calls(manifest)
+        return finish(self._map(_call, calls))
+
+    def _sync_calls(self, manifest):
+        """Returns the work of _sync_hooks: a list of calls and a
+        function given their results that returns the installed state
+
+        Each call is a function taking no arguments, so the calls of
+        several configs can be run together (see CptHookSet)."""
+
+        old_state = manifest['repos']
+        digests = {}
+        repos = self._managed_repos()
+        calls = [functools.partial(self._sync_repo, repo, old_state, digests)
+                 for repo in repos]
+        # Repositories no longer managed by the config
+        managed = set(repos)
+        calls += [functools.partial(self._remove_dropped, repo,
+                                    old_state[repo])
+                  for repo in sorted(old_state) if repo not in managed]
+
+        def finish(results):
+            return dict((repo, result)
+                        for repo, result in zip(repos, results)
+                        if result is not None)
+
+        return calls, finish
+
+    def _sync_repo(self, repo, old_state, digests):
+        """Apply the difference between the state of a repository in
+        old_state and the config, returning its installed state
+
+        digests caches the wrapper digest of each hook type."""
+
+        repo_path = self._locate_repo(repo)
+        if repo_path is None:
+            logging.warn('Could not locate repo {0}'.format(repo))
+            return None
+        hooks = {}
+        for hook_type in self.config.hooks_for_repo(repo):
+            if self.compile_wrappers:
+                # Compiled wrappers differ between repositories
+                hooks[hook_type] = self._wrapper_digest(hook_type, repo)
                 continue
-            hooks = self.config.hooks_for_repo(repo).keys()
-            self.add_hooks_to_repo(repo_path, hooks)
+            if hook_type not in digests:
+                digests[hook_type] = self._wrapper_digest(hook_type)
+            hooks[hook_type] = digests[hook_type]
+
+        old = old_state.get(repo, {'path': None, 'hooks': {}})
+        old_hooks = old['hooks']
+        if old['path'] != repo_path:
+            if old['path'] is not None:
+                self._remove_wrappers(old['path'], old_hooks)
+            old_hooks = {}
+        self._remove_wrappers(
+            repo_path, [h for h in old_hooks if h not in hooks])
+
+        # A wrapper is only left alone if it has the wanted digest and
+        # is still the file recorded, eg. not rewritten by an --init
+        # without the manifest
+        changed = [h for h in hooks
+                   if old_hooks.get(h) != {
+                       'digest': hooks[h],
+                       'stamp': self._wrapper_stamp(repo_path, h)}]
+        written = []
+        if changed:
+            logging.debug('Updating {0} hooks {1}'.format(repo, changed))
+            written = self.add_hooks_to_repo(repo_path, changed, repo)
+        installed = dict((h, old_hooks[h]) for h in hooks
+                         if h not in changed)
+        for h in written:
+            installed[h] = self._installed_wrapper(repo_path, h, hooks[h])
+        return {'path': repo_path, 'hooks': installed}
+
+    def _remove_dropped(self, repo, old):
+        """Remove the wrappers of a repository no longer managed
+
+        If another config now manages the repository, the wrappers of
+        the hook types it manages are left for it to replace."""
+
+        hooks = old['hooks']
+        owner = self.other_repos.get(repo)
+        if owner is not None:
+            managed = owner.config.hooks_for_repo(repo)
+            hooks = [h for h in hooks if h not in managed]
+        self._remove_wrappers(old['path'], hooks)
+
+    def _remove_wrappers(self, repo_path, hooks):
+        """Remove the wrappers for a list of hooks from a repository"""
+        for hook_type in hooks:
+            target = os.path.join(repo_path, 'hooks', hook_type)
+            if os.path.isfile(target):
+                self._remove_wrapper(target)
 
-    def remove_unmanaged_hooks(self):
+    def _load_manifest(self):
+        """Returns the manifest of the previous update, or None
+
+        None is returned if there is no usable manifest or it was
+        written for a different cpthook or config file."""
+
+        if self.manifest_file is None:
+            return None
+        try:
+            with open(self.manifest_file) as f:
+                manifest = json.load(f)
+        except (IOError, ValueError):
+            logging.info('No usable manifest {0}'.format(self.manifest_file))
+            return None
+        if manifest.get('version') != manifest_version or \
+                manifest.get('cpthook') != self._script_name() or \
+                manifest.get('config') != os.path.realpath(self.config_file):
+            logging.info('Manifest {0} does not match, ignoring it'.format(
+                self.manifest_file))
+            return None
+        return manifest
+
+    def _write_manifest(self, state):
+        """Atomically write the installed state to the manifest file"""
+
+        manifest = {
+            'version': manifest_version,
+            'cpthook': self._script_name(),
+            'config': os.path.realpath(self.config_file),
+            'repos': state,
+        }
+        manifest_dir = os.path.dirname(os.path.abspath(self.manifest_file))
+        try:
+            fd, tmp = tempfile.mkstemp(dir=manifest_dir, prefix='.cpthook-')
+            with os.fdopen(fd, 'w') as f:
+                json.dump(manifest, f, indent=1, sort_keys=True)
+            os.rename(tmp, self.manifest_file)
+            self._written_paths.add(os.path.abspath(self.manifest_file))
+        except (IOError, OSError):
+            logging.warn('Could not write manifest {0}'.format(
+                self.manifest_file))
+
+    def update_hooks(self):
+        """Install configured hooks and remove unmanaged wrappers
+
+        If manifest_file holds the state recorded by a previous update
+        only the wrappers whose desired state has changed are written
+        or removed. Otherwise all wrappers are installed and repos
+        below repo-path are scanned for unmanaged wrappers. The new
+        state is then recorded in manifest_file. Scripts referenced by
+        the config that do not exist or are not executable are
+        reported."""
+
+        calls, finish, full = self._update_calls()
+        results = self._map(_call, calls)
+        if full:
+            self.remove_unmanaged_hooks()
+        finish(results)
+        self._sync_writes()
+
+    def _update_calls(self):
+        """Returns the work of update_hooks
+
+        This is a list of calls (see _sync_calls), a function given
+        their results that records the new state and whether a full
+        update is being made, after which unmanaged wrappers are to be
+        removed."""
+
+        for problem in self.config.script_problems():
+            logging.warn(problem)
+        manifest = self._load_manifest()
+        if manifest is None:
+            repos = self._managed_repos()
+            calls = [functools.partial(self._install_repo, repo)
+                     for repo in repos]
+
+            def installed(results):
+                return dict((repo, result)
+                            for repo, result in zip(repos, results)
+                            if result is not None)
+        else:
+            logging.info('Updating hooks from manifest {0}'.format(
+                self.manifest_file))
+            calls, installed = self._sync_calls(manifest)
+
+        def finish(results):
+            state = installed(results)
+            if self.manifest_file is not None and not self.dry_run:
+                self._write_manifest(state)
+
+        return calls, finish, manifest is None
+
+    def remove_unmanaged_hooks(self, paths=None):
         """Remove cpthook wrapper hooks from repos below repo-path
 
         Removes scripts for git repos found immediately below a
-        directory listed in the global repo-path"""
-
-        repos = []
-        for path in self.config.global_config['repo-path']:
-            dirs = os.listdir(path)
-            for dir_ in dirs:
-                p = os.path.realpath(os.path.join(path, dir_))
-                if p not in repos:
-                    if self._is_git_repo(p):
-                        repos.append(p)
+        directory listed in the global repo-path, or among paths if
+        given"""
+
+        if paths is None:
+            paths = self.locator.paths()
+        candidates = []
+        seen = set()
+        for path in paths:
+            p = os.path.realpath(path)
+            if p not in seen:
+                seen.add(p)
+                candidates.append(p)
+        is_repo = self._map(self._is_git_repo, candidates)
+        repos = [p for p, r in zip(candidates, is_repo) if r]
 
         # repos is a list of git repositories. Find which contain
         # cpthook wrappers but are unmanaged according to config
-        for repo in repos:
-            path = None
-            if os.path.isdir(os.path.join(repo, 'hooks')):
-                path = os.path.join(repo, 'hooks')
-            elif os.path.isdir(os.path.join(repo, '.git', 'hooks')):
-                path = os.path.join(repo, '.git', 'hooks')
-            if path is None:
-                logging.debug('No hooks directory found in {0}'.format(
-                    repo))
-            hook_files = os.listdir(path)
-
-            # Filter out all files but the supported hooks
-            hook_files = [h for h in hook_files if h in supported_hooks]
-
-            if len(hook_files) == 0:
-                # No hooks in repo, skip it
-                continue
+        self._map(self._remove_unmanaged_hooks_from_repo, repos)
+
+    def _remove_unmanaged_hooks_from_repo(self, repo):
+        """Remove cpthook wrappers not configured for a repository"""
+
+        path = None
+        if os.path.isdir(os.path.join(repo, 'hooks')):
+            path = os.path.join(repo, 'hooks')
+        elif os.path.isdir(os.path.join(repo, '.git', 'hooks')):
+            path = os.path.join(repo, '.git', 'hooks')
+        if path is None:
+            logging.debug('No hooks directory found in {0}'.format(
+                repo))
+            return
+        hook_files = os.listdir(path)
 
-            repo_name = re.sub('\.git$', '', os.path.basename(repo))
-            known_hooks = self.config.hooks_for_repo(repo_name).keys()
+        # Filter out all files but the supported hooks
+        hook_files = [h for h in sorted(hook_files) if h in supported_hooks]
 
-            for file_ in hook_files:
-                if file_ not in known_hooks:
-                    f_p = os.path.join(path, file_)
-                    try:
-                        is_wrapper = self._is_cpthook_wrapper(f_p)
-                    except:
-                        logging.warn(('Could not determine if {0} '
-                                      'is a wrapper'.format(f_p)))
-                        continue
-                    if is_wrapper:
-                        if self.dry_run:
-                            logging.info(('Dry run. Skipping removal '
-                                          'of unmanaged wrapper '
-                                          '{0}'.format(f_p)))
-                            continue
-                        try:
-                            os.remove(f_p)
-                        except:
-                            logging.warn('Could not remove {0}'.format(f_p))
-                        logging.info('Removed unmanaged wrapper '
-                                     '{0}'.format(f_p))
-                    else:
-                        logging.debug('Not cpthook wrapper: {0}'.format(f_p))
+        if len(hook_files) == 0:
+            # No hooks in repo, skip it
+            return
 
-    def _abs_script_name(self, hook, script):
-        hooksd_path = self.config.global_config['script-path']
-        script_file = os.path.join(hooksd_path, hook, script)
-        logging.debug('Script path {0}'.format(script_file))
-        return script_file
+        repo_name = re.sub('\.git$', '', os.path.basename(repo))
+        owner = self.other_repos.get(repo_name, self)
+        known_hooks = owner.config.hooks_for_repo(repo_name).keys()
 
-    def _is_git_repo(self, path):
-        if not os.path.isdir(path):
+        for file_ in hook_files:
+            if file_ not in known_hooks:
+                self._remove_wrapper(os.path.join(path, file_))
+
+    def _map(self, func, items, jobs=None):
+        """Returns [func(x) for x in items], calling func on a pool of
+        jobs threads, by default self.jobs
+
+        Each call is a unit of work whose log records are held back
+        and emitted in the order of items, so log output is the same
+        however many threads are used."""
+
+        if jobs is None:
+            jobs = self.jobs
+        if jobs <= 1 or len(items) <= 1:
+            return [func(x) for x in items]
+
+        from multiprocessing.pool import ThreadPool
+        root = logging.getLogger()
+        deferred = _DeferredLogFilter()
+
+        def unit(item):
+            deferred.start()
+            try:
+                return func(item), None, deferred.stop()
+            except Exception as e:
+                return None, e, deferred.stop()
+
+        root.addFilter(deferred)
+        pool = ThreadPool(jobs)
+        results = []
+        try:
+            for result, error, records in pool.imap(unit, items):
+                for record in records:
+                    root.handle(record)
+                if error is not None:
+                    raise error
+                results.append(result)
+        finally:
+            pool.close()
+            pool.join()
+            root.removeFilter(deferred)
+        return results
+
+    def _git_dir_layout(self, git_dir):
+        """Classify git_dir as a git directory
+
+        Returns True if it holds HEAD, objects and refs, None if only
+        some of them are present and False if it has no HEAD."""
+
+        if not os.path.isfile(os.path.join(git_dir, 'HEAD')):
             return False
-        orig_dir = os.getcwd()
+        common_dir = git_dir
+        commondir_file = os.path.join(git_dir, 'commondir')
+        if os.path.isfile(commondir_file):
+            # Linked worktree: objects and refs live in the common dir
+            try:
+                with open(commondir_file) as f:
+                    common_dir = os.path.join(git_dir, f.read().strip())
+            except IOError:
+                return None
+        if os.path.isdir(os.path.join(common_dir, 'objects')) and \
+                os.path.isdir(os.path.join(common_dir, 'refs')):
+            return True
+        return None
+
+    def _detect_git_repo(self, path):
+        """Returns True or False if path is or is not a git repo, or
+        None if it cannot be decided from the filesystem layout"""
+
+        layout = self._git_dir_layout(path)
+        if layout is not False:
+            # Bare repository or git directory
+            return layout
+        dot_git = os.path.join(path, '.git')
+        if os.path.isdir(dot_git):
+            return self._git_dir_layout(dot_git)
+        if os.path.isfile(dot_git):
+            # A gitdir file pointing to the git directory
+            try:
+                with open(dot_git) as f:
+                    line = f.readline().strip()
+            except IOError:
+                return None
+            if not line.startswith('gitdir:'):
+                return None
+            git_dir = os.path.join(path, line[len('gitdir:'):].strip())
+            return self._git_dir_layout(git_dir)
+        return False
+
+    def _is_git_repo(self, path):
+        """Return True if path is a git repository
+
+        The filesystem layout of path and path/.git is examined for a
+        git directory, without running git. If the layout is ambiguous
+        git is asked when strict_repo_detection is set, otherwise the
+        presence of HEAD is taken to mean a repository. If
+        repo_detection_cache is set results are cached by path, inode
+        and mtime."""
+
         try:
-            os.chdir(path)
+            st = os.stat(path)
         except OSError:
             return False
-        with open('/dev/null', 'wb') as devnull:
-            ret = subprocess.call(['git', 'rev-parse'], stderr=devnull)
-        os.chdir(orig_dir)
-        if ret != 0:
+        if not os.path.isdir(path):
             return False
-        else:
-            return True
 
-    def run_hook(self, hook, args):
+        path = os.path.realpath(path)
+        key = (st.st_ino, st.st_mtime)
+        if self.repo_detection_cache:
+            try:
+                cached_key, result = self._git_repo_cache[path]
+                if cached_key == key:
+                    return result
+            except KeyError:
+                pass
+
+        result = self._detect_git_repo(path)
+        if result is None:
+            if self.strict_repo_detection:
+                logging.debug('Asking git whether {0} is a repo'.format(
+                    path))
+                with open(os.devnull, 'wb') as devnull:
+                    ret = subprocess.call(['git', 'rev-parse'], cwd=path,
+                                          stdout=devnull, stderr=devnull)
+                result = ret == 0
+            else:
+                result = True
+
+        if self.repo_detection_cache:
+            self._git_repo_cache[path] = (key, result)
+        return result
+
+    def run_hook(self, hook, args, stdin=None, repo_path=None):
         """Runs a given hook type (eg. post-commit)
 
-        Expects execution within the git repository (as git does).
+        Expects execution within the git repository (as git does),
+        unless the path of the repository is given as repo_path.
         Attempts to run each script of the given hook type that
-        is enabled for the current repository.
+        is enabled for the repository. Hook input is read from the
+        stdin file, or sys.stdin if not given. Scripts are run from
+        the repository directory.
 
         Execution halts when all scripts are run or earlier if
         a hook script terminated with a non-zero exit code.
 
+        If exec_single_script is set, stdin is not given and there is
+        exactly one script to run, this process is replaced by the
+        script, which reads hook input directly and whose exit code
+        git sees, and run_hook does not return.
+
         Returns 0, or the non-zero exit code from the script that
         terminated with that exit code."""
 
-        if not self._is_git_repo(os.path.curdir):
-            logging.warn('{0} is not a git repo?'.format(
-                os.path.realpath(os.path.curdir)))
-            return -1
-        # Work out the repository name from the current directory
-        repo = os.path.basename(os.path.realpath(os.path.curdir))
-        repo = re.sub('\.git$', '', repo)
-
-        # Read stdin into a buffer to be replayed to each hook script.
-        stdin = sys.stdin.read()
-
-        hooks = self.config.hooks_for_repo(repo)
-        if hook in hooks:
+        cwd = None
+        if repo_path is None:
+            repo_path = os.path.curdir
+        else:
+            cwd = repo_path
+        with self.tracer.span('hook', hook=hook) as span:
+            with self.tracer.span('repo-check', hook=hook):
+                is_repo = self._is_git_repo(repo_path)
+            if not is_repo:
+                logging.warn('{0} is not a git repo?'.format(
+                    os.path.realpath(repo_path)))
+                span['exit'] = -1
+                return -1
+            # Work out the repository name from its directory
+            repo = self.locator.name(repo_path)
+            span['repo'] = repo
+
+            # Spool stdin to be replayed to each hook script.
+            if stdin is None:
+                stdin = sys.stdin
+                exec_ok = self.exec_single_script and cwd is None
+            else:
+                exec_ok = False
+            stdin = StdinSpool(stdin)
+
+            span['exit'] = self._run_hook(repo, hook, args, stdin, cwd,
+                                          exec_ok)
+            return span['exit']
+
+    def run_batch(self, jobs):
+        """Run hooks for many repositories at once
+
+        jobs is a list of dicts, each with the path of a repository as
+        'repo', a hook type as 'hook' and optionally a list of 'args'.
+        Hook input is read from 'stdin', a file name or file object,
+        or given directly as the string 'input'. Jobs without either
+        get no input. Jobs run on a pool of jobs threads sharing the
+        loaded config and repository index.
+
+        Returns a report dict for each job, in order, with the 'repo'
+        and 'hook' of the job, the 'exit' code of the hook and its
+        'start' time and 'duration' in seconds. Jobs that could not
+        be run have exit code -1 and an 'error' message."""
+
+        def run(job):
+            report = {'repo': job.get('repo'), 'hook': job.get('hook'),
+                      'start': time.time()}
+            try:
+                report['exit'] = self._run_job(job)
+            except Exception as e:
+                logging.error('Could not run {0} hook for {1}: {2}'.format(
+                    report['hook'], report['repo'], e))
+                report['exit'] = -1
+                report['error'] = str(e)
+            report['duration'] = time.time() - report['start']
+            return report
+
+        return self._map(run, jobs)
+
+    def _run_job(self, job):
+        """Run a single run_batch job, returning the hook exit code"""
+
+        hook = job['hook']
+        if hook not in supported_hooks:
+            raise ValueError('Unsupported hook "{0}"'.format(hook))
+        repo_path = job['repo']
+        if not os.path.isdir(repo_path):
+            raise ValueError('No repository directory "{0}"'.format(
+                repo_path))
+        args = [_native_str(arg) for arg in job.get('args', [])]
+
+        stdin = job.get('stdin')
+        if stdin is None:
+            stdin = tempfile.TemporaryFile()
+            stdin.write(_native_str(job.get('input', '')))
+            stdin.seek(0)
+        elif isinstance(stdin, basestring):
+            stdin = open(stdin, 'rb')
+        try:
+            return self.run_hook(hook, args, stdin,
+                                 repo_path=os.path.realpath(repo_path))
+        finally:
+            if stdin is not job.get('stdin'):
+                stdin.close()
+
+    def _run_hook(self, repo, hook, args, stdin, cwd=None, exec_ok=False):
+        """Run the scripts of a hook type for a repository
+
+        Scripts are run from the directory cwd if given. If exec_ok is
+        True a single script may replace this process. Async stages
+        are queued once the other stages have succeeded."""
+
+        with self.tracer.span('resolve', repo=repo, hook=hook):
+            plan = self.config.hook_plan(repo, hook)
+        deferred = []
+        if self.queue is not None and not self.dry_run:
+            deferred = [stage for stage in plan if stage['async']]
+            plan = [stage for stage in plan if not stage['async']]
+        if exec_ok and not deferred:
+            self._exec_single_script(repo, hook, plan, args)
+        if plan or deferred:
             logging.info('Found {0} hooks'.format(hook))
-            for script in hooks[hook]:
-                script_file = self._abs_script_name(hook, script)
-                if not os.path.exists(script_file):
+        ret = self._run_stages(repo, hook, plan, args, stdin, cwd)
+        if ret == 0 and deferred:
+            self._queue_job(repo, hook, deferred, args, stdin, cwd)
+        return ret
+
+    def _run_stages(self, repo, hook, plan, args, stdin, cwd=None,
+                    env=None):
+        """Run the stages of a hook plan in order
+
+        Scripts are run from the directory cwd, if given, with the
+        environment env, if given. Scripts not started before the
+        shortest hook-timeout of the plan has passed time out."""
+
+        hook_timeouts = [x['hook-timeout'] for x in plan if x['hook-timeout']]
+        deadline = None
+        if hook_timeouts:
+            deadline = time.time() + min(hook_timeouts)
+
+        for stage in plan:
+            scripts = []
+            for script in stage['scripts']:
+                entry = self.config.scripts.lookup(hook, script)
+                if entry is None:
                     logging.info('{0} hook {1} does not exist'.format(
                         hook, script))
                     continue
-                if not os.access(script_file, os.X_OK):
+                script_file = entry['path']
+                if not entry['executable']:
                     logging.info('{0} hook {1} is not executable'.format(
                         hook, script))
                     continue
@@ -564,17 +3058,783 @@ class CptHook(object):
                     logging.info('Dry-run: skipping {0} script {1}'.format(
                         repo, script))
                     continue
-                logging.info('Running {0} hook {1}'.format(hook, script))
-                logging.debug([script_file] + args)
-                p = subprocess.Popen([script_file] + args,
-                                     stdin=subprocess.PIPE)
-                p.stdin.write(stdin)
-                p.stdin.close()
-                ret = p.wait()
+                scripts.append((script, script_file))
 
+            if len(scripts) > 1 and stage['max-parallel'] != 1:
+                ret = self._run_parallel(repo, hook, scripts, args, stdin,
+                                         stage, cwd, env, deadline)
+                if ret != 0:
+                    return ret
+                continue
+
+            for script, script_file in scripts:
+                ret = self._run_script(repo, hook, script, script_file, args,
+                                       stdin, stage=stage, cwd=cwd, env=env,
+                                       deadline=deadline)
                 if ret != 0:
                     msg = 'Received non-zero return code from {0}'.format(
                           script)
                     logging.info(msg)
                     return ret
         return 0
+
+    def _queue_job(self, repo, hook, plan, args, stdin, cwd=None):
+        """Queue the stages of a hook plan to be run in the background
+
+        The hook's args, environment, working directory and input are
+        recorded with the job, and a queue worker is started if none
+        is running."""
+
+        with self.tracer.span('queue', repo=repo, hook=hook):
+            job = {
+                'repo': repo,
+                'hook': hook,
+                'stages': plan,
+                'args': list(args),
+                'env': dict(os.environ),
+                'cwd': os.path.realpath(cwd or os.path.curdir),
+                'attempts': 0,
+            }
+            name = self.queue.put(job, stdin)
+        logging.info('Queued {0} hook job {1}'.format(hook, name))
+        self._start_worker()
+
+    def _start_worker(self):
+        """Start a detached queue worker unless one is running
+
+        A running worker checks for new jobs after releasing the
+        queue lock, so it picks up jobs queued while it finishes."""
+
+        lock = self.queue.lock()
+        if lock is None:
+            return
+        self.queue.unlock(lock)
+        command = [sys.executable, self._script_name(),
+                   '--config={0}'.format(os.path.realpath(self.config_file))]
+        if self.cache_file is not None:
+            command.append('--cache={0}'.format(
+                os.path.realpath(self.cache_file)))
+        command += self.wrapper_options + ['--drain']
+        with open(os.devnull, 'r+b') as devnull:
+            # A new session, so the worker outlives git and the hook
+            subprocess.Popen(command, stdin=devnull, stdout=devnull,
+                             stderr=devnull, close_fds=True,
+                             preexec_fn=os.setsid)
+
+    def drain_queue(self):
+        """Run queued hook jobs until the queue is empty
+
+        Up to the async-jobs global option jobs are run at once. A job
+        whose scripts fail is tried again, up to async-retries times,
+        and then left in the failed directory of the queue. The first
+        retry waits async-backoff seconds, doubling for each retry
+        after that. Returns immediately if another worker is draining
+        the queue."""
+
+        if self.queue is None:
+            logging.warn('No async-queue is configured')
+            return
+        g_conf = self.config.global_config
+        jobs = g_conf.get('async-jobs', async_jobs)
+        retries = g_conf.get('async-retries', async_retries)
+        backoff = g_conf.get('async-backoff', async_backoff)
+        while True:
+            lock = self.queue.lock()
+            if lock is None:
+                return
+            try:
+                self.queue.recover()
+                while True:
+                    names = self.queue.ready()
+                    if names:
+                        self._map(lambda name: self._run_queued(
+                            name, retries, backoff), names, jobs)
+                        continue
+                    names = self.queue.pending()
+                    if not names:
+                        break
+                    # Wait for the first job held back by its backoff
+                    time.sleep(max(0, self.queue.due(names[0]) -
+                                   time.time()))
+            finally:
+                self.queue.unlock(lock)
+            # Jobs queued while the lock was being released
+            if not self.queue.pending():
+                return
+
+    def _run_queued(self, name, retries, backoff=async_backoff):
+        """Run a queued job, then remove, retry or fail it"""
+
+        job = self.queue.claim(name)
+        stdin = self.queue.input(job)
+        try:
+            ret = self._run_stages(job['repo'], job['hook'], job['stages'],
+                                   job['args'], StdinSpool(stdin),
+                                   job['cwd'], job['env'])
+        except Exception as e:
+            logging.error('Could not run {0} hook job {1}: {2}'.format(
+                job['hook'], name, e))
+            ret = -1
+        finally:
+            stdin.close()
+        if ret == 0:
+            self.queue.done(name, job)
+            return
+        job['attempts'] += 1
+        if job['attempts'] < retries:
+            delay = backoff * 2 ** (job['attempts'] - 1)
+            logging.warn('{0} hook job {1} failed, retrying in {2} '
+                         'seconds'.format(job['hook'], name, delay))
+            self.queue.retry(name, job, delay)
+        else:
+            logging.error('{0} hook job {1} failed {2} times'.format(
+                job['hook'], name, job['attempts']))
+            self.queue.fail(name, job)
+
+    def _exec_single_script(self, repo, hook, plan, args):
+        """Replace this process with the script of a single script plan
+
+        Returns if the plan has more than one script, or its script is
+        not run directly: in a dry run, when it is missing or not
+        executable (as reported by _run_hook), its result is cached,
+        it is subject to a timeout or the process limit, or its run is
+        to be traced. Hook input has not been read, so the script
+        inherits it."""
+
+        if self.dry_run or self.tracer.trace_file is not None or \
+                len(plan) != 1 or \
+                len(plan[0]['scripts']) != 1 or \
+                (plan[0]['cache'] and self.result_cache is not None) or \
+                plan[0]['timeout'] or plan[0]['hook-timeout'] or \
+                self.process_slots is not None:
+            return
+        script = plan[0]['scripts'][0]
+        entry = self.config.scripts.lookup(hook, script)
+        if entry is None or not entry['executable']:
+            return
+
+        logging.info('Running {0} hook {1} in place'.format(hook, script))
+        logging.debug([entry['path']] + args)
+        for handler in logging.getLogger().handlers:
+            handler.flush()
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os.execv(entry['path'], [entry['path']] + args)
+
+    def _result_key(self, hook, script, args, stdin):
+        """Returns the result cache key of a script run"""
+        scripts = self.config.scripts
+        entry = scripts.lookup(hook, script)
+        return ResultCache.key(entry['path'], scripts.digest(entry), hook,
+                               marshal.dumps(list(args)), stdin.digest())
+
+    def _run_script(self, repo, hook, script, script_file, args, stdin,
+                    started=None, stage=None, cwd=None, env=None,
+                    deadline=None):
+        """Run a hook script from cwd, replaying the stdin spool to it
+
+        The script is run with the environment env if given. If
+        started is given it is called with the process once it has
+        been spawned.
+
+        The options of the plan stage of the script apply. With the
+        cache option and a configured result cache, a result recorded
+        within cache-ttl seconds (or at any time if 0) for the same
+        script, args and input is replayed instead of running the
+        script, and new results are recorded. A script running past
+        its timeout or the hook deadline (a time.time() value) has its
+        process group killed, and exits with timeout_exit_code or 0
+        according to the timeout-policy.
+
+        Returns the exit code of the script."""
+
+        stage = stage or {}
+        logging.info('Running {0} hook {1}'.format(hook, script))
+        logging.debug([script_file] + args)
+        with self.tracer.span('script', repo=repo, hook=hook,
+                              script=script) as span:
+            key = None
+            output = None
+            if stage.get('cache') and self.result_cache is not None:
+                key = self._result_key(hook, script, args, stdin)
+                result = self.result_cache.get(key, stage['cache-ttl'])
+                if result is not None:
+                    logging.info('Using cached result of {0} hook '
+                                 '{1}'.format(hook, script))
+                    span['cached'] = True
+                    span['exit'] = result['exit']
+                    self._write_output(result['stdout'], result['stderr'])
+                    return span['exit']
+                # Capture output to be recorded
+                output = (tempfile.TemporaryFile(), tempfile.TemporaryFile())
+
+            if stage.get('timeout'):
+                timeout = time.time() + stage['timeout']
+                deadline = min(deadline or timeout, timeout)
+
+            slot = None
+            if self.process_slots is not None:
+                start = time.time()
+                slot_deadline = deadline
+                if self.process_slots.wait:
+                    slot_deadline = min(deadline or float('inf'),
+                                        start + self.process_slots.wait)
+                slot = self.process_slots.acquire(slot_deadline)
+                span['slot_duration'] = time.time() - start
+            try:
+                if slot is None and self.process_slots is not None:
+                    # Timed out waiting for a free slot
+                    logging.warn('No free process slot for {0} hook '
+                                 '{1}'.format(hook, script))
+                    span['exit'] = None
+                elif deadline is not None and time.time() >= deadline:
+                    # Not started before the hook deadline
+                    span['exit'] = None
+                else:
+                    span['exit'] = self._spawn(script_file, args, stdin,
+                                               started, cwd, env, output,
+                                               deadline, span)
+            finally:
+                if slot is not None:
+                    self.process_slots.release(slot)
+
+            if output is not None:
+                stdout, stderr = [self._read_output(f) for f in output]
+                self._write_output(stdout, stderr)
+                # Scripts killed by a signal, eg. when cancelled, or
+                # timed out have no result worth keeping
+                if span['exit'] is not None and span['exit'] >= 0:
+                    self.result_cache.put(key, span['exit'], stdout, stderr)
+
+            if span['exit'] is None:
+                span['timeout'] = True
+                logging.warn('{0} hook {1} timed out'.format(hook, script))
+                if stage.get('timeout-policy', 'fail') == 'fail':
+                    span['exit'] = timeout_exit_code
+                else:
+                    span['exit'] = 0
+        return span['exit']
+
+    def _spawn(self, script_file, args, stdin, started, cwd, env, output,
+               deadline, span):
+        """Start a script and wait for it to exit
+
+        With a deadline the script is run in its own process group,
+        which is killed if the script is still running at the
+        deadline. Returns the exit code, or None if the script was
+        killed at the deadline."""
+
+        start = time.time()
+        # Close other descriptors so concurrently running scripts do
+        # not hold open each other's input pipes.
+        p = subprocess.Popen([script_file] + args, cwd=cwd, env=env,
+                             stdin=subprocess.PIPE,
+                             stdout=output and output[0],
+                             stderr=output and output[1],
+                             close_fds=True,
+                             preexec_fn=deadline and _new_process_group)
+        span['spawn_duration'] = time.time() - start
+        if started is not None:
+            started(p)
+        writer = stdin.feed(p.stdin, span)
+        start = time.time()
+        try:
+            return _wait(p, deadline)
+        finally:
+            span['wait_duration'] = time.time() - start
+            # Let the writer finish recording its stats in the span. A
+            # process the script left running may hold the pipe open
+            # without reading it, so only wait briefly.
+            writer.join(self.stdin_join_timeout)
+
+    def _read_output(self, f):
+        f.seek(0)
+        data = f.read()
+        f.close()
+        return data
+
+    def _write_output(self, stdout, stderr):
+        """Write recorded script output to our own output"""
+        for out, data in ((sys.stdout, stdout), (sys.stderr, stderr)):
+            if data:
+                out.write(data)
+                out.flush()
+
+    def _run_parallel(self, repo, hook, scripts, args, stdin, stage, cwd=None,
+                      env=None, deadline=None):
+        """Run the scripts of a plan stage concurrently
+
+        Scripts are run as by _run_script. At most the max-parallel
+        option of the stage scripts run at once (0 for no limit).
+        Returns 0 if all scripts succeeded or the exit code of the
+        first script to fail, -1 for a script that could not be run.
+        With the cancel-on-failure option the
+        remaining scripts are terminated, or not started, once a
+        script has failed."""
+
+        max_parallel = stage['max-parallel']
+        cancel = stage['cancel-on-failure']
+        if max_parallel < 1:
+            max_parallel = len(scripts)
+        slots = threading.BoundedSemaphore(max_parallel)
+        lock = threading.Lock()
+        running = []
+        state = {'ret': 0}
+
+        def started(p):
+            with lock:
+                running.append(p)
+                if cancel and state['ret'] != 0:
+                    p.terminate()
+
+        def run(script, script_file):
+            with slots:
+                with lock:
+                    if cancel and state['ret'] != 0:
+                        logging.info('Cancelled {0} hook {1}'.format(
+                            hook, script))
+                        return
+                try:
+                    ret = self._run_script(repo, hook, script, script_file,
+                                           args, stdin, started, stage, cwd,
+                                           env, deadline)
+                except Exception as e:
+                    # Fail the stage rather than lose the error with
+                    # this thread
+                    logging.error('Could not run {0} hook {1}: {2}'.format(
+                        hook, script, e))
+                    ret = -1
+            with lock:
+                if ret == 0 or state['ret'] != 0:
+                    return
+                state['ret'] = ret
+                logging.info('Received non-zero return code from '
+                             '{0}'.format(script))
+                if cancel:
+                    for p in running:
+                        if p.poll() is None:
+                            p.terminate()
+
+        threads = [threading.Thread(target=run, args=x) for x in scripts]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return state['ret']
+
+
+def _read_config_list(config_list):
+    """Returns the config files listed in a config list file
+
+    Each line names a config file, relative to the directory of the
+    list. Blank lines and lines starting with # are ignored."""
+
+    base = os.path.dirname(os.path.abspath(config_list))
+    config_files = []
+    with open(config_list) as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                config_files.append(os.path.join(base, line))
+    return config_files
+
+
+def _config_file_name(path, config_file):
+    """Returns the name of the file of a config in a CptHookSet to use
+    in place of path, eg. hook.manifest.1a2b3c4d"""
+    digest = hashlib.sha1(os.path.realpath(config_file)).hexdigest()
+    return '{0}.{1}'.format(path, digest[:8])
+
+
+class CptHookSet(object):
+
+    def __init__(self, config_list, cache_file=None):
+        """Several cpthook configs managing the repositories of a host
+
+        config_list is a file listing the config files in precedence
+        order (see _read_config_list). A repository claimed by more
+        than one config is managed by the first of them and the
+        conflict is reported. The configs share a RepoLocator for each
+        repo-path, the listing of each search path, so one listed by
+        several configs is scanned once, the git repository detection
+        cache and one pool of jobs threads.
+
+        Options are set on the CptHookSet as on a CptHook and applied
+        to the CptHook of each config when updating hooks. Each config
+        has its own cache_file and manifest_file (see
+        _config_file_name)."""
+        self.config_list = config_list
+        self.config_files = _read_config_list(config_list)
+        if not self.config_files:
+            raise ValueError('No config files listed in {0}'.format(
+                config_list))
+        seen = set()
+        for config_file in self.config_files:
+            if os.path.realpath(config_file) in seen:
+                raise ValueError('{0} is listed more than once'.format(
+                    config_file))
+            seen.add(os.path.realpath(config_file))
+
+        self.hooks = []
+        locators = {}
+        listings = _DirListings()
+        git_repo_cache = {}
+        for config_file in self.config_files:
+            try:
+                cpt = CptHook(config_file, cache_file=cache_file and
+                              _config_file_name(cache_file, config_file))
+            except Exception:
+                logging.error('Invalid cpthook config file {0}'.format(
+                    config_file))
+                raise
+            repo_path = tuple(cpt.config.global_config['repo-path'])
+            if repo_path not in locators:
+                locators[repo_path] = RepoLocator(list(repo_path),
+                                                  listings)
+            cpt._locator = locators[repo_path]
+            cpt._git_repo_cache = git_repo_cache
+            self.hooks.append(cpt)
+        self._claims = None
+
+        self.dry_run = False
+        self.socket_path = None
+        self.strict_repo_detection = False
+        self.manifest_file = None
+        self.jobs = 1
+        self.sync = False
+        self.compile_wrappers = False
+        self.wrapper_options = []
+        self.tracer = HookTracer()
+
+    def _configure(self):
+        """Apply the options of the set to the CptHook of each config"""
+        for cpt in self.hooks:
+            cpt.dry_run = self.dry_run
+            cpt.socket_path = self.socket_path
+            cpt.strict_repo_detection = self.strict_repo_detection
+            cpt.manifest_file = self.manifest_file and _config_file_name(
+                self.manifest_file, cpt.config_file)
+            cpt.jobs = self.jobs
+            cpt.sync = self.sync
+            cpt.compile_wrappers = self.compile_wrappers
+            cpt.wrapper_options = list(self.wrapper_options)
+            cpt.tracer = self.tracer
+
+    def claims(self):
+        """Returns a dict of repository name to the CptHooks of the
+        configs claiming the repository, in precedence order
+
+        Each CptHook is told which repositories other configs manage
+        (see CptHook.other_repos)."""
+
+        if self._claims is None:
+            for cpt in self.hooks:
+                cpt.other_repos = {}
+            claims = {}
+            for cpt in self.hooks:
+                for repo in cpt._managed_repos():
+                    claims.setdefault(repo, []).append(cpt)
+            for repo, cpts in claims.items():
+                for cpt in self.hooks:
+                    if cpt is not cpts[0]:
+                        cpt.other_repos[repo] = cpts[0]
+            self._claims = claims
+        return self._claims
+
+    def conflicts(self):
+        """Returns a sorted list of the repositories claimed by more
+        than one config, each with the claiming config files in
+        precedence order"""
+        return sorted((repo, [cpt.config_file for cpt in cpts])
+                      for repo, cpts in self.claims().items()
+                      if len(cpts) > 1)
+
+    def problems(self):
+        """Returns messages describing the scripts of each config that
+        would not be run and the conflicting claims to repositories"""
+
+        problems = []
+        for cpt in self.hooks:
+            problems += ['{0}: {1}'.format(cpt.config_file, problem)
+                         for problem in cpt.config.script_problems()]
+        for repo, config_files in self.conflicts():
+            problems.append('Repo {0} is claimed by {1}, using {2}'.format(
+                repo, ' '.join(config_files), config_files[0]))
+        return problems
+
+    def update_hooks(self):
+        """Install the hooks of every config and remove unmanaged
+        wrappers
+
+        Each config is updated as by CptHook.update_hooks, but the
+        work of all configs is run on one pool of jobs threads. If
+        any config makes a full update, repos below every repo-path
+        are scanned once for wrappers not configured by the config
+        managing the repository."""
+
+        self._configure()
+        for repo, config_files in self.conflicts():
+            logging.warn('Repo {0} is claimed by {1}, using {2}'.format(
+                repo, ' '.join(config_files), config_files[0]))
+
+        work = [cpt._update_calls() for cpt in self.hooks]
+        first = self.hooks[0]
+        results = first._map(_call, [call for calls, _, _ in work
+                                     for call in calls])
+        if any(full for _, _, full in work):
+            self.remove_unmanaged_hooks()
+        offset = 0
+        for calls, finish, _ in work:
+            finish(results[offset:offset + len(calls)])
+            offset += len(calls)
+
+        # Sync the writes of every config together
+        for cpt in self.hooks[1:]:
+            first._written_paths.update(cpt._written_paths)
+            cpt._written_paths = set()
+        first._sync_writes()
+
+    def remove_unmanaged_hooks(self):
+        """Remove cpthook wrappers from repos below every repo-path
+        that are not configured by the config managing the repository"""
+
+        self._configure()
+        self.claims()
+        paths = []
+        locators = []
+        for cpt in self.hooks:
+            if cpt.locator not in locators:
+                locators.append(cpt.locator)
+                paths += cpt.locator.paths()
+        # Repositories of other configs are looked up by the first
+        self.hooks[0].remove_unmanaged_hooks(paths)
+
+
+def _new_process_group():
+    """Make the calling process the leader of a new process group"""
+    os.setpgid(0, 0)
+
+
+def _wait(p, deadline=None, grace=2.0):
+    """Wait for a process, killing its process group at the deadline
+
+    The group is sent SIGTERM and then, if the process is still
+    running after grace seconds, SIGKILL. Returns the exit code of the
+    process, or None if it was killed."""
+
+    if deadline is None:
+        return p.wait()
+    delay = 0.005
+    while p.poll() is None:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            break
+        time.sleep(min(delay, remaining))
+        delay = min(delay * 2, 0.1)
+    else:
+        return p.returncode
+
+    try:
+        os.killpg(p.pid, signal.SIGTERM)
+    except OSError:
+        pass
+    end = time.time() + grace
+    while p.poll() is None and time.time() < end:
+        time.sleep(0.01)
+    try:
+        # Also kill whatever the script left running in its group
+        os.killpg(p.pid, signal.SIGKILL)
+    except OSError:
+        pass
+    p.wait()
+    return None
+
+
+def _call(function):
+    """Returns the result of calling function (see CptHook._map)"""
+    return function()
+
+
+def _native_str(value):
+    """Returns value as a native str, encoding unicode as UTF-8"""
+    if not isinstance(value, str):
+        return value.encode('utf-8')
+    return value
+
+
+class CptHookDaemon(object):
+
+    # Seconds between checks for shutdown and exited children
+    poll_interval = 1.0
+
+    def __init__(self, config_file, socket_path, cache_file=None,
+                 tracer=None):
+        """A long running cpthook serving hooks over a Unix socket
+
+        The daemon holds the resolved configuration in memory and
+        reloads it when the config file changes. Each hook invocation
+        sent by a daemon wrapper (see CptHook.socket_path) is run in
+        a forked child, which needs neither interpreter startup nor
+        config parsing.
+
+        A wrapper sends a JSON request line holding the hook, args,
+        cwd and environment, followed by the hook input. The daemon
+        replies with frames of a channel byte and a 4 byte length:
+        'o' and 'e' carry script stdout and stderr, 'x' the exit
+        code. Hook execution is traced with tracer if given."""
+        self.config_file = config_file
+        self.cache_file = cache_file
+        self.socket_path = socket_path
+        self._running = False
+        self._children = set()
+        self.tracer = tracer or HookTracer()
+        self._load()
+
+    def _config_stamp(self):
+        st = os.stat(self.config_file)
+        return st.st_mtime, st.st_size
+
+    def _load(self):
+        stamp = self._config_stamp()
+        self.cpt = CptHook(self.config_file, cache_file=self.cache_file)
+        self.cpt.tracer = self.tracer
+        self._stamp = stamp
+
+    def _reload_if_changed(self):
+        """Reload the config if the config file has changed
+
+        An invalid config is reported and the previous config kept."""
+
+        try:
+            stamp = self._config_stamp()
+        except OSError:
+            logging.warn('Could not stat {0}'.format(self.config_file))
+            return
+        if stamp == self._stamp:
+            return
+        try:
+            self._load()
+            logging.info('Reloaded config {0}'.format(self.config_file))
+        except Exception as e:
+            # Only retry once the config changes again
+            self._stamp = stamp
+            logging.warn('Keeping previous config. Could not load {0}: '
+                         '{1}'.format(self.config_file, e))
+
+    def _reap(self):
+        """Collect exited children"""
+        for pid in list(self._children):
+            try:
+                done, _ = os.waitpid(pid, os.WNOHANG)
+            except OSError:
+                done = pid
+            if done:
+                self._children.discard(pid)
+
+    def serve_forever(self):
+        """Accept and run hook invocations until shutdown is called"""
+
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # Only the user running the daemon may connect
+        umask = os.umask(0077)
+        try:
+            listener.bind(self.socket_path)
+        finally:
+            os.umask(umask)
+        listener.listen(64)
+        listener.settimeout(self.poll_interval)
+        logging.info('Listening on {0}'.format(self.socket_path))
+
+        self._running = True
+        try:
+            while self._running:
+                self._reap()
+                try:
+                    conn, _ = listener.accept()
+                except socket.timeout:
+                    continue
+                conn.settimeout(None)
+                self._reload_if_changed()
+                pid = os.fork()
+                if pid == 0:
+                    listener.close()
+                    ret = 1
+                    try:
+                        self._handle(conn)
+                        ret = 0
+                    except Exception:
+                        logging.exception('Failed to run hook')
+                    os._exit(ret)
+                self._children.add(pid)
+                conn.close()
+        finally:
+            listener.close()
+            try:
+                os.remove(self.socket_path)
+            except OSError:
+                pass
+
+    def shutdown(self):
+        """Stop serving after the current poll interval"""
+        self._running = False
+
+    def _pump(self, fd, channel, send):
+        """Send everything read from fd as frames of a channel"""
+        while True:
+            data = os.read(fd, 65536)
+            if not data:
+                break
+            try:
+                send(channel, data)
+            except socket.error:
+                # Client went away. Keep draining the pipe.
+                pass
+        os.close(fd)
+
+    def _handle(self, conn):
+        """Run one hook invocation in a forked child"""
+
+        request = conn.makefile('rb', 0)
+        data = json.loads(request.readline())
+        hook = _native_str(data['hook'])
+        args = [_native_str(x) for x in data['args']]
+        os.chdir(_native_str(data['cwd']))
+        os.environ.clear()
+        for key, value in data['env'].items():
+            os.environ[_native_str(key)] = _native_str(value)
+
+        lock = threading.Lock()
+
+        def send(channel, data):
+            with lock:
+                conn.sendall(struct.pack('!cI', channel, len(data)) + data)
+
+        # Relay output of the hook scripts (and our logging) to the
+        # client through pipes replacing stdout and stderr.
+        pumps = []
+        for fd, channel in ((1, 'o'), (2, 'e')):
+            r, w = os.pipe()
+            os.dup2(w, fd)
+            os.close(w)
+            pump = threading.Thread(target=self._pump,
+                                    args=(r, channel, send))
+            pump.start()
+            pumps.append(pump)
+
+        try:
+            ret = self.cpt.run_hook(hook, args, stdin=request)
+        except Exception:
+            logging.exception('Failed to run {0} hook'.format(hook))
+            ret = -1
+
+        sys.stdout.flush()
+        sys.stderr.flush()
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(devnull, 1)
+        os.dup2(devnull, 2)
+        for pump in pumps:
+            pump.join()
+        send('x', str(ret))
+        conn.close()
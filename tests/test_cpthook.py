@@ -0,0 +1,1218 @@
+import json
+import logging
+import os
+import os.path
+import shutil
+import stat
+import subprocess
+import tempfile
+import threading
+import time
+import unittest
+from StringIO import StringIO
+
+import cpthook
+
+
+class LogCapture(logging.Handler):
+    """Collects the messages logged while in use as a context manager"""
+
+    def __init__(self, level=logging.INFO):
+        logging.Handler.__init__(self)
+        self.log_level = level
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+    def __enter__(self):
+        root = logging.getLogger()
+        self.orig_level = root.level
+        root.setLevel(self.log_level)
+        root.addHandler(self)
+        return self
+
+    def __exit__(self, *exc_info):
+        root = logging.getLogger()
+        root.removeHandler(self)
+        root.setLevel(self.orig_level)
+
+
+class HookEnvironment(object):
+    """A temporary cpthook admin directory and repository farm"""
+
+    def __init__(self, config, scripts, settings=''):
+        """Create hooks.d scripts and a bare repo for each repo named
+
+        config is the body of the config file after the cpthook block.
+        scripts maps 'hook-type/name' to the body of a shell script.
+        settings are further lines of the cpthook block."""
+
+        self.root = tempfile.mkdtemp()
+        self.script_path = os.path.join(self.root, 'hooks.d')
+        self.repo_path = os.path.join(self.root, 'repos')
+        os.mkdir(self.repo_path)
+        for name, body in scripts.items():
+            script = os.path.join(self.script_path, name)
+            if not os.path.isdir(os.path.dirname(script)):
+                os.makedirs(os.path.dirname(script))
+            with open(script, 'w') as f:
+                f.write('#!/bin/sh\n' + body)
+            os.chmod(script, 0755)
+        self.config_file = os.path.join(self.root, 'hook.cfg')
+        self.settings = settings
+        self.write_config(config)
+
+    def cpthook(self):
+        """Returns a CptHook for the config installing wrappers that
+        run the cpthook program in this source tree"""
+
+        cpt = cpthook.CptHook(self.config_file)
+        cpthook_path = os.path.join(
+            os.path.dirname(os.path.realpath(cpthook.__file__)), 'cpthook')
+        cpt._script_name = lambda: cpthook_path
+        return cpt
+
+    def write_config(self, config):
+        with open(self.config_file, 'w') as f:
+            f.write('[cpthook]\nscript-path = {0}\nrepo-path = {1}\n{2}\n'
+                    .format(self.script_path, self.repo_path, self.settings))
+            f.write(config)
+
+    def add_repo(self, name):
+        path = os.path.join(self.repo_path, name + '.git')
+        with open(os.devnull, 'wb') as devnull:
+            subprocess.check_call(['git', 'init', '--bare', path],
+                                  stdout=devnull, stderr=devnull)
+        return path
+
+    def run_hook(self, repo, hook, args=None, stdin='', tracer=None):
+        """Run hook in repo as git would, returning its exit code"""
+
+        cpt = cpthook.CptHook(self.config_file)
+        if tracer is not None:
+            cpt.tracer = tracer
+        orig_dir = os.getcwd()
+        orig_stdin = cpthook.sys.stdin
+        os.chdir(os.path.join(self.repo_path, repo + '.git'))
+        cpthook.sys.stdin = StringIO(stdin)
+        try:
+            return cpt.run_hook(hook, args or [])
+        finally:
+            cpthook.sys.stdin = orig_stdin
+            os.chdir(orig_dir)
+
+    def run_wrapper(self, repo, hook, args=None, stdin=''):
+        """Run the installed wrapper for hook in repo as git would
+
+        Returns the exit code, stdout and stderr of the wrapper."""
+
+        repo_path = os.path.join(self.repo_path, repo + '.git')
+        p = subprocess.Popen([os.path.join(repo_path, 'hooks', hook)] +
+                             (args or []), cwd=repo_path,
+                             stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                             stderr=subprocess.PIPE)
+        out, err = p.communicate(stdin)
+        return p.returncode, out, err
+
+    def path(self, *names):
+        return os.path.join(self.root, *names)
+
+    def cleanup(self):
+        shutil.rmtree(self.root)
+
+
+class RunHookTests(unittest.TestCase):
+
+    def tearDown(self):
+        self.env.cleanup()
+
+    def test_sequential_fail_fast(self):
+        """Scripts after a failing script are not run"""
+        self.env = HookEnvironment(
+            '[repos test]\nmembers = repo1\nhooks = hooks1\n'
+            '[hooks hooks1]\npre-receive = fail.sh after.sh\n',
+            {'pre-receive/fail.sh': 'exit 3\n',
+             'pre-receive/after.sh': 'touch "$1"\n'})
+        self.env.add_repo('repo1')
+        marker = self.env.path('after')
+        ret = self.env.run_hook('repo1', 'pre-receive', [marker])
+        self.assertEqual(ret, 3)
+        self.assertFalse(os.path.exists(marker))
+
+    def test_parallel_stage(self):
+        """Scripts in a parallel stage run concurrently"""
+        # Each script waits for the other to have started
+        wait = ('touch "$1/$2"; i=0\n'
+                'while [ ! -e "$1/$3" ]; do\n'
+                '  i=$((i+1)); [ $i -gt 50 ] && exit 1; sleep 0.1\n'
+                'done\n')
+        self.env = HookEnvironment(
+            '[repos test]\nmembers = repo1\nhooks = hooks1\n'
+            '[hooks hooks1]\nparallel = true\n'
+            'post-receive = a.sh b.sh | c.sh\n',
+            {'post-receive/a.sh': 'set -- "$1" a b\n' + wait,
+             'post-receive/b.sh': 'set -- "$1" b a\n' + wait,
+             'post-receive/c.sh': 'touch "$1/c"\n'})
+        self.env.add_repo('repo1')
+        ret = self.env.run_hook('repo1', 'post-receive', [self.env.root])
+        self.assertEqual(ret, 0)
+        self.assertTrue(os.path.exists(self.env.path('c')))
+
+    def test_parallel_cancel_on_failure(self):
+        """A failing script terminates its siblings"""
+        self.env = HookEnvironment(
+            '[repos test]\nmembers = repo1\nhooks = hooks1\n'
+            '[hooks hooks1]\nparallel = true\ncancel-on-failure = true\n'
+            'post-receive = slow.sh fail.sh\n',
+            {'post-receive/slow.sh': ('for i in 1 2 3 4 5 6 7 8 9 10; do\n'
+                                      '  sleep 0.5\n'
+                                      'done\n'
+                                      'touch "$1"\n'),
+             'post-receive/fail.sh': 'exit 2\n'})
+        self.env.add_repo('repo1')
+        marker = self.env.path('slow')
+        ret = self.env.run_hook('repo1', 'post-receive', [marker])
+        self.assertEqual(ret, 2)
+        self.assertFalse(os.path.exists(marker))
+
+    def test_parallel_unrunnable(self):
+        """A parallel stage fails if one of its scripts cannot be run"""
+        self.env = HookEnvironment(
+            '[repos test]\nmembers = repo1\nhooks = hooks1\n'
+            '[hooks hooks1]\nparallel = true\n'
+            'pre-receive = ok.sh broken.sh\n',
+            {'pre-receive/ok.sh': 'exit 0\n',
+             'pre-receive/broken.sh': 'exit 0\n'})
+        with open(self.env.path('hooks.d', 'pre-receive', 'broken.sh'),
+                  'w') as f:
+            f.write('#!/nonexistent/interpreter\n')
+        self.env.add_repo('repo1')
+        ret = self.env.run_hook('repo1', 'pre-receive')
+        self.assertEqual(ret, -1)
+
+    def test_stdin_replay(self):
+        """Each script receives the complete hook input"""
+        self.env = HookEnvironment(
+            '[repos test]\nmembers = repo1\nhooks = hooks1 hooks2\n'
+            '[hooks hooks1]\npost-receive = a.sh\n'
+            '[hooks hooks2]\nparallel = true\npost-receive = b.sh c.sh\n',
+            {'post-receive/a.sh': 'cat > "$1/a"\n',
+             'post-receive/b.sh': 'cat > "$1/b"\n',
+             'post-receive/c.sh': 'cat > "$1/c"\n'})
+        self.env.add_repo('repo1')
+        # Larger than the in-memory spool limit
+        stdin = ''.join('{0:040x} {1:040x} refs/heads/b{0}\n'.format(i, i + 1)
+                        for i in range(40000))
+        ret = self.env.run_hook('repo1', 'post-receive', [self.env.root],
+                                stdin)
+        self.assertEqual(ret, 0)
+        for name in ('a', 'b', 'c'):
+            with open(self.env.path(name)) as f:
+                self.assertEqual(f.read(), stdin)
+
+    def test_stdin_not_read(self):
+        """A script may exit without reading its input"""
+        self.env = HookEnvironment(
+            '[repos test]\nmembers = repo1\nhooks = hooks1\n'
+            '[hooks hooks1]\npre-receive = a.sh\n',
+            {'pre-receive/a.sh': 'exit 0\n'})
+        self.env.add_repo('repo1')
+        ret = self.env.run_hook('repo1', 'pre-receive', [], 'x' * 1000000)
+        self.assertEqual(ret, 0)
+
+    def test_exec_single_script(self):
+        """A single script replaces the cpthook process"""
+        self.env = HookEnvironment(
+            '[repos test]\nmembers = repo1 repo2\nhooks = hooks1\n'
+            '[repos two]\nmembers = repo2\nhooks = hooks2\n'
+            '[hooks hooks1]\npost-receive = a.sh\n'
+            '[hooks hooks2]\npost-receive = b.sh\n',
+            {'post-receive/a.sh': ('cat\n'
+                                   'tr "\\0" " " < /proc/$PPID/cmdline\n'),
+             'post-receive/b.sh': 'exit 0\n'})
+        self.env.add_repo('repo1')
+        self.env.add_repo('repo2')
+        self.env.cpthook().install_hooks()
+        ret, out, _ = self.env.run_wrapper('repo1', 'post-receive', [],
+                                           'old new ref\n')
+        self.assertEqual(ret, 0)
+        self.assertTrue(out.startswith('old new ref\n'))
+        self.assertFalse('--hook=' in out)
+        # With two scripts cpthook runs them as its children
+        ret, out, _ = self.env.run_wrapper('repo2', 'post-receive', [],
+                                           'old new ref\n')
+        self.assertEqual(ret, 0)
+        self.assertTrue('--hook=' in out)
+
+    def test_exec_traced(self):
+        """A traced hook runs its single script as a child"""
+        self.env = HookEnvironment(
+            '[repos test]\nmembers = repo1\nhooks = hooks1\n'
+            '[hooks hooks1]\npost-receive = a.sh\n',
+            {'post-receive/a.sh': 'exit 0\n'})
+        self.env.add_repo('repo1')
+        trace = self.env.path('trace')
+        cpt = self.env.cpthook()
+        cpt.wrapper_options = ['--trace={0}'.format(trace)]
+        cpt.install_hooks()
+        ret, _, _ = self.env.run_wrapper('repo1', 'post-receive')
+        self.assertEqual(ret, 0)
+        stats = cpthook.trace_stats(trace)
+        self.assertEqual(stats['script']['post-receive/a.sh']['count'], 1)
+        self.assertEqual(stats['repo']['repo1']['count'], 1)
+
+    def test_nested_repo_path(self):
+        """Hooks run for a repository below nested repo-path entries"""
+        config = ('[repos test]\nmembers = foo\nhooks = hooks1\n'
+                  '[hooks hooks1]\npre-receive = a.sh\n')
+        self.env = HookEnvironment(config, {
+            'pre-receive/a.sh': 'echo run >> "$0.log"\n'})
+        repo = self.env.add_repo('team/foo')
+        self.env.repo_path = '{0} {1}'.format(
+            self.env.repo_path, os.path.join(self.env.repo_path, 'team'))
+        self.env.write_config(config)
+        self.env.cpthook().install_hooks()
+        orig_dir = os.getcwd()
+        os.chdir(repo)
+        try:
+            ret = cpthook.CptHook(self.env.config_file).run_hook(
+                'pre-receive', [], StringIO(''))
+        finally:
+            os.chdir(orig_dir)
+        self.assertEqual(ret, 0)
+        self.assertTrue(os.path.exists(
+            self.env.path('hooks.d', 'pre-receive', 'a.sh.log')))
+
+    def test_lazy_config_error(self):
+        """A config error found running a hook is reported"""
+        self.env = HookEnvironment(
+            '[repos test]\nmembers = repo1\nhooks = hooks1\n'
+            '[hooks hooks1]\npost-receive = a.sh\n',
+            {'post-receive/a.sh': 'exit 0\n'})
+        self.env.add_repo('repo1')
+        self.env.cpthook().install_hooks()
+        self.env.write_config('[repos test]\nmembers = repo1\n'
+                              'hooks = missing\n')
+        ret, out, _ = self.env.run_wrapper('repo1', 'post-receive')
+        self.assertEqual(ret, 255)
+        self.assertIn('Invalid cpthook config file', out)
+
+    def test_timeout(self):
+        """A script overrunning its timeout has its group killed"""
+        self.env = HookEnvironment(
+            '[repos test]\nmembers = repo1\nhooks = hooks1\n'
+            '[hooks hooks1]\ntimeout = 1\npre-receive = slow.sh after.sh\n',
+            {'pre-receive/slow.sh': '(sleep 2; touch "$1") &\nsleep 10\n',
+             'pre-receive/after.sh': 'touch "$1.after"\n'})
+        self.env.add_repo('repo1')
+        marker = self.env.path('slow')
+        start = time.time()
+        ret = self.env.run_hook('repo1', 'pre-receive', [marker])
+        self.assertEqual(ret, cpthook.timeout_exit_code)
+        self.assertTrue(time.time() - start < 5)
+        time.sleep(1.5)
+        self.assertFalse(os.path.exists(marker))
+        self.assertFalse(os.path.exists(marker + '.after'))
+
+    def test_hook_timeout_pass(self):
+        """With the pass policy a timed out script is ignored"""
+        self.env = HookEnvironment(
+            '[repos test]\nmembers = repo1\nhooks = hooks1\n'
+            '[hooks hooks1]\nhook-timeout = 1\ntimeout-policy = pass\n'
+            'pre-receive = slow.sh after.sh\n',
+            {'pre-receive/slow.sh': 'sleep 10\n',
+             'pre-receive/after.sh': 'touch "$1"\n'})
+        self.env.add_repo('repo1')
+        marker = self.env.path('after')
+        ret = self.env.run_hook('repo1', 'pre-receive', [marker])
+        self.assertEqual(ret, 0)
+        # The hook deadline has passed, so after.sh times out too
+        self.assertFalse(os.path.exists(marker))
+
+    def test_process_slot_wait(self):
+        """Without a timeout a script waits for a slot for a bounded time"""
+        config = ('[repos test]\nmembers = repo1\nhooks = hooks1\n'
+                  '[hooks hooks1]\npre-receive = a.sh\n')
+        self.env = HookEnvironment(config, {'pre-receive/a.sh': 'exit 0\n'})
+        slot_path = self.env.path('slots')
+        self.env.settings = ('max-processes = 1\nprocess-slot-wait = 1\n'
+                             'process-slot-path = {0}\n'.format(slot_path))
+        self.env.write_config(config)
+        self.env.add_repo('repo1')
+        # Another hook holds the only slot
+        slots = cpthook.ProcessSlots(slot_path, 1)
+        held = slots.acquire()
+        try:
+            start = time.time()
+            ret = self.env.run_hook('repo1', 'pre-receive')
+            self.assertEqual(ret, cpthook.timeout_exit_code)
+            self.assertTrue(time.time() - start < 5)
+        finally:
+            slots.release(held)
+
+    def test_result_cache(self):
+        """A cached result is replayed for the same input"""
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        self.env = HookEnvironment(
+            '[repos test]\nmembers = repo1\nhooks = hooks1 hooks2\n'
+            '[hooks hooks1]\ncache = true\npre-receive = a.sh\n'
+            '[hooks hooks2]\npre-receive = b.sh\n',
+            {'pre-receive/a.sh': 'cat; echo run >> "$0.log"; exit 0\n',
+             'pre-receive/b.sh': 'echo run >> "$0.log"\n'},
+            settings='result-cache = {0}\n'.format(cache_dir))
+        self.env.add_repo('repo1')
+        orig_stdout = cpthook.sys.stdout
+        try:
+            outputs = []
+            for stdin in ('old new ref\n', 'old new ref\n', 'other\n'):
+                cpthook.sys.stdout = StringIO()
+                ret = self.env.run_hook('repo1', 'pre-receive', [], stdin)
+                self.assertEqual(ret, 0)
+                outputs.append(cpthook.sys.stdout.getvalue())
+        finally:
+            cpthook.sys.stdout = orig_stdout
+        self.assertEqual(outputs, ['old new ref\n', 'old new ref\n',
+                                   'other\n'])
+        for script, runs in (('a.sh', 2), ('b.sh', 3)):
+            log = self.env.path('hooks.d', 'pre-receive', script + '.log')
+            with open(log) as f:
+                self.assertEqual(len(f.readlines()), runs)
+
+
+class AsyncTests(unittest.TestCase):
+
+    config = ('[repos test]\nmembers = repo1\nhooks = hooks1 hooks2\n'
+              '[hooks hooks1]\npost-receive = a.sh\n'
+              '[hooks hooks2]\nasync = true\npost-receive = b.sh\n'
+              'pre-receive = c.sh\n')
+
+    def setUp(self):
+        queue_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, queue_dir)
+        self.env = HookEnvironment(self.config, {
+            'post-receive/a.sh': 'echo a >> "$1"\n',
+            'post-receive/b.sh': ('cat >> "$1"; pwd >> "$1"\n'
+                                  'echo "$CPTHOOK_TEST" >> "$1"\n'
+                                  'exit $(cat "$1.exit" 2>/dev/null)\n'),
+            'pre-receive/c.sh': 'echo c >> "$1"\n'},
+            settings=('async-queue = {0}\nasync-retries = 2\n'
+                      'async-backoff = 0\n'.format(queue_dir)))
+        self.repo1 = self.env.add_repo('repo1')
+        self.log = self.env.path('log')
+        self.workers = []
+
+    def tearDown(self):
+        self.env.cleanup()
+
+    def cpthook(self):
+        cpt = self.env.cpthook()
+        # Drain the queue in the test rather than a detached worker
+        cpt._start_worker = lambda: self.workers.append(True)
+        return cpt
+
+    def run_hook(self, hook):
+        orig_dir = os.getcwd()
+        os.chdir(self.repo1)
+        os.environ['CPTHOOK_TEST'] = 'env'
+        try:
+            return self.cpthook().run_hook(hook, [self.log],
+                                           StringIO('old new ref\n'))
+        finally:
+            del os.environ['CPTHOOK_TEST']
+            os.chdir(orig_dir)
+
+    def read_log(self):
+        with open(self.log) as f:
+            return f.read().splitlines()
+
+    def test_queued(self):
+        """Async scripts of post-* hooks run when the queue is drained"""
+        self.assertEqual(self.run_hook('post-receive'), 0)
+        self.assertEqual(self.read_log(), ['a'])
+        self.assertEqual(self.workers, [True])
+        self.cpthook().drain_queue()
+        self.assertEqual(self.read_log(), ['a', 'old new ref',
+                                           os.path.realpath(self.repo1),
+                                           'env'])
+
+    def test_not_post_hook(self):
+        """Async scripts of other hooks are run synchronously"""
+        self.assertEqual(self.run_hook('pre-receive'), 0)
+        self.assertEqual(self.read_log(), ['c'])
+        self.assertEqual(self.workers, [])
+
+    def test_retry_and_fail(self):
+        """A failing job is retried and then moved to failed"""
+        with open(self.log + '.exit', 'w') as f:
+            f.write('1\n')
+        self.run_hook('post-receive')
+        self.cpthook().drain_queue()
+        queue = cpthook.HookQueue(
+            self.env.cpthook().config.global_config['async-queue'])
+        self.assertEqual(self.read_log().count('old new ref'), 2)
+        self.assertEqual(queue.pending(), [])
+        failed = sorted(os.listdir(queue._path('failed')))
+        self.assertEqual(failed, [failed[0], failed[0] + '.input'])
+        self.assertEqual(os.listdir(queue._path('input')), [])
+
+    def test_input_file(self):
+        """Hook input is kept in a file beside the queued job"""
+        self.run_hook('post-receive')
+        queue = self.cpthook().queue
+        name = queue.pending()[0]
+        job = queue.claim(name)
+        self.assertNotIn('stdin', job)
+        with queue.input(job) as f:
+            self.assertEqual(f.read(), 'old new ref\n')
+
+    def test_retry_backoff(self):
+        """A failing job is not due again until its backoff has passed"""
+        with open(self.log + '.exit', 'w') as f:
+            f.write('1\n')
+        self.run_hook('post-receive')
+        cpt = self.cpthook()
+        name = cpt.queue.pending()[0]
+        cpt._run_queued(name, 3, 60)
+        self.assertEqual(cpt.queue.ready(), [])
+        self.assertGreater(cpt.queue.due(cpt.queue.pending()[0]),
+                           time.time() + 50)
+        self.assertEqual(self.read_log().count('old new ref'), 1)
+
+
+class ScriptTableTests(unittest.TestCase):
+
+    config = ('[repos test]\nmembers = repo1\nhooks = hooks1\n'
+              '[hooks hooks1]\npre-receive = a.sh b.sh c.sh\n')
+
+    def setUp(self):
+        self.env = HookEnvironment(self.config, {'pre-receive/a.sh': '',
+                                                 'pre-receive/b.sh': ''})
+        os.chmod(self.env.path('hooks.d', 'pre-receive', 'b.sh'), 0644)
+
+    def tearDown(self):
+        self.env.cleanup()
+
+    def test_script_problems(self):
+        """Missing and non-executable scripts are reported"""
+        config = cpthook.CptHookConfig(self.env.config_file)
+        self.assertEqual(config.script_problems(), [
+            'hooks hooks1: pre-receive hook b.sh is not executable',
+            'hooks hooks1: pre-receive hook c.sh does not exist'])
+
+    def test_cached_table(self):
+        """The table is stored in the config cache and revalidated"""
+        cache = self.env.path('hook.cache')
+        cpthook.CptHookConfig(self.env.config_file, cache_file=cache)
+        config = cpthook.CptHookConfig(self.env.config_file,
+                                       cache_file=cache)
+        entry = config.scripts.lookup('pre-receive', 'a.sh')
+        self.assertEqual(entry['path'],
+                         self.env.path('hooks.d', 'pre-receive', 'a.sh'))
+        self.assertTrue(entry['executable'])
+        self.assertNotEqual(entry['sha1'], None)
+        self.assertFalse(
+            config.scripts.lookup('pre-receive', 'b.sh')['executable'])
+        os.chmod(self.env.path('hooks.d', 'pre-receive', 'b.sh'), 0755)
+        self.assertTrue(
+            config.scripts.lookup('pre-receive', 'b.sh')['executable'])
+        self.assertEqual(config.scripts.lookup('pre-receive', 'c.sh'), None)
+
+
+class ProcessSlotsTests(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_slots(self):
+        """No more than count slots are held at once"""
+        slots = cpthook.ProcessSlots(self.dir, 2)
+        first = slots.acquire()
+        second = slots.acquire()
+        self.assertEqual(slots.acquire(time.time()), None)
+        slots.release(first)
+        third = slots.acquire(time.time())
+        self.assertNotEqual(third, None)
+        slots.release(second)
+        slots.release(third)
+
+    def test_shared_modes(self):
+        """Slots are created for use by all users whatever the umask"""
+        directory = os.path.join(self.dir, 'slots')
+        slots = cpthook.ProcessSlots(directory, 1)
+        umask = os.umask(077)
+        try:
+            slots.release(slots.acquire())
+        finally:
+            os.umask(umask)
+        self.assertEqual(stat.S_IMODE(os.stat(directory).st_mode), 01777)
+        self.assertEqual(stat.S_IMODE(os.stat(
+            os.path.join(directory, 'slot-0')).st_mode), 0644)
+
+    def test_unusable_directory(self):
+        """No slot is taken when the slot files cannot be opened"""
+        directory = os.path.join(self.dir, 'file')
+        with open(directory, 'w'):
+            pass
+        slots = cpthook.ProcessSlots(directory, 1)
+        self.assertEqual(slots.acquire(), None)
+
+
+class ConfigWatcherTests(unittest.TestCase):
+
+    def setUp(self):
+        self.env = HookEnvironment('', {'pre-receive/a.sh': 'exit 0\n'})
+
+    def tearDown(self):
+        self.env.cleanup()
+
+    def check_watcher(self, use_inotify):
+        watcher = cpthook.ConfigWatcher(self.env.config_file,
+                                        self.env.script_path, use_inotify)
+        watcher.poll_interval = 0.05
+        try:
+            self.assertFalse(watcher.wait(0.2))
+            # Unrelated files next to the config are ignored
+            with open(self.env.path('unrelated'), 'w') as f:
+                f.write('x')
+            self.assertFalse(watcher.wait(0.2))
+            self.env.write_config('[repos test]\nmembers = repo1\n')
+            self.assertTrue(watcher.wait(2))
+            time.sleep(0.05)
+            with open(self.env.path('hooks.d', 'pre-receive', 'b.sh'),
+                      'w') as f:
+                f.write('exit 0\n')
+            self.assertTrue(watcher.wait(2))
+        finally:
+            watcher.close()
+
+    def test_inotify(self):
+        """Changes to the config and scripts are seen with inotify"""
+        if cpthook._load_libc('inotify_init') is None:
+            return
+        self.check_watcher(True)
+
+    def test_polling(self):
+        """Changes to the config and scripts are seen by polling"""
+        self.check_watcher(False)
+
+
+class ResultCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_ttl(self):
+        """Results older than the ttl are not used"""
+        cache = cpthook.ResultCache(self.dir)
+        cache.put('k', 1, 'out', 'err')
+        self.assertEqual(cache.get('k', 60)['stdout'], 'out')
+        os.utime(os.path.join(self.dir, 'k'), None)
+        result = cache.get('k')
+        self.assertEqual((result['exit'], result['stderr']), (1, 'err'))
+        cache.put('old', 0, '', '')
+        with open(os.path.join(self.dir, 'old'), 'rb') as f:
+            result = cpthook.marshal.load(f)
+        result['time'] -= 120
+        with open(os.path.join(self.dir, 'old'), 'wb') as f:
+            cpthook.marshal.dump(result, f)
+        self.assertEqual(cache.get('old', 60), None)
+
+    def test_lru_eviction(self):
+        """The least recently used results are evicted first"""
+        cache = cpthook.ResultCache(self.dir, max_entries=2)
+        cache.put('a', 0, '', '')
+        cache.put('b', 0, '', '')
+        past = time.time() - 60
+        os.utime(os.path.join(self.dir, 'a'), (past, past))
+        os.utime(os.path.join(self.dir, 'b'), (past - 10, past - 10))
+        cache.put('c', 0, '', '')
+        self.assertEqual(sorted(os.listdir(self.dir)), ['a', 'c'])
+
+
+class BatchTests(unittest.TestCase):
+
+    config = ('[repos test]\nmembers = repo1 repo2\nhooks = hooks1\n'
+              '[hooks hooks1]\npost-receive = a.sh\npre-receive = b.sh\n')
+
+    def setUp(self):
+        self.env = HookEnvironment(self.config, {
+            'post-receive/a.sh': 'cat >> "$0.log"; pwd >> "$0.log"\n',
+            'pre-receive/b.sh': 'echo b; exit 3\n'})
+        self.repo1 = self.env.add_repo('repo1')
+        self.repo2 = self.env.add_repo('repo2')
+
+    def tearDown(self):
+        self.env.cleanup()
+
+    def test_batch(self):
+        """Each job runs in its repository with its own input"""
+        cpt = cpthook.CptHook(self.env.config_file)
+        cpt.jobs = 2
+        report = cpt.run_batch([
+            {'repo': self.repo1, 'hook': 'post-receive', 'input': 'a\n'},
+            {'repo': self.repo2, 'hook': 'post-receive', 'input': 'b\n'},
+            {'repo': self.repo2, 'hook': 'pre-receive'},
+            {'repo': self.env.path('missing'), 'hook': 'pre-receive'}])
+        self.assertEqual([job['exit'] for job in report], [0, 0, 3, -1])
+        self.assertEqual(report[0]['repo'], self.repo1)
+        self.assertTrue('error' in report[3])
+        self.assertTrue(all(job['duration'] >= 0 for job in report))
+        with open(self.env.path('hooks.d', 'post-receive', 'a.sh.log')) as f:
+            lines = sorted(f.read().splitlines())
+        self.assertEqual(lines, sorted(['a', os.path.realpath(self.repo1),
+                                        'b', os.path.realpath(self.repo2)]))
+
+    def test_batch_report(self):
+        """Script output is kept out of the batch report"""
+        cpthook_path = os.path.join(
+            os.path.dirname(os.path.realpath(cpthook.__file__)), 'cpthook')
+        p = subprocess.Popen([cpthook.sys.executable, cpthook_path,
+                              '--config={0}'.format(self.env.config_file),
+                              '--batch=-'],
+                             stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                             stderr=subprocess.PIPE)
+        out, err = p.communicate(json.dumps(
+            {'repo': self.repo2, 'hook': 'pre-receive'}) + '\n')
+        self.assertEqual(p.returncode, 1)
+        self.assertEqual([json.loads(line)['exit']
+                          for line in out.splitlines()], [3])
+        self.assertIn('b\n', err)
+
+
+class TraceTests(unittest.TestCase):
+
+    def setUp(self):
+        self.env = HookEnvironment(
+            '[repos test]\nmembers = repo1 repo2\nhooks = hooks1\n'
+            '[hooks hooks1]\npre-receive = a.sh b.sh\n',
+            {'pre-receive/a.sh': 'cat >/dev/null\n',
+             'pre-receive/b.sh': 'exit 1\n'})
+        self.env.add_repo('repo1')
+        self.env.add_repo('repo2')
+        self.trace = self.env.path('trace.log')
+
+    def tearDown(self):
+        self.env.cleanup()
+
+    def test_trace_spans(self):
+        """Each phase and script is recorded with its exit code"""
+        tracer = cpthook.HookTracer(self.trace)
+        ret = self.env.run_hook('repo1', 'pre-receive', stdin='refs\n',
+                                tracer=tracer)
+        self.assertEqual(ret, 1)
+        with open(self.trace) as f:
+            spans = [json.loads(line) for line in f]
+        self.assertEqual([x['phase'] for x in spans],
+                         ['repo-check', 'resolve', 'script', 'script',
+                          'hook'])
+        self.assertEqual([x.get('exit') for x in spans],
+                         [None, None, 0, 1, 1])
+        self.assertEqual(spans[2]['script'], 'a.sh')
+        self.assertEqual(spans[2]['stdin_bytes'], 5)
+        self.assertEqual(spans[4]['repo'], 'repo1')
+
+    def test_trace_stats(self):
+        """Durations are summarised per script and per repo"""
+        tracer = cpthook.HookTracer(self.trace, max_bytes=1000,
+                                    backup_count=5)
+        for i in range(3):
+            self.env.run_hook('repo1', 'pre-receive', tracer=tracer)
+        self.env.run_hook('repo2', 'pre-receive', tracer=tracer)
+        self.assertTrue(os.path.exists(self.trace + '.1'))
+        stats = cpthook.trace_stats(self.trace)
+        self.assertEqual(sorted(stats['script']),
+                         ['pre-receive/a.sh', 'pre-receive/b.sh'])
+        self.assertEqual(stats['script']['pre-receive/a.sh']['count'], 4)
+        self.assertEqual(stats['repo']['repo1']['count'], 3)
+        self.assertTrue(stats['repo']['repo1']['p50'] <=
+                        stats['repo']['repo1']['p99'])
+
+    def test_percentile(self):
+        """Percentiles are nearest rank values"""
+        values = range(1, 101)
+        self.assertEqual([cpthook._percentile(values, p)
+                          for p in (50, 95, 99, 100)], [50, 95, 99, 100])
+        self.assertEqual(cpthook._percentile([1, 2], 50), 1)
+        self.assertEqual(cpthook._percentile([1, 2], 51), 2)
+        self.assertEqual(cpthook._percentile([7], 99), 7)
+
+    def test_process_start_time(self):
+        """The start time of this process is in the recent past"""
+        start = cpthook.process_start_time()
+        if start is None:
+            return
+        self.assertTrue(time.time() - 3600 < start <= time.time())
+
+
+class DaemonTests(unittest.TestCase):
+
+    def setUp(self):
+        self.env = HookEnvironment(
+            '[repos test]\nmembers = repo1\nhooks = hooks1\n'
+            '[hooks hooks1]\npre-receive = a.sh\n',
+            {'pre-receive/a.sh': 'echo "args $*"; cat; echo oops >&2; '
+                                 'exit 4\n'})
+        self.repo = self.env.add_repo('repo1')
+        self.socket = self.env.path('cpthook.sock')
+        cpt = self.env.cpthook()
+        cpt.socket_path = self.socket
+        cpt.add_hooks_to_repo(self.repo, ['pre-receive'])
+
+    def tearDown(self):
+        self.env.cleanup()
+
+    def test_install_options(self):
+        """Wrappers record the options they were installed with"""
+        with open(os.path.join(self.repo, 'hooks', 'pre-receive')) as f:
+            lines = f.read().splitlines()
+        self.assertTrue('# cpthook-install: --socket={0}'.format(
+            os.path.realpath(self.socket)) in lines)
+
+    def test_daemon_wrapper(self):
+        """Wrappers run hooks through the daemon"""
+        daemon = cpthook.CptHookDaemon(self.env.config_file, self.socket)
+        daemon.poll_interval = 0.1
+        server = threading.Thread(target=daemon.serve_forever)
+        server.start()
+        try:
+            for i in range(50):
+                if os.path.exists(self.socket):
+                    break
+                time.sleep(0.1)
+            # Only the daemon, holding the loaded config, can succeed
+            os.remove(self.env.config_file)
+            ret, out, err = self.env.run_wrapper('repo1', 'pre-receive',
+                                                 ['x', 'y'], 'refs\n')
+        finally:
+            daemon.shutdown()
+            server.join()
+        self.assertEqual(ret, 4)
+        self.assertEqual(out, 'args x y\nrefs\n')
+        self.assertEqual(err, 'oops\n')
+
+    def test_daemon_unreachable(self):
+        """Wrappers fall back to running cpthook without the daemon"""
+        ret, out, err = self.env.run_wrapper('repo1', 'pre-receive',
+                                             ['x'], 'refs\n')
+        self.assertEqual(ret, 4)
+        self.assertEqual(out, 'args x\nrefs\n')
+        self.assertEqual(err, 'oops\n')
+
+
+class UpdateHooksTests(unittest.TestCase):
+
+    config = ('[repos test]\nmembers = repo1 repo2\nhooks = hooks1\n'
+              '[hooks hooks1]\npre-receive = a.sh\npost-receive = b.sh\n')
+
+    def setUp(self):
+        self.env = HookEnvironment(self.config, {})
+        self.repo1 = self.env.add_repo('repo1')
+        self.repo2 = self.env.add_repo('repo2')
+        self.manifest = self.env.path('manifest.json')
+
+    def tearDown(self):
+        self.env.cleanup()
+
+    def update(self, manifest=True, jobs=1, sync=False):
+        cpt = self.env.cpthook()
+        if manifest:
+            cpt.manifest_file = self.manifest
+        cpt.jobs = jobs
+        cpt.sync = sync
+        cpt.update_hooks()
+        return cpt
+
+    def hooks(self, repo_path):
+        hooks = os.listdir(os.path.join(repo_path, 'hooks'))
+        return sorted(h for h in hooks if h in cpthook.supported_hooks)
+
+    def test_full_update(self):
+        """Without a manifest all wrappers are installed"""
+        self.update()
+        self.assertTrue(os.path.isfile(self.manifest))
+        self.assertEqual(self.hooks(self.repo1),
+                         ['post-receive', 'pre-receive'])
+        self.assertEqual(self.hooks(self.repo2),
+                         ['post-receive', 'pre-receive'])
+
+    def test_incremental_update(self):
+        """With a manifest only changed wrappers are touched"""
+        self.update()
+        wrapper = os.path.join(self.repo2, 'hooks', 'pre-receive')
+        inode = os.stat(wrapper).st_ino
+        self.env.write_config(
+            '[repos test]\nmembers = repo1\nhooks = hooks1\n'
+            '[repos other]\nmembers = repo2\nhooks = hooks2\n'
+            '[hooks hooks1]\npost-receive = b.sh\n'
+            '[hooks hooks2]\npre-receive = a.sh\nupdate = c.sh\n')
+        self.update()
+        self.assertEqual(self.hooks(self.repo1), ['post-receive'])
+        self.assertEqual(self.hooks(self.repo2), ['pre-receive', 'update'])
+        # An unchanged wrapper is not rewritten
+        self.assertEqual(os.stat(wrapper).st_ino, inode)
+
+    def test_replaced_wrapper(self):
+        """Wrappers removed or rewritten since the update are restored"""
+        self.update()
+        os.remove(os.path.join(self.repo1, 'hooks', 'post-receive'))
+        # An update without the manifest installs different wrappers
+        cpt = self.env.cpthook()
+        cpt.socket_path = self.env.path('cpthook.sock')
+        cpt.update_hooks()
+        self.update()
+        self.assertEqual(self.hooks(self.repo1),
+                         ['post-receive', 'pre-receive'])
+        with open(os.path.join(self.repo2, 'hooks', 'pre-receive')) as f:
+            self.assertFalse('cpthook.sock' in f.read())
+
+    def test_concurrent_update(self):
+        """Concurrent updates log the same output as serial updates"""
+        for i in range(3, 20):
+            self.env.add_repo('repo{0}'.format(i))
+        self.env.write_config(
+            '[repos test]\nmembers = {0}\nhooks = hooks1\n'
+            '[hooks hooks1]\npre-receive = a.sh\npost-receive = b.sh\n'
+            .format(' '.join('repo{0}'.format(i) for i in range(1, 22))))
+        logs = []
+        for jobs in (1, 8):
+            for i in range(1, 20):
+                hooks = self.env.path('repos', 'repo{0}.git'.format(i),
+                                      'hooks')
+                for hook in self.hooks(os.path.dirname(hooks)):
+                    os.remove(os.path.join(hooks, hook))
+            with LogCapture() as capture:
+                self.update(manifest=False, jobs=jobs)
+            logs.append(capture.messages)
+        self.assertEqual(logs[0], logs[1])
+        self.assertEqual(len([x for x in logs[0] if x.startswith('Wrote')]),
+                         38)
+
+    def test_atomic_write(self):
+        """Wrappers are renamed into place executable and synced"""
+        load_libc = cpthook._load_libc
+        try:
+            for libc in (load_libc, lambda *functions: None):
+                cpthook._load_libc = libc
+                cpt = self.update(manifest=False, sync=True)
+                self.assertEqual(cpt._written_paths, set())
+                for repo_path in (self.repo1, self.repo2):
+                    hooks = os.path.join(repo_path, 'hooks')
+                    self.assertEqual(
+                        [h for h in os.listdir(hooks)
+                         if h.startswith('.cpthook-')], [])
+                    mode = os.stat(os.path.join(hooks, 'pre-receive'))
+                    self.assertEqual(stat.S_IMODE(mode.st_mode), 0755)
+        finally:
+            cpthook._load_libc = load_libc
+
+    def test_removed_repo(self):
+        """Wrappers of repos dropped from the config are removed"""
+        self.update()
+        self.env.write_config(
+            '[repos test]\nmembers = repo1\nhooks = hooks1\n'
+            '[hooks hooks1]\npre-receive = a.sh\n')
+        self.update()
+        self.assertEqual(self.hooks(self.repo1), ['pre-receive'])
+        self.assertEqual(self.hooks(self.repo2), [])
+
+
+class CompiledWrapperTests(unittest.TestCase):
+
+    config = ('[repos test]\nmembers = repo1\nhooks = hooks1\n'
+              '[hooks hooks1]\npre-receive = a.sh missing.sh b.sh c.sh\n'
+              'update = a.sh\n')
+    scripts = {
+        'pre-receive/a.sh': 'echo a; cat\n',
+        'pre-receive/b.sh': 'echo b; cat; exit 3\n',
+        'pre-receive/c.sh': 'echo c\n',
+        'update/a.sh': 'echo update "$@"\n',
+    }
+
+    def setUp(self):
+        self.env = HookEnvironment(self.config, self.scripts)
+        self.repo = self.env.add_repo('repo1')
+
+    def tearDown(self):
+        self.env.cleanup()
+
+    def install(self, manifest=None):
+        cpt = self.env.cpthook()
+        cpt.compile_wrappers = True
+        cpt.manifest_file = manifest
+        cpt.update_hooks()
+
+    def wrapper(self, hook):
+        with open(os.path.join(self.repo, 'hooks', hook)) as f:
+            return f.read()
+
+    def test_compiled(self):
+        """Scripts run in order with replayed input until one fails"""
+        self.install()
+        lines = self.wrapper('pre-receive').splitlines()
+        self.assertTrue(lines[3].startswith('# cpthook: '))
+        self.assertTrue('--config={0}'.format(
+            os.path.realpath(self.env.config_file)) in lines[3])
+        self.assertEqual(lines[4], '# cpthook-install: --compile')
+        self.assertEqual(self.env.run_wrapper('repo1', 'pre-receive',
+                                              stdin='x\n'),
+                         (3, 'a\nx\nb\nx\n', ''))
+        self.assertEqual(self.env.run_wrapper('repo1', 'update', ['r']),
+                         (0, 'update r\n', ''))
+
+    def test_fallback(self):
+        """Plans that need cpthook get the usual wrapper"""
+        self.env.write_config(
+            '[repos test]\nmembers = repo1\nhooks = hooks1 hooks2\n'
+            '[hooks hooks1]\nupdate = a.sh\n'
+            '[hooks hooks2]\ntimeout = 5\npre-receive = a.sh\n')
+        self.install()
+        self.assertTrue('--hook=pre-receive $*' in self.wrapper('pre-receive'))
+        self.assertFalse('--hook=update $*' in self.wrapper('update'))
+
+    def test_config_change(self):
+        """Incremental updates regenerate changed compiled wrappers"""
+        manifest = self.env.path('manifest.json')
+        self.install(manifest)
+        self.env.write_config(
+            '[repos test]\nmembers = repo1\nhooks = hooks1\n'
+            '[hooks hooks1]\npre-receive = c.sh a.sh\nupdate = a.sh\n')
+        self.install(manifest)
+        self.assertEqual(self.env.run_wrapper('repo1', 'pre-receive',
+                                              stdin='x\n'),
+                         (0, 'c\na\nx\n', ''))
+
+
+class CptHookSetTests(unittest.TestCase):
+
+    config = ('[repos test]\nmembers = repo1 repo2\nhooks = hooks1\n'
+              '[hooks hooks1]\npre-receive = a.sh\n')
+    other_config = ('[repos other]\nmembers = repo2 repo3\nhooks = hooks2\n'
+                    '[hooks hooks2]\nupdate = b.sh\n')
+
+    def setUp(self):
+        self.env = HookEnvironment(self.config, {})
+        for name in ('repo1', 'repo2', 'repo3', 'repo4'):
+            self.env.add_repo(name)
+        self.write_other(self.other_config)
+        self.config_list = self.env.path('configs')
+        with open(self.config_list, 'w') as f:
+            f.write('# In precedence order\nhook.cfg\n\nother.cfg\n')
+
+    def tearDown(self):
+        self.env.cleanup()
+
+    def write_other(self, config, repo_path=None):
+        with open(self.env.path('other.cfg'), 'w') as f:
+            f.write('[cpthook]\nscript-path = {0}\nrepo-path = {1}\n{2}'
+                    .format(self.env.script_path,
+                            repo_path or self.env.repo_path, config))
+
+    def cpthooks(self, manifest=False):
+        cpts = cpthook.CptHookSet(self.config_list)
+        for cpt in cpts.hooks:
+            cpt._script_name = self.env.cpthook()._script_name
+        if manifest:
+            cpts.manifest_file = self.env.path('manifest.json')
+        return cpts
+
+    def hooks(self, repo):
+        hooks = os.listdir(self.env.path('repos', repo + '.git', 'hooks'))
+        return sorted(h for h in hooks if h in cpthook.supported_hooks)
+
+    def test_shared_locator(self):
+        """Configs with the same repo-path share a locator"""
+        cpts = self.cpthooks()
+        self.assertEqual(cpts.config_files, [self.env.config_file,
+                                             self.env.path('other.cfg')])
+        self.assertTrue(cpts.hooks[0].locator is cpts.hooks[1].locator)
+
+    def test_shared_listings(self):
+        """A search path in several repo-path lists is listed once"""
+        extra = self.env.path('extra')
+        os.mkdir(extra)
+        self.write_other(self.other_config,
+                         '{0} {1}'.format(self.env.repo_path, extra))
+        cpts = self.cpthooks()
+        self.assertFalse(cpts.hooks[0].locator is cpts.hooks[1].locator)
+        listed = []
+        orig_list_dirs = cpthook._list_dirs
+
+        def list_dirs(path):
+            listed.append(path)
+            return orig_list_dirs(path)
+
+        cpthook._list_dirs = list_dirs
+        try:
+            cpts.update_hooks()
+        finally:
+            cpthook._list_dirs = orig_list_dirs
+        self.assertEqual(sorted(listed), sorted(
+            os.path.realpath(p) for p in (extra, self.env.repo_path)))
+        self.assertEqual(self.hooks('repo3'), ['update'])
+
+    def test_conflicts(self):
+        """A repo claimed by two configs is managed by the first"""
+        cpts = self.cpthooks()
+        self.assertEqual(cpts.conflicts(), [
+            ('repo2', [self.env.config_file, self.env.path('other.cfg')])])
+        wrapper = self.env.path('repos', 'repo4.git', 'hooks', 'update')
+        with open(wrapper, 'w') as f:
+            f.write('#!/bin/sh\n# cpthook-wrapper\n')
+        with LogCapture(logging.WARN) as capture:
+            cpts.update_hooks()
+        self.assertTrue(capture.messages[0].startswith(
+            'Repo repo2 is claimed by'))
+        self.assertEqual(self.hooks('repo1'), ['pre-receive'])
+        self.assertEqual(self.hooks('repo2'), ['pre-receive'])
+        self.assertEqual(self.hooks('repo3'), ['update'])
+        # Unmanaged by any config
+        self.assertEqual(self.hooks('repo4'), [])
+
+    def test_incremental_move(self):
+        """A repo moved between configs gets the new config's hooks"""
+        self.cpthooks(manifest=True).update_hooks()
+        self.env.write_config(
+            '[repos test]\nmembers = repo1\nhooks = hooks1\n'
+            '[hooks hooks1]\npre-receive = a.sh\n')
+        self.cpthooks(manifest=True).update_hooks()
+        self.assertEqual(self.hooks('repo1'), ['pre-receive'])
+        self.assertEqual(self.hooks('repo2'), ['update'])
+        self.assertEqual(self.hooks('repo3'), ['update'])
+        manifests = sorted(x for x in os.listdir(self.env.root)
+                           if x.startswith('manifest.json.'))
+        self.assertEqual(len(manifests), 2)
+
+
+class RepoPatternTests(unittest.TestCase):
+
+    config = ('[repos team]\nmembers = team-a/* re:^svc-\nhooks = hooks1\n'
+              '[hooks hooks1]\npre-receive = a.sh\n')
+
+    def setUp(self):
+        self.env = HookEnvironment(self.config, {
+            'pre-receive/a.sh': 'echo a >> "$0.log"\n'})
+        self.web = self.env.add_repo('team-a/web')
+        self.svc = self.env.add_repo('svc-auth')
+        self.other = self.env.add_repo('other')
+
+    def tearDown(self):
+        self.env.cleanup()
+
+    def test_install_matching_repos(self):
+        """Repositories matching a pattern have hooks installed"""
+        self.env.cpthook().install_hooks()
+        for path in (self.web, self.svc):
+            self.assertTrue(os.path.isfile(
+                os.path.join(path, 'hooks', 'pre-receive')))
+        self.assertFalse(os.path.isfile(
+            os.path.join(self.other, 'hooks', 'pre-receive')))
+
+    def test_nested_repo_name(self):
+        """Hooks in nested repositories are found by their full name"""
+        self.assertEqual(self.env.run_hook('team-a/web', 'pre-receive'), 0)
+        self.assertTrue(os.path.isfile(
+            self.env.path('hooks.d', 'pre-receive', 'a.sh.log')))
+
+
+class RepoDetectionTests(unittest.TestCase):
+
+    def setUp(self):
+        self.env = HookEnvironment('', {})
+        self.cpt = cpthook.CptHook(self.env.config_file)
+
+    def tearDown(self):
+        self.env.cleanup()
+
+    def test_bare_repo(self):
+        self.assertTrue(self.cpt._is_git_repo(self.env.add_repo('bare')))
+
+    def test_work_tree(self):
+        path = self.env.path('work')
+        with open(os.devnull, 'wb') as devnull:
+            subprocess.check_call(['git', 'init', path], stdout=devnull)
+        self.assertTrue(self.cpt._is_git_repo(path))
+
+    def test_gitdir_file(self):
+        """A .git file pointing at the git directory is followed"""
+        git_dir = self.env.add_repo('separate')
+        path = self.env.path('linked')
+        os.mkdir(path)
+        with open(os.path.join(path, '.git'), 'w') as f:
+            f.write('gitdir: {0}\n'.format(git_dir))
+        self.assertTrue(self.cpt._is_git_repo(path))
+
+    def test_not_a_repo(self):
+        self.assertFalse(self.cpt._is_git_repo(self.env.repo_path))
+        self.assertFalse(self.cpt._is_git_repo(self.env.path('missing')))
+
+    def test_ambiguous_layout(self):
+        """Strict detection asks git about incomplete git directories"""
+        path = self.env.path('partial')
+        os.mkdir(path)
+        with open(os.path.join(path, 'HEAD'), 'w') as f:
+            f.write('ref: refs/heads/master\n')
+        self.assertTrue(self.cpt._is_git_repo(path))
+        self.cpt.strict_repo_detection = True
+        self.cpt.repo_detection_cache = False
+        self.assertFalse(self.cpt._is_git_repo(path))
+
+
+class RepoLocatorTests(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        for path in ('a/plain/hooks', 'a/work/.git/hooks', 'a/bare.git/hooks',
+                     'a/both/hooks', 'a/both.git/hooks',
+                     'a/workbare.git/.git/hooks', 'a/nohooks',
+                     'a/team/nested.git/hooks',
+                     'b/plain/hooks', 'b/other.git/hooks'):
+            os.makedirs(os.path.join(self.root, path))
+        self.locator = cpthook.RepoLocator(
+            [os.path.join(self.root, 'a'), os.path.join(self.root, 'b')])
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def assertLocated(self, repo, path):
+        if path is not None:
+            path = os.path.join(self.root, path)
+        self.assertEqual(self.locator.locate(repo), path)
+
+    def test_naming_cases(self):
+        self.assertLocated('plain', 'a/plain')
+        self.assertLocated('work', 'a/work/.git')
+        self.assertLocated('bare', 'a/bare.git')
+        self.assertLocated('workbare', 'a/workbare.git/.git')
+        self.assertLocated('both', 'a/both')
+
+    def test_search_path_order(self):
+        self.assertLocated('other', 'b/other.git')
+
+    def test_missing(self):
+        self.assertLocated('nohooks', None)
+        self.assertLocated('doesnotexist', None)
+
+    def test_nested(self):
+        self.assertLocated('team/nested', 'a/team/nested.git')
+
+    def test_nested_search_paths(self):
+        """A repository is named from the deepest search path below it"""
+        self.locator = cpthook.RepoLocator(
+            [os.path.join(self.root, 'a'), os.path.join(self.root, 'a/team')])
+        path = os.path.join(self.root, 'a/team/nested.git')
+        self.assertEqual(self.locator.name(path), 'nested')
+        self.assertLocated('nested', 'a/team/nested.git')
+
+    def test_paths(self):
+        self.assertEqual(
+            [os.path.relpath(p, self.root) for p in self.locator.paths()],
+            ['a/bare.git', 'a/both', 'a/both.git', 'a/nohooks', 'a/plain',
+             'a/team', 'a/work', 'a/workbare.git', 'b/other.git', 'b/plain'])
@@ -1,4 +1,5 @@
 import os.path
+import shutil
 import sys
 import tempfile
 import unittest
@@ -34,6 +35,35 @@ class UnitTests(unittest.TestCase):
             h = CptHookConfig(config)
         self.assertRaises(cpthook.CyclicalDependencyException, f)
 
+    def test_cyclical_dependency_path(self):
+        """The reported cycle names each group on the cycle in order"""
+        try:
+            CptHookConfig(cfgfile('test_cyclical_dependency.cfg'))
+        except cpthook.CyclicalDependencyException as e:
+            self.assertEqual(str(e), 'cyclical1 -> cyclical2 -> cyclical1')
+        else:
+            self.fail('CyclicalDependencyException not raised')
+
+    def test_duplicate_inheritance(self):
+        """Inherited members are deduplicated, keeping first occurrence"""
+        h = CptHookConfig(cfgfile())
+        self.assertEqual(h.repo_groups['top']['members'], ['repo1', 'repo2'])
+
+    def test_deep_inheritance(self):
+        """Long inheritance chains resolve to the root members"""
+        config_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, config_dir)
+        config = os.path.join(config_dir, 'hook.cfg')
+        with open(config, 'w') as f:
+            f.write('[repos level0]\nmembers = repo0\n')
+            for i in range(1, 200):
+                f.write('[repos level{0}]\nmembers = repo{0} @level{1}\n'
+                        .format(i, i - 1))
+        h = CptHookConfig(config)
+        members = h.repo_groups['level199']['members']
+        self.assertEqual(len(members), 200)
+        self.assertEqual(members[:2], ['repo199', 'repo198'])
+
     def test_unknown_dependency(self):
         config = cfgfile()
         def f():
@@ -62,7 +92,196 @@ class UnitTests(unittest.TestCase):
         hooks = h.hooks_for_repo('repo1')
         self.assertEqual(hooks, {'pre-receive': ['pre-receive.sh']})
 
+    def test_repo_group_membership(self):
+        """Membership includes inherited groups and the global group"""
+        h = CptHookConfig(cfgfile('complete-valid.cfg'))
+        self.assertEqual(h.repo_group_membership('repo1'),
+                         ['test1', 'test2', 'test4'])
+        self.assertEqual(h.repo_group_membership('doesnotexist'), [])
+
+    def test_repos(self):
+        """All members of all repo groups are known repos"""
+        h = CptHookConfig(cfgfile('complete-valid.cfg'))
+        self.assertEqual(h.repos(), ['repo1', 'repo1a', 'repo2', 'repo3',
+                                     'repo4'])
+
+    def test_hook_plan(self):
+        """Parallel hook groups are split into stages"""
+        h = CptHookConfig(cfgfile())
+        plan = h.hook_plan('repo1', 'post-receive')
+        self.assertEqual([x['scripts'] for x in plan],
+                         [['first.sh'], ['email.sh'], ['ci.sh'],
+                          ['mirror.sh']])
+        self.assertEqual([x['max-parallel'] for x in plan], [1, 1, 2, 2])
+        self.assertEqual(h.hooks_for_repo('repo1')['post-receive'],
+                         ['first.sh', 'email.sh', 'ci.sh', 'mirror.sh'])
+        self.assertEqual(h.hook_plan('repo1', 'pre-receive'), [])
+
+    def test_lazy_resolution(self):
+        """Lazily resolved hooks match eagerly resolved hooks"""
+        h = CptHookConfig(cfgfile('complete-valid.cfg'))
+        for repo in h.repos() + ['doesnotexist']:
+            lazy = CptHookConfig(cfgfile('complete-valid.cfg'), lazy=True)
+            self.assertEqual(lazy.hooks_for_repo(repo),
+                             h.hooks_for_repo(repo))
+            self.assertEqual(lazy.repo_group_membership(repo),
+                             h.repo_group_membership(repo))
+        self.assertEqual(lazy.repos(), h.repos())
+
+    def test_lazy_cyclical_dependency(self):
+        """Lazy lookups report cycles involving the repo only"""
+        config = cfgfile('test_lazy_cyclical_dependency.cfg')
+        h = CptHookConfig(config, lazy=True)
+        self.assertEqual(h.hooks_for_repo('repo2'), {})
+        self.assertRaises(cpthook.CyclicalDependencyException,
+                          h.hooks_for_repo, 'repo1')
+
+    def test_lazy_unknown_dependency(self):
+        """Lazy lookups report unknown groups involving the repo only"""
+        h = CptHookConfig(cfgfile(), lazy=True)
+        self.assertEqual(h.hooks_for_repo('repo2'), {})
+        self.assertRaises(cpthook.UnknownDependencyException,
+                          h.hooks_for_repo, 'repo1')
+
+    def test_repo_patterns(self):
+        """Glob and regex members match repositories by name"""
+        for lazy in (False, True):
+            h = CptHookConfig(cfgfile('test_repo_patterns.cfg'), lazy=lazy)
+            self.assertEqual(h.repo_group_membership('team-a/web'),
+                             ['team-a'])
+            self.assertEqual(h.repo_group_membership('svc-auth'),
+                             ['everything', 'services'])
+            self.assertEqual(h.hooks_for_repo('svc-auth'),
+                             {'pre-receive': ['b.sh'],
+                              'post-receive': ['c.sh']})
+            self.assertEqual(h.repo_group_membership('svc-1'), [])
+            self.assertEqual(h.repo_group_membership('team-b/web'), [])
+            self.assertEqual(h.repos(), ['legacy'])
+            self.assertEqual(h.pattern_prefixes(), set(['team-a/', '']))
+
+    def test_repo_patterns_cache(self):
+        """Pattern members survive the config cache"""
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        cache = os.path.join(cache_dir, 'hook.cache')
+        CptHookConfig(cfgfile('test_repo_patterns.cfg'), cache_file=cache)
+        h = CptHookConfig(cfgfile('test_repo_patterns.cfg'),
+                          cache_file=cache)
+        self.assertEqual(h.repo_group_membership('team-a/web'),
+                         ['team-a'])
+
+    def test_repo_matcher(self):
+        """Every group with a matching pattern is returned"""
+        m = cpthook.RepoMatcher({'team-*': ['a'], 'team-a*': ['b'],
+                                 're:.*-ci$': ['c'], 'other': ['d']})
+        self.assertEqual(m.match('team-a-ci'), set(['a', 'b', 'c']))
+        self.assertEqual(m.match('team-b'), set(['a']))
+        self.assertEqual(m.match('team'), set())
+
+    def test_hook_inheritance(self):
+        """Inherited scripts take the place of their reference"""
+        h = CptHookConfig(cfgfile('test_hook_inheritance.cfg'), lazy=True)
+        self.assertEqual(h.hooks_for_repo('repo1'), {
+            'pre-receive': ['first.sh', 'a.sh', 'b.sh', 'last.sh']})
+        self.assertEqual(
+            [s['scripts'] for s in h.hook_plan('repo3', 'pre-receive')],
+            [['check.sh'], ['first.sh', 'a.sh', 'b.sh', 'last.sh']])
+        self.assertRaises(cpthook.CyclicalDependencyException,
+                          h.hooks_for_repo, 'repo4')
+        self.assertRaises(cpthook.CyclicalDependencyException,
+                          CptHookConfig, cfgfile('test_hook_inheritance.cfg'))
+
+    def test_invalid_pattern(self):
+        """A regex member that does not compile is a config error"""
+        config_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, config_dir)
+        config = os.path.join(config_dir, 'hook.cfg')
+        with open(config, 'w') as f:
+            f.write('[repos test1]\nmembers = re:([\nhooks = h1\n'
+                    '[hooks h1]\npre-receive = a.sh\n')
+        for lazy in (False, True):
+            self.assertRaises(cpthook.InvalidConfigValueException,
+                              CptHookConfig, config, lazy=lazy)
+
+    def test_inherited_duplicates(self):
+        """A script inherited more than once is only planned once"""
+        config_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, config_dir)
+        config = os.path.join(config_dir, 'hook.cfg')
+        with open(config, 'w') as f:
+            f.write('[repos test1]\nmembers = repo1\nhooks = h1\n'
+                    '[hooks base]\npre-receive = a.sh b.sh\n'
+                    '[hooks h1]\nparallel = true\n'
+                    'pre-receive = a.sh @base | b.sh @base c.sh\n')
+        h = CptHookConfig(config)
+        self.assertEqual(
+            [s['scripts'] for s in h.hook_plan('repo1', 'pre-receive')],
+            [['a.sh', 'b.sh'], ['c.sh']])
+
+    def test_invalid_timeout_policy(self):
+        """String options only take their allowed values"""
+        config_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, config_dir)
+        config = os.path.join(config_dir, 'hook.cfg')
+        with open(config, 'w') as f:
+            f.write('[repos test1]\nmembers = repo1\nhooks = h1\n'
+                    '[hooks h1]\ntimeout-policy = maybe\n'
+                    'pre-receive = a.sh\n')
+        self.assertRaises(cpthook.InvalidConfigValueException,
+                          CptHookConfig, config)
+
+    def test_shared_hooks(self):
+        """Repositories with the same hook groups share merged hooks"""
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        cache = os.path.join(cache_dir, 'hook.cache')
+        config = os.path.join(cache_dir, 'hook.cfg')
+        with open(config, 'w') as f:
+            f.write('[repos test1]\nmembers = repo1 repo2\nhooks = h1\n'
+                    '[hooks h1]\npre-receive = a.sh\n')
+        for _ in range(2):
+            h = CptHookConfig(config, cache_file=cache)
+            self.assertTrue(h.hooks_for_repo('repo1') is
+                            h.hooks_for_repo('repo2'))
+
     def test_parse_complete_valid_config(self):
         """Should return CptHookConfig object for valid config"""
         h = CptHookConfig(cfgfile('complete-valid.cfg'))
         self.assertIsInstance(h, CptHookConfig)
+
+    def test_cache_round_trip(self):
+        """A config loaded from cache matches the parsed config"""
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        cache = os.path.join(cache_dir, 'hook.cache')
+        h = CptHookConfig(cfgfile('complete-valid.cfg'), cache_file=cache)
+        self.assertTrue(os.path.isfile(cache))
+        c = CptHookConfig(cfgfile('complete-valid.cfg'), cache_file=cache)
+        self.assertEqual(h.hooks_for_repo('repo4'),
+                         c.hooks_for_repo('repo4'))
+        self.assertEqual(h.global_config, c.global_config)
+
+    def test_cache_readable(self):
+        """The cache is readable by users other than its writer"""
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        cache = os.path.join(cache_dir, 'hook.cache')
+        CptHookConfig(cfgfile('complete-valid.cfg'), cache_file=cache)
+        self.assertEqual(os.stat(cache).st_mode & 0777, 0644)
+
+    def test_stale_cache_is_rebuilt(self):
+        """A cache built for different config content is not used"""
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        cache = os.path.join(cache_dir, 'hook.cache')
+        config = os.path.join(cache_dir, 'hook.cfg')
+        with open(config, 'w') as f:
+            f.write('[repos test1]\nmembers = repo1\nhooks = hooks1\n'
+                    '[hooks hooks1]\npre-receive = a.sh\n')
+        CptHookConfig(config, cache_file=cache)
+        with open(config, 'w') as f:
+            f.write('[repos test1]\nmembers = repo1\nhooks = hooks1\n'
+                    '[hooks hooks1]\npre-receive = bb.sh\n')
+        h = CptHookConfig(config, cache_file=cache)
+        self.assertEqual(h.hooks_for_repo('repo1'),
+                         {'pre-receive': ['bb.sh']})
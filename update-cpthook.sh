@@ -42,7 +42,8 @@ if [ "$hookdir" == "" ]; then
 fi
 
 # Attempt to cpthook path from wrapper script in repository.
-cpthook=`grep --no-filename cpthook $hookdir/* 2>/dev/null | grep -- --config | cut -d\  -f1 | head -1`
+# Daemon wrappers record the cpthook command in a "# cpthook:" comment.
+cpthook=`grep --no-filename cpthook $hookdir/* 2>/dev/null | grep -- --config | sed -e "s/^# cpthook: //" | cut -d\  -f1 | head -1`
 
 if [ "$cpthook" == "" ]; then
     echo_warning Could not locate cpthook.
@@ -67,6 +68,10 @@ if [ ! -f "$hookcfg" ]; then
     exit 0
 fi
 
+# Options the wrappers were installed with (eg. --socket, --cache or
+# --manifest), so that updated wrappers are installed alike.
+initopts=`grep --no-filename '^# cpthook-install:' $hookdir/* 2>/dev/null | sed -e "s/^# cpthook-install: *//" | head -1`
+
 hookbase=`basename $hookcfg`
 
 # Look for a file with the same name as the config file that
@@ -103,13 +108,20 @@ while read oldrev newrev refname; do
                     echo_warning Could not write $hookcfg. Please investigate.
                 else
                     echo_notice Wrote cpthook config $hookcfg.
-                    $cpthook --config=$hookcfg --init
-                    ret=$?
-                    if [ $ret -eq 0 ]; then
-                        echo_success Successfully updated cpthook config
+                    if [ -f "$hookcfg.watch" ] && \
+                            ! flock --nonblock "$hookcfg.watch" true; then
+                        # cpthook --watch holds the lock and applies
+                        # the new config itself
+                        echo_success cpthook --watch will apply the config
                     else
-                        echo_notice Ran: $cpthook --config=$hookcfg --init
-                        echo_error cpthook update failed. Please investigate.
+                        $cpthook --config=$hookcfg $initopts --init
+                        ret=$?
+                        if [ $ret -eq 0 ]; then
+                            echo_success Successfully updated cpthook config
+                        else
+                            echo_notice Ran: $cpthook --config=$hookcfg $initopts --init
+                            echo_error cpthook update failed. Please investigate.
+                        fi
                     fi
                 fi
             fi